@@ -0,0 +1,211 @@
+"""Допуск запросов к LLM и сброс лишней нагрузки.
+
+Каждый текст, который пойдет в модель, сначала получает билет:
+
+    ticket = admission.admit(chat_id, "lesson", text)
+    if ticket.status == ADMITTED:
+        try:
+            ...  # вызов модели с ticket.text
+        finally:
+            admission.release(ticket)
+
+Правила:
+- классы запросов (урок, NeuroPartner) идут по приоритету: младший класс
+  получает место, только если старший никого не ждет, и занимает не больше
+  своей доли лимита (shares);
+- у одного чата одновременно выполняется не больше per_user запросов;
+  следующий запрос чата ждет, пока закончится его собственный, без срока
+  (это не перегрузка, а очередь внутри чата); пока он ждет, новые
+  сообщения этого чата приклеиваются к нему (COLLAPSED) и отдельного
+  вызова модели не будет; ссылки на приклеенные сообщения (ref) копятся
+  в ticket.merged;
+- общий лимит адаптивный: пока сглаженная задержка модели ниже
+  target_latency, он растет на 1 за "круг" запросов, выше - уменьшается
+  пропорционально превышению (не быстрее чем на 10% за ответ);
+- запрос, не получивший общее место за max_wait своего класса (отсчет
+  идет с момента, когда свой запрос чата уже не мешает) или пришедший в
+  переполненную очередь, получает SHED - вызывающий отвечает короткой
+  заглушкой вместо ожидания таймаута.
+"""
+import threading
+import time
+from collections import deque
+
+ADMITTED = "admitted"
+COLLAPSED = "collapsed"
+SHED = "shed"
+
+
+class Ticket:
+    __slots__ = ("chat_id", "klass", "texts", "merged", "status")
+
+    def __init__(self, chat_id, klass, text, status=None):
+        self.chat_id = chat_id
+        self.klass = klass
+        self.texts = [text]
+        self.merged = []
+        self.status = status
+
+    @property
+    def text(self):
+        """Текст запроса; приклеенные сообщения идут отдельными строками"""
+        return "\n".join(self.texts)
+
+
+class _Chat:
+    __slots__ = ("running", "waiting")
+
+    def __init__(self):
+        self.running = 0
+        self.waiting = None
+
+
+class AdmissionController:
+    def __init__(self, priority, limit=16, min_limit=2, max_limit=None, shares=None,
+                 max_wait=None, max_queue=100, per_user=1, target_latency=4.0, smoothing=0.2):
+        # priority - классы от старшего к младшему
+        self.priority = tuple(priority)
+        self.max_limit = max_limit or limit
+        self.min_limit = min_limit
+        self.limit = float(min(limit, self.max_limit))
+        self.shares = {klass: 1.0 for klass in self.priority}
+        self.shares.update(shares or {})
+        self.max_wait = {klass: 0.0 for klass in self.priority}
+        self.max_wait.update(max_wait or {})
+        self.max_queue = max_queue
+        self.per_user = per_user
+        self.target_latency = target_latency
+        self.smoothing = smoothing
+        self.latency = None
+        self._cond = threading.Condition()
+        self._chats = {}
+        self._waiting = {klass: deque() for klass in self.priority}
+        self._running = {klass: 0 for klass in self.priority}
+        self._total = 0
+        self.counters = {
+            (klass, outcome): 0
+            for klass in self.priority
+            for outcome in (ADMITTED, "queued", COLLAPSED, SHED)
+        }
+
+    # ---- допуск ----
+
+    def admit(self, chat_id, klass, text, ref=None):
+        """ref - ссылка на сообщение (message_id), попадет в merged билета-хозяина"""
+        with self._cond:
+            chat = self._chats.get(chat_id)
+            if chat is not None and chat.waiting is not None:
+                # Чат уже ждет ответа - сообщение уйдет в тот же запрос
+                chat.waiting.texts.append(text)
+                if ref is not None:
+                    chat.waiting.merged.append(ref)
+                self.counters[(klass, COLLAPSED)] += 1
+                return Ticket(chat_id, klass, text, COLLAPSED)
+
+            ticket = Ticket(chat_id, klass, text)
+            if len(self._waiting[klass]) >= self.max_queue:
+                return self._shed(ticket)
+            if chat is None:
+                chat = self._chats[chat_id] = _Chat()
+            chat.waiting = ticket
+            self._waiting[klass].append(ticket)
+
+            queued = False
+            deadline = None
+            while not self._can_run(ticket, chat):
+                queued = True
+                if chat.running >= self.per_user:
+                    # Ждем свой же запрос чата - срок допуска еще не идет
+                    self._cond.wait()
+                    continue
+                if deadline is None:
+                    deadline = time.monotonic() + self.max_wait[klass]
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    self._leave_queue(ticket, chat)
+                    # Место в очереди освободилось - младшие классы могут пройти
+                    self._cond.notify_all()
+                    return self._shed(ticket)
+                self._cond.wait(remaining)
+
+            chat.running += 1
+            self._leave_queue(ticket, chat)
+            self._running[klass] += 1
+            self._total += 1
+            self.counters[(klass, ADMITTED)] += 1
+            if queued:
+                self.counters[(klass, "queued")] += 1
+            ticket.status = ADMITTED
+            return ticket
+
+    def release(self, ticket):
+        if ticket.status != ADMITTED:
+            return
+        with self._cond:
+            ticket.status = None
+            chat = self._chats.get(ticket.chat_id)
+            if chat is not None:
+                chat.running -= 1
+                self._drop_idle(ticket.chat_id, chat)
+            self._running[ticket.klass] -= 1
+            self._total -= 1
+            self._cond.notify_all()
+
+    def observe(self, latency):
+        """Задержка ответа модели (секунды) - подстраивает общий лимит"""
+        with self._cond:
+            if self.latency is None:
+                self.latency = latency
+            else:
+                self.latency += self.smoothing * (latency - self.latency)
+            if self.latency > self.target_latency:
+                self.limit *= max(0.9, self.target_latency / self.latency)
+            else:
+                self.limit += 1 / max(1.0, self.limit)
+            self.limit = min(self.max_limit, max(self.min_limit, self.limit))
+            self._cond.notify_all()
+
+    # ---- внутреннее (под self._cond) ----
+
+    def _can_run(self, ticket, chat):
+        if chat.running >= self.per_user:
+            return False
+        limit = int(self.limit)
+        if self._total >= limit:
+            return False
+        if self._running[ticket.klass] >= max(1, int(limit * self.shares[ticket.klass])):
+            return False
+        # Старший класс, который может пойти прямо сейчас, идет первым
+        for klass in self.priority:
+            if klass == ticket.klass:
+                return True
+            for waiting in self._waiting[klass]:
+                if self._chats[waiting.chat_id].running < self.per_user:
+                    return False
+        return True
+
+    def _leave_queue(self, ticket, chat):
+        self._waiting[ticket.klass].remove(ticket)
+        chat.waiting = None
+        self._drop_idle(ticket.chat_id, chat)
+
+    def _drop_idle(self, chat_id, chat):
+        if chat.running <= 0 and chat.waiting is None:
+            self._chats.pop(chat_id, None)
+
+    def _shed(self, ticket):
+        ticket.status = SHED
+        self.counters[(ticket.klass, SHED)] += 1
+        return ticket
+
+    # ---- служебное ----
+
+    def stats(self):
+        with self._cond:
+            return {
+                "limit": int(self.limit),
+                "latency_ewma": round(self.latency, 3) if self.latency is not None else None,
+                "in_flight": dict(self._running),
+                "waiting": {klass: len(queue) for klass, queue in self._waiting.items()},
+                "counters": {f"{klass}_{outcome}": count for (klass, outcome), count in self.counters.items()}
+            }
@@ -1,68 +1,331 @@
 import httpx
-from flask import Flask, request, jsonify
-import google.generativeai as genai
+from flask import Flask, request, jsonify, Response
 import os
-import requests
 import logging
 import random
 import time
+import atexit
+import signal
+import sys
+import threading
+import functools
+from update_queue import UpdateQueue, extract_chat_id
+from telegram_client import TelegramClient
+from outbound import OutboundScheduler, BACKGROUND, is_rate_limited, is_superseded
+from render_cache import RenderCache, is_not_modified
+from screens import Screen, ScreenMemo
+from response_cache import ResponseCache, normalize_prompt
+from llm_gateway import LLMGateway, GeminiBackend, FakeLLMBackend, CircuitBreaker
+from admission import AdmissionController, COLLAPSED, SHED
+from payments import (
+    PaymentLedger, TonIndexerClient, ReconciliationPoller,
+    to_nano, format_ton, payment_comment
+)
+from streaming import ProgressiveEditor
+import chat_modes
+from chat_modes import ChatModes
+from state_store import StateStore
+from prompt_builder import LessonContextBuilder, estimate_tokens
+from lesson_openers import LessonOpeners
+from router import CallbackRouter
+from idempotency import UpdateDeduplicator
+from pipeline import UpdatePipeline
+from locks import ShardedLocks
+from sessions import create_sessions, SessionBusy, HashRing
+from metrics import MetricsRegistry, TOKEN_BUCKETS
+from log_setup import setup_logging, log_context, log_bind
+from catalog import (
+    Catalog, LESSONS_PER_PAGE, COURSES_PER_PAGE, course_callback, lesson_callback, catalog_callback,
+    parse_ids, popcount, page_slice
+)
+from conversation import (
+    Conversation, ROLE_STUDENT, ROLE_TEACHER, CONVERSATION_CAPACITY,
+    snapshot_lesson_state, encode_lesson_state, decode_lesson_state
+)
 
 app = Flask(__name__)
 
 # Настройка API ключей для Gemini
 GEMINI_API_KEY = os.getenv('GEMINI_API_KEY')
-genai.configure(api_key=GEMINI_API_KEY)
+GEMINI_MODEL = os.getenv('GEMINI_MODEL', 'gemini-2.0-flash-exp')
+
+# Шлюз к LLM: LLM_BACKEND=fake подключает локальную заглушку вместо Gemini
+LLM_BACKEND = os.getenv('LLM_BACKEND', 'gemini')
+FAKE_LLM_LATENCY = float(os.getenv('FAKE_LLM_LATENCY', '0.5'))
+FAKE_LLM_JITTER = float(os.getenv('FAKE_LLM_JITTER', '0'))
+FAKE_LLM_DISTRIBUTION = os.getenv('FAKE_LLM_DISTRIBUTION', 'uniform')
+FAKE_LLM_FAILURE_RATE = float(os.getenv('FAKE_LLM_FAILURE_RATE', '0'))
+FAKE_LLM_SEED = os.getenv('FAKE_LLM_SEED') or None
+LLM_MAX_CONCURRENCY = int(os.getenv('LLM_MAX_CONCURRENCY', '16'))
+LLM_DEADLINE = float(os.getenv('LLM_DEADLINE', '15'))
+LLM_HEDGE = os.getenv('LLM_HEDGE', '0') == '1'
+LLM_BREAKER_FAILURES = int(os.getenv('LLM_BREAKER_FAILURES', '5'))
+LLM_BREAKER_RESET = float(os.getenv('LLM_BREAKER_RESET', '30'))
+# Прогрев модели в фоне после старта: LLM_WARMUP=0 - SDK грузится при первом запросе к LLM
+LLM_WARMUP = os.getenv('LLM_WARMUP', '1') == '1'
+LLM_WARMUP_DELAY = float(os.getenv('LLM_WARMUP_DELAY', '1'))
+# Допуск к LLM: уроки важнее NeuroPartner, лимит сжимается при росте задержки модели
+ADMISSION_MIN_LIMIT = int(os.getenv('ADMISSION_MIN_LIMIT', '2'))
+ADMISSION_TARGET_LATENCY = float(os.getenv('ADMISSION_TARGET_LATENCY', '4'))
+ADMISSION_PARTNER_SHARE = float(os.getenv('ADMISSION_PARTNER_SHARE', '0.5'))
+ADMISSION_LESSON_WAIT = float(os.getenv('ADMISSION_LESSON_WAIT', '8'))
+ADMISSION_PARTNER_WAIT = float(os.getenv('ADMISSION_PARTNER_WAIT', '1'))
+ADMISSION_MAX_QUEUE = int(os.getenv('ADMISSION_MAX_QUEUE', '100'))
+
+# Потоковый показ ответов: частичный текст появляется правками сообщения
+STREAM_REPLIES = os.getenv('STREAM_REPLIES', '0') == '1'
+STREAM_EDIT_INTERVAL = float(os.getenv('STREAM_EDIT_INTERVAL', '1.5'))
+
+# Хранилище состояния: без STATE_DB_PATH все живет только в памяти
+STATE_DB_PATH = os.getenv('STATE_DB_PATH', '')
+STATE_FLUSH_INTERVAL = float(os.getenv('STATE_FLUSH_INTERVAL', '0.5'))
+# Сессии чатов: local - один процесс, sqlite - несколько воркеров на общей базе
+SESSION_BACKEND = os.getenv('SESSION_BACKEND', 'local')
+SESSION_WAIT = float(os.getenv('SESSION_WAIT', '30'))
+SESSION_LEASE_TTL = float(os.getenv('SESSION_LEASE_TTL', '60'))
+
+# Привязка чатов к экземплярам: список адресов всех экземпляров и свой адрес
+AFFINITY_PEERS = [peer.strip().rstrip('/') for peer in os.getenv('AFFINITY_PEERS', '').split(',') if peer.strip()]
+AFFINITY_SELF = os.getenv('AFFINITY_SELF', '').rstrip('/')
+AFFINITY_HEADER = 'X-Affinity-Forwarded'
+
+# Как часто /health заново проверяет доступность Telegram (getMe), секунды
+HEALTH_CHECK_TTL = float(os.getenv('HEALTH_CHECK_TTL', '30'))
+
+# Число шардов блокировок состояния чатов
+CHAT_LOCK_SHARDS = int(os.getenv('CHAT_LOCK_SHARDS', '64'))
+
+# Бюджет промпта урока (в оценочных токенах) и частота обновления краткого содержания
+PROMPT_TOKEN_BUDGET = int(os.getenv('PROMPT_TOKEN_BUDGET', '1000'))
+SUMMARY_TOKEN_BUDGET = int(os.getenv('SUMMARY_TOKEN_BUDGET', '250'))
+PROMPT_RECENT_TURNS = int(os.getenv('PROMPT_RECENT_TURNS', '4'))
+SUMMARY_EVERY = int(os.getenv('SUMMARY_EVERY', '2'))
+
+# Заранее сгенерированные первые шаги уроков (python lesson_openers.py)
+LESSON_OPENERS_PATH = os.getenv(
+    'LESSON_OPENERS_PATH',
+    os.path.join(os.path.dirname(os.path.abspath(__file__)), 'lesson_openers.json')
+)
+LESSON_OPENER_VARIANTS = int(os.getenv('LESSON_OPENER_VARIANTS', '3'))
+PREGENERATE_OPENERS = os.getenv('PREGENERATE_OPENERS', '0') == '1'
+
+# Каталог курсов и уроков
+COURSES_PATH = os.getenv(
+    'COURSES_PATH',
+    os.path.join(os.path.dirname(os.path.abspath(__file__)), 'courses.json')
+)
 
 TELEGRAM_TOKEN = os.getenv('TELEGRAM_TOKEN')
+TELEGRAM_API_URL = os.getenv('TELEGRAM_API_URL', 'https://api.telegram.org')
 TON_WALLET = os.getenv('TON_WALLET', 'UQAVTMHfwYcMn7ttJNXiJVaoA-jjRTeJHc2sjpkAVzc84oSY')
+# Оплата премиума: входящие переводы читаются из индексатора TON (toncenter API v3)
+TON_INDEXER_URL = os.getenv('TON_INDEXER_URL', '')
+TON_INDEXER_API_KEY = os.getenv('TON_INDEXER_API_KEY')
+TON_POLL_INTERVAL = float(os.getenv('TON_POLL_INTERVAL', '30'))
+TON_PAGE_SIZE = int(os.getenv('TON_PAGE_SIZE', '100'))
+PREMIUM_PRICE_TON = float(os.getenv('PREMIUM_PRICE_TON', '10'))
+PREMIUM_DAYS = int(os.getenv('PREMIUM_DAYS', '30'))
+DEVELOPMENT_FUND_SHARE = float(os.getenv('DEVELOPMENT_FUND_SHARE', '0.5'))
+
+# Режим вебхука: при ASYNC_WEBHOOK=1 обновления обрабатываются в пуле воркеров
+ASYNC_WEBHOOK = os.getenv('ASYNC_WEBHOOK', '0') == '1'
+UPDATE_WORKERS = int(os.getenv('UPDATE_WORKERS', '8'))
+UPDATE_QUEUE_SIZE = int(os.getenv('UPDATE_QUEUE_SIZE', '1000'))
+UPDATE_DRAIN_TIMEOUT = float(os.getenv('UPDATE_DRAIN_TIMEOUT', '10'))
+
+# Окно защиты от повторной доставки одного и того же update_id
+UPDATE_DEDUP_WINDOW = float(os.getenv('UPDATE_DEDUP_WINDOW', '3600'))
+UPDATE_DEDUP_SIZE = int(os.getenv('UPDATE_DEDUP_SIZE', '100000'))
+
+# Лимиты Telegram: ~30 сообщений/сек на бота и ~1 сообщение/сек на чат
+TELEGRAM_GLOBAL_RATE = float(os.getenv('TELEGRAM_GLOBAL_RATE', '30'))
+TELEGRAM_CHAT_RATE = float(os.getenv('TELEGRAM_CHAT_RATE', '1'))
+TELEGRAM_CHAT_BURST = int(os.getenv('TELEGRAM_CHAT_BURST', '3'))
+RENDER_CACHE_SIZE = int(os.getenv('RENDER_CACHE_SIZE', '50000'))
+# Сколько чатов хранят собранные экраны курса и профиля
+SCREEN_MEMO_CHATS = int(os.getenv('SCREEN_MEMO_CHATS', '10000'))
+# Потоки для побочных действий update (answerCallbackQuery и т.п.)
+SIDE_EFFECT_WORKERS = int(os.getenv('SIDE_EFFECT_WORKERS', '4'))
+
+# Кэш ответов Gemini на типовые запросы
+RESPONSE_CACHE_TTL = float(os.getenv('RESPONSE_CACHE_TTL', '600'))
+RESPONSE_CACHE_SIZE = int(os.getenv('RESPONSE_CACHE_SIZE', '5000'))
+RESPONSE_CACHE_MAX_BYTES = int(os.getenv('RESPONSE_CACHE_MAX_BYTES', str(8 * 1024 * 1024)))
+# Кэшируем только короткие запросы - длинные почти никогда не повторяются
+RESPONSE_CACHE_MAX_PROMPT = int(os.getenv('RESPONSE_CACHE_MAX_PROMPT', '100'))
+
+# Логирование: JSON в фоновом потоке, уровни по компонентам ("llm_gateway=WARNING,app.updates=DEBUG"),
+# повторяющиеся ошибки - не больше LOG_RATE в секунду после LOG_BURST, дальше каждая LOG_SAMPLE-я
+LOG_LEVEL = os.getenv('LOG_LEVEL', 'INFO')
+LOG_LEVELS = os.getenv('LOG_LEVELS', '')
+LOG_FORMAT = os.getenv('LOG_FORMAT', 'json')
+LOG_QUEUE_SIZE = int(os.getenv('LOG_QUEUE_SIZE', '10000'))
+LOG_RATE = float(os.getenv('LOG_RATE', '1'))
+LOG_BURST = int(os.getenv('LOG_BURST', '10'))
+LOG_SAMPLE = int(os.getenv('LOG_SAMPLE', '100'))
+LOG_MAX_MESSAGE = int(os.getenv('LOG_MAX_MESSAGE', '2000'))
+# Update дольше этого (секунды) пишется в лог app.updates как медленный
+SLOW_UPDATE_SECONDS = float(os.getenv('SLOW_UPDATE_SECONDS', '10'))
+
+# 📝 ЛОГИ НЕ ПИШУТСЯ ИЗ ПОТОКА ЗАПРОСА - ТОЛЬКО ОЧЕРЕДЬ
+log_pipeline = setup_logging(
+    level=LOG_LEVEL, levels=LOG_LEVELS, fmt=LOG_FORMAT, queue_size=LOG_QUEUE_SIZE,
+    rate=LOG_RATE, burst=LOG_BURST, sample=LOG_SAMPLE, max_message=LOG_MAX_MESSAGE
+)
+# Зарегистрирован первым - значит останавливается последним и допишет логи остальных
+atexit.register(log_pipeline.stop)
+log = logging.getLogger("app")
+update_log = logging.getLogger("app.updates")
+
+# 📈 МЕТРИКИ ДЛЯ /metrics (формат Prometheus, без блокировок на горячем пути)
+metrics = MetricsRegistry()
+telegram_latency = metrics.histogram("neuro_telegram_request_seconds", "Время вызова Bot API", ("method",))
+telegram_responses = metrics.counter("neuro_telegram_responses_total", "Ответы Bot API по HTTP-статусу", ("method", "status"))
+llm_latency = metrics.histogram("neuro_llm_request_seconds", "Время generate_content", ("mode", "outcome"))
+llm_prompt_tokens = metrics.histogram("neuro_llm_prompt_tokens", "Оценка токенов промпта", buckets=TOKEN_BUCKETS)
+llm_output_tokens = metrics.histogram("neuro_llm_output_tokens", "Оценка токенов ответа", buckets=TOKEN_BUCKETS)
+callback_latency = metrics.histogram("neuro_callback_seconds", "Обработка callback-кнопки", ("route",))
+callback_errors = metrics.counter("neuro_callback_errors_total", "Ошибки обработчиков кнопок", ("route",))
+update_latency = metrics.histogram("neuro_update_seconds", "Критический путь update по видам", ("kind",))
+edit_fallbacks = metrics.counter("neuro_edit_fallbacks_total", "Правка не удалась, отправлено новое сообщение")
+reply_fallbacks = metrics.counter("neuro_fallback_replies_total", "Заготовленные ответы вместо ответа модели", ("mode",))
+
+def observe_telegram(method, status, elapsed):
+    telegram_latency.observe(elapsed, method)
+    telegram_responses.inc(method, str(status))
+
+def observe_llm(mode, outcome, elapsed, prompt, text):
+    llm_latency.observe(elapsed, mode, outcome)
+    admission.observe(elapsed)
+    llm_prompt_tokens.observe(estimate_tokens(prompt))
+    if outcome == "ok":
+        llm_output_tokens.observe(estimate_tokens(text))
+
+def observe_callback(route, elapsed, failed):
+    callback_latency.observe(elapsed, route)
+    if failed:
+        callback_errors.inc(route)
+
+def observe_update(kind, elapsed):
+    update_latency.observe(elapsed, kind)
+    if elapsed >= SLOW_UPDATE_SECONDS:
+        update_log.warning("Slow update: %s", kind, extra={"kind": kind, "latency_ms": round(elapsed * 1000, 1)})
+    elif update_log.isEnabledFor(logging.DEBUG):
+        update_log.debug("Update done: %s", kind, extra={"kind": kind, "latency_ms": round(elapsed * 1000, 1)})
+
+# Общий клиент Bot API с пулом keep-alive соединений
+telegram = TelegramClient(TELEGRAM_TOKEN, base_url=TELEGRAM_API_URL, observer=observe_telegram)
+
+# Все отправки и правки сообщений идут через планировщик с лимитами
+outbound = OutboundScheduler(
+    telegram,
+    global_rate=TELEGRAM_GLOBAL_RATE,
+    chat_rate=TELEGRAM_CHAT_RATE,
+    chat_burst=TELEGRAM_CHAT_BURST
+)
+atexit.register(outbound.close)
+
+# Независимые действия update идут параллельно с генерацией ответа
+update_pipeline = UpdatePipeline(workers=SIDE_EFFECT_WORKERS, observer=observe_update)
+atexit.register(update_pipeline.close)
+
+# Последнее отрисованное содержимое главного сообщения каждого чата
+render_cache = RenderCache(max_chats=RENDER_CACHE_SIZE)
+
+# Собранные экраны курса и профиля по чатам (см. screens.py)
+screen_memo = ScreenMemo(max_chats=SCREEN_MEMO_CHATS)
 
 def delete_user_message(chat_id, message_id):
-    """Удаляет сообщение пользователя"""
-    try:
-        response = requests.post(
-            f"https://api.telegram.org/bot{TELEGRAM_TOKEN}/deleteMessage",
-            json={
-                "chat_id": chat_id,
-                "message_id": message_id
-            }
-        )
-        return response.json()
-    except Exception as e:
-        logging.error(f"Error deleting message: {e}")
-        return None
+    """Удаляет сообщение пользователя (фоновая операция, ответ не ждем)"""
+    return update_pipeline.track(outbound.submit(
+        "deleteMessage",
+        {"chat_id": chat_id, "message_id": message_id},
+        chat_id=chat_id,
+        priority=BACKGROUND
+    ))
 
-# 🌌 ОБНОВЛЕННАЯ БАЗА ЗНАНИЙ С NEUROTEACHER
-COURSES = {
-    "🧠 NeuroTeacher": {
-        "уроки": [
-            "🌌 Первый контакт: основы взаимодействия с AI",
-            "⚡ Когнитивное ускорение: 10x продуктивности", 
-            "🔮 Стратегическое видение: анализ трендов",
-            "💫 Симбиоз: ваша роль в эпоху AI",
-            "🎯 Инициация в новые возможности",
-            "🧠 Апгрейд мышления: модели гениев",
-            "🚀 Экспоненциальный рост компетенций", 
-            "🔧 Бесшовная интеграция AI в жизнь",
-            "🌍 Позиционирование в новой реальности"
-        ],
-        "уровень": "🎯 Полная трансформация мышления",
-        "описание": "От основ до продвинутых стратегий. Полный путь от новичка до творца новой реальности."
-    }
-}
+# 🌌 КАТАЛОГ КУРСОВ ИЗ courses.json (индексы по id уроков и курсов)
+catalog = Catalog.load(COURSES_PATH)
+
+# 💾 СОСТОЯНИЕ ПОЛЬЗОВАТЕЛЕЙ ПЕРЕЖИВАЕТ РЕДЕПЛОЙ (SQLite, отложенная запись)
+state_store = StateStore(STATE_DB_PATH or None, flush_interval=STATE_FLUSH_INTERVAL)
+atexit.register(state_store.close)
+
+# 🧩 ОДИН ЧАТ ОДНОВРЕМЕННО ОБРАБАТЫВАЕТ ТОЛЬКО ОДИН ВОРКЕР
+sessions = create_sessions(
+    SESSION_BACKEND, state_store, STATE_DB_PATH,
+    wait=SESSION_WAIT, ttl=SESSION_LEASE_TTL, on_migrate=[render_cache.forget, screen_memo.forget]
+)
+atexit.register(sessions.close)
 
-USER_PROGRESS = {}
-USER_MESSAGE_IDS = {}
-USER_LESSON_STATE = {}
+# 🔒 СОСТОЯНИЕ ЧАТА МЕНЯЕТСЯ ТОЛЬКО ПОД БЛОКИРОВКОЙ ЕГО ШАРДА
+chat_locks = ShardedLocks(CHAT_LOCK_SHARDS)
+
+USER_PROGRESS = state_store.map("progress", lock=chat_locks)
+USER_MESSAGE_IDS = state_store.map("message_id", lock=chat_locks)
+USER_LESSON_STATE = state_store.map("lesson", encode_lesson_state, decode_lesson_state, lock=chat_locks)
 # ИЗМЕНЕНИЕ: Упрощаем структуру сохраненного прогресса
-USER_SAVED_PROGRESS = {}
-
-# 🚀 ОБНОВЛЕННАЯ ФИНАНСОВАЯ СИСТЕМА
-DEVELOPMENT_FUND = {
-    "total_income": 0,
-    "development_fund": 0,
-    "marketing_budget": 0,
-    "transactions": []
-}
+USER_SAVED_PROGRESS = state_store.map("saved_lesson", encode_lesson_state, decode_lesson_state, lock=chat_locks)
+# Текущий режим каждого чата (меню, урок, NeuroPartner)
+USER_CHAT_MODES = ChatModes(state_store.map("chat_mode"))
+
+# УЖЕ ПРИНЯТЫЕ update_id - ПОВТОРЫ TELEGRAM НЕ ОБРАБАТЫВАЮТСЯ ВТОРОЙ РАЗ
+update_dedup = UpdateDeduplicator(window=UPDATE_DEDUP_WINDOW, max_entries=UPDATE_DEDUP_SIZE,
+                                  path=STATE_DB_PATH or None)
+atexit.register(update_dedup.close)
+
+# 🚀 ФИНАНСЫ: ЖУРНАЛ ПЛАТЕЖЕЙ TON, ИТОГИ И ПРЕМИУМ ЧИТАЮТСЯ ИЗ ПАМЯТИ
+ledger = PaymentLedger(
+    STATE_DB_PATH or None,
+    price=to_nano(PREMIUM_PRICE_TON),
+    period=PREMIUM_DAYS * 86400,
+    fund_share=DEVELOPMENT_FUND_SHARE
+)
+atexit.register(ledger.close)
+
+if LLM_BACKEND == 'fake':
+    llm_backend = FakeLLMBackend(
+        latency=FAKE_LLM_LATENCY,
+        jitter=FAKE_LLM_JITTER,
+        failure_rate=FAKE_LLM_FAILURE_RATE,
+        seed=FAKE_LLM_SEED,
+        distribution=FAKE_LLM_DISTRIBUTION
+    )
+else:
+    llm_backend = GeminiBackend(GEMINI_API_KEY, GEMINI_MODEL)
+
+# 🚦 ДОПУСК К LLM: КВОТЫ КЛАССОВ, ОДИН ЗАПРОС НА ЧАТ, АДАПТИВНЫЙ ЛИМИТ
+admission = AdmissionController(
+    priority=("lesson", "neuropartner"),
+    limit=LLM_MAX_CONCURRENCY,
+    min_limit=ADMISSION_MIN_LIMIT,
+    shares={"neuropartner": ADMISSION_PARTNER_SHARE},
+    max_wait={"lesson": ADMISSION_LESSON_WAIT, "neuropartner": ADMISSION_PARTNER_WAIT},
+    max_queue=ADMISSION_MAX_QUEUE,
+    target_latency=ADMISSION_TARGET_LATENCY
+)
+
+llm_gateway = LLMGateway(
+    llm_backend,
+    max_concurrency=LLM_MAX_CONCURRENCY,
+    deadline=LLM_DEADLINE,
+    hedge=LLM_HEDGE,
+    breaker=CircuitBreaker(LLM_BREAKER_FAILURES, LLM_BREAKER_RESET),
+    observer=observe_llm
+)
+
+response_cache = ResponseCache(
+    ttl=RESPONSE_CACHE_TTL,
+    max_entries=RESPONSE_CACHE_SIZE,
+    max_bytes=RESPONSE_CACHE_MAX_BYTES
+)
+
+def cacheable_prompt(text):
+    """Нормализованный запрос или None, если его нет смысла кэшировать"""
+    normalized = normalize_prompt(text)
+    if len(normalized) > RESPONSE_CACHE_MAX_PROMPT:
+        return None
+    return normalized
 
 # 🎯 УЛУЧШЕННЫЙ ДИАЛОГОВЫЙ AI-ПРЕПОДАВАТЕЛЬ (GEMINI)
 class DialogAITeacher:
@@ -74,60 +337,54 @@ class DialogAITeacher:
             "практика": "🔧",
             "обратная связь": "💫"
         }
-        # Настройка модели Gemini
-        self.model = genai.GenerativeModel('gemini-2.0-flash-exp')
+        # Промпт урока: статический префикс + краткое содержание + последние реплики
+        self.context_builder = LessonContextBuilder(
+            token_budget=PROMPT_TOKEN_BUDGET,
+            summary_budget=SUMMARY_TOKEN_BUDGET,
+            recent_turns=PROMPT_RECENT_TURNS,
+            summary_every=SUMMARY_EVERY,
+            capacity=CONVERSATION_CAPACITY
+        )
 
-    def generate_lesson_step(self, lesson_topic, user_level, conversation_history, current_step):
+    def generate_lesson_step(self, lesson_topic, user_level, conversation_history, current_step, on_partial=None,
+                             summary=None, summary_upto=0):
         """Генерирует следующий шаг урока используя Gemini"""
         
-        system_prompt = f"""
-        Ты - опытный AI-преподаватель NeuroTeacher. Веди естественный диалог с учеником.
-        
-        Тема урока: {lesson_topic}
-        Уровень ученика: {user_level}/5
-        
-        История диалога:
-        {self._format_conversation_history(conversation_history)}
-        
-        Важные правила:
-        1. Будь естественным и вовлекающим
-        2. Адаптируй объяснения под уровень понимания
-        3. Задавай открытые вопросы
-        4. Будь немного креативным в подаче
-        5. Не будь слишком формальным
-        6. Отвечай на русском языке
-        7. Будь кратким, но информативным (максимум 3-4 предложения)
-        
-        Продолжи урок естественным образом:
-        """
+        system_prompt, _ = self.context_builder.build(
+            lesson_topic, user_level, conversation_history, summary, summary_upto
+        )
         
         try:
-            response = self.model.generate_content(
-                system_prompt,
-                generation_config=genai.types.GenerationConfig(
-                    max_output_tokens=500,
-                    temperature=0.8
-                )
-            )
-            return response.text
+            cache_key = self._opening_cache_key(lesson_topic, user_level, conversation_history, current_step)
+            if cache_key:
+                return response_cache.get_or_compute(cache_key, lambda: self._generate(system_prompt, on_partial))
+            return self._generate(system_prompt, on_partial)
         except Exception as e:
-            logging.error(f"Gemini API error: {e}")
+            log.error("Gemini API error: %s", e)
+            reply_fallbacks.inc("lesson")
             return "🧠 Давайте продолжим наш урок! Расскажите, что вам было наиболее интересно в предыдущей части?"
 
-    def _format_conversation_history(self, history):
-        if not history:
-            return "Диалог только начинается"
-        
-        formatted = []
-        for msg in history[-4:]:  # Берем последние 4 сообщения
-            role = "Ученик" if msg["role"] == "student" else "Учитель"
-            formatted.append(f"{role}: {msg['content']}")
-        
-        return "\n".join(formatted)
+    def _generate(self, system_prompt, on_partial=None):
+        if on_partial is not None:
+            return llm_gateway.generate_stream(system_prompt, on_partial, max_output_tokens=500, temperature=0.8)
+        return llm_gateway.generate(system_prompt, max_output_tokens=500, temperature=0.8)
 
-    def create_progress_tracker(self, completed_lessons, total_lessons=9):
-        progress_percent = (completed_lessons / total_lessons) * 100
-        progress_bar = "🟩" * completed_lessons + "⬜" * (total_lessons - completed_lessons)
+    def _opening_cache_key(self, lesson_topic, user_level, conversation_history, current_step):
+        """Ключ кэша для первого шага урока (ответ зависит только от темы, уровня и реплики)"""
+        if current_step != 0 or len(conversation_history) > 1:
+            return None
+        student_text = conversation_history.recent(1)[0].content if len(conversation_history) else ""
+        normalized = cacheable_prompt(student_text)
+        if normalized is None:
+            return None
+        return ("lesson", lesson_topic, user_level, normalized)
+
+    def create_progress_tracker(self, completed_lessons, total_lessons):
+        progress_percent = (completed_lessons / total_lessons) * 100 if total_lessons else 0
+        # Для длинных курсов полоса масштабируется до 10 клеток
+        cells = min(total_lessons, 10)
+        filled = round(completed_lessons * cells / total_lessons) if total_lessons else 0
+        progress_bar = "🟩" * filled + "⬜" * (cells - filled)
         
         achievements = []
         if completed_lessons >= 1:
@@ -136,7 +393,7 @@ class DialogAITeacher:
             achievements.append("🚀 Практик") 
         if completed_lessons >= 6:
             achievements.append("💫 Продвинутый")
-        if completed_lessons >= 9:
+        if total_lessons and completed_lessons >= total_lessons:
             achievements.append("🏆 Мастер")
             
         return {
@@ -149,65 +406,135 @@ class DialogAITeacher:
 # Инициализация преподавателя
 dialog_teacher = DialogAITeacher()
 
+# ГОТОВЫЕ ПЕРВЫЕ ШАГИ УРОКОВ ДЛЯ ВСЕХ УРОВНЕЙ
+lesson_openers = LessonOpeners(LESSON_OPENERS_PATH, variants=LESSON_OPENER_VARIANTS)
+
+def build_lesson_openers():
+    """Догенерирует первые шаги для всех уроков и уровней (только изменившиеся)"""
+    lessons = [lesson.title for lesson in catalog.iter_lessons()]
+    return lesson_openers.build(
+        lessons,
+        lambda topic, level: dialog_teacher.context_builder.build(topic, level, Conversation())[0],
+        lambda prompt: llm_gateway.generate(prompt, max_output_tokens=500, temperature=0.9)
+    )
+
+if PREGENERATE_OPENERS:
+    threading.Thread(target=build_lesson_openers, name="openers-build", daemon=True).start()
+
 # ПРОСТЫЕ И ЭФФЕКТИВНЫЕ ФУНКЦИИ СОХРАНЕНИЯ ПРОГРЕССА
 def save_lesson_progress(chat_id):
     """Сохраняет текущий прогресс урока"""
-    if chat_id in USER_LESSON_STATE:
-        USER_SAVED_PROGRESS[chat_id] = USER_LESSON_STATE[chat_id].copy()
-        logging.info(f"Прогресс сохранен для {chat_id}: {USER_SAVED_PROGRESS[chat_id]['current_lesson']}")
+    with chat_locks(chat_id):
+        if chat_id in USER_LESSON_STATE:
+            USER_SAVED_PROGRESS[chat_id] = snapshot_lesson_state(USER_LESSON_STATE[chat_id])
+            log.info("Прогресс сохранен для %s: %s", chat_id, USER_SAVED_PROGRESS[chat_id]['current_lesson'])
 
 def restore_lesson_progress(chat_id):
     """Восстанавливает прогресс урока если есть сохраненный"""
-    if chat_id in USER_SAVED_PROGRESS:
-        USER_LESSON_STATE[chat_id] = USER_SAVED_PROGRESS[chat_id].copy()
-        logging.info(f"Прогресс восстановлен для {chat_id}: {USER_LESSON_STATE[chat_id]['current_lesson']}")
-        return True
-    return False
-
-def generate_ton_payment_link(chat_id, amount=10):
-    return f"https://app.tonkeeper.com/transfer/UQAVTMHfwYcMn7ttJNXiJVaoA-jjRTeJHc2sjpkAVzc84oSY?amount={amount*1000000000}&text=premium_{chat_id}"
-
-def update_user_progress(chat_id, lesson_name):
-    if chat_id not in USER_PROGRESS:
-        USER_PROGRESS[chat_id] = {"пройденные_уроки": [], "уровень": 1, "баллы": 0}
-    
-    if lesson_name not in USER_PROGRESS[chat_id]["пройденные_уроки"]:
-        USER_PROGRESS[chat_id]["пройденные_уроки"].append(lesson_name)
-        USER_PROGRESS[chat_id]["баллы"] += 10
+    with chat_locks(chat_id):
+        if chat_id in USER_SAVED_PROGRESS:
+            USER_LESSON_STATE[chat_id] = snapshot_lesson_state(USER_SAVED_PROGRESS[chat_id])
+            log.info("Прогресс восстановлен для %s: %s", chat_id, USER_LESSON_STATE[chat_id]['current_lesson'])
+            return True
+        return False
+
+def leave_lesson(chat_id):
+    """Сохраняет прогресс и выходит из урока, чтобы он не перехватывал сообщения"""
+    with chat_locks(chat_id):
+        if chat_id in USER_LESSON_STATE:
+            save_lesson_progress(chat_id)
+            del USER_LESSON_STATE[chat_id]
+
+def generate_ton_payment_link(chat_id, amount=PREMIUM_PRICE_TON):
+    # Комментарий premium_<chat_id> связывает перевод с пользователем
+    return f"https://app.tonkeeper.com/transfer/{TON_WALLET}?amount={to_nano(amount)}&text={payment_comment(chat_id)}"
+
+def format_date(timestamp):
+    return time.strftime('%d.%m.%Y', time.localtime(timestamp))
+
+def new_user_progress():
+    # "курсы": {id курса: битовая маска пройденных уроков}
+    return {"курсы": {}, "пройдено": 0, "уровень": 1, "баллы": 0}
+
+def get_user_progress(chat_id):
+    """Прогресс пользователя; старый формат со списком уроков переводится в битовые маски"""
+    with chat_locks(chat_id):
+        progress = USER_PROGRESS.get(chat_id)
+        if progress is None:
+            return new_user_progress()
+        if "пройденные_уроки" in progress:
+            courses = catalog.progress_bits(progress.pop("пройденные_уроки"))
+            progress["курсы"] = courses
+            progress["пройдено"] = sum(popcount(bits) for bits in courses.values())
+            USER_PROGRESS.touch(chat_id)
+        return progress
+
+def course_bits(progress, course):
+    return progress["курсы"].get(str(course.id), 0)
+
+def update_user_progress(chat_id, lesson_id):
+    lesson = catalog.lesson(lesson_id)
+    if lesson is None:
+        return
+    with chat_locks(chat_id):
+        if chat_id not in USER_PROGRESS:
+            USER_PROGRESS[chat_id] = new_user_progress()
+        progress = get_user_progress(chat_id)
         
-        if len(USER_PROGRESS[chat_id]["пройденные_уроки"]) % 2 == 0:
-            USER_PROGRESS[chat_id]["уровень"] += 1
+        bits = course_bits(progress, lesson.course)
+        if not bits & lesson.bit:
+            progress["курсы"][str(lesson.course.id)] = bits | lesson.bit
+            progress["пройдено"] += 1
+            progress["баллы"] += 10
+            
+            if progress["пройдено"] % 2 == 0:
+                progress["уровень"] += 1
+            
+            USER_PROGRESS.touch(chat_id)
+            # Экраны курса и профиля показывали старый прогресс
+            screen_memo.forget(chat_id)
+
+def new_lesson_state(lesson):
+    return {
+        "current_lesson": lesson.title,
+        "lesson_id": lesson.id,
+        "step": 0,
+        "conversation": Conversation()
+    }
 
 def update_lesson_state(chat_id, lesson_name, step=0, user_message=None):
-    if chat_id not in USER_LESSON_STATE:
-        USER_LESSON_STATE[chat_id] = {
-            "current_lesson": lesson_name,
-            "step": step,
-            "conversation": []
-        }
-    
-    if user_message:
-        USER_LESSON_STATE[chat_id]["conversation"].append({
-            "role": "student", 
-            "content": user_message
-        })
-    
-    USER_LESSON_STATE[chat_id]["step"] = step
+    with chat_locks(chat_id):
+        if chat_id not in USER_LESSON_STATE:
+            USER_LESSON_STATE[chat_id] = {
+                "current_lesson": lesson_name,
+                "step": step,
+                "conversation": Conversation()
+            }
+        
+        if user_message:
+            USER_LESSON_STATE[chat_id]["conversation"].append(ROLE_STUDENT, user_message)
+        
+        USER_LESSON_STATE[chat_id]["step"] = step
+        USER_LESSON_STATE.touch(chat_id)
 
 def add_teacher_response(chat_id, teacher_message):
-    if chat_id in USER_LESSON_STATE:
-        USER_LESSON_STATE[chat_id]["conversation"].append({
-            "role": "teacher",
-            "content": teacher_message
-        })
+    with chat_locks(chat_id):
+        if chat_id in USER_LESSON_STATE:
+            USER_LESSON_STATE[chat_id]["conversation"].append(ROLE_TEACHER, teacher_message)
+            USER_LESSON_STATE.touch(chat_id)
 
 # 🎯 ОБНОВЛЕННАЯ СИСТЕМА МЕНЮ С NEUROPARTNER
 class MenuManager:
     def get_main_menu(self):
+        # С одним курсом сразу открываем его, с несколькими - список курсов
+        if len(catalog) == 1:
+            courses_callback = course_callback(catalog.courses[0].id)
+        else:
+            courses_callback = catalog_callback()
         keyboard = {
             "inline_keyboard": [
                 [
-                    {"text": "🧠 NeuroTeacher", "callback_data": "menu_course_🧠 NeuroTeacher"},
+                    {"text": "🧠 NeuroTeacher", "callback_data": courses_callback},
                     {"text": "💫 NeuroPartner", "callback_data": "menu_neuropartner"}
                 ],
                 [
@@ -225,26 +552,55 @@ class MenuManager:
         
         return {"text": text, "keyboard": keyboard}
     
-    def get_enhanced_course_menu(self, course_name, user_id):
+    def get_catalog_menu(self, page=0):
+        """Список курсов постранично"""
+        page, courses = page_slice(catalog.courses, page, COURSES_PER_PAGE)
+        course_buttons = [
+            [{"text": course.name, "callback_data": course_callback(course.id)}]
+            for course in courses
+        ]
+        nav_row = self._page_row(page, catalog.course_pages(), catalog_callback)
+        if nav_row:
+            course_buttons.append(nav_row)
+        course_buttons.append([{"text": "🔙 Назад к меню", "callback_data": "menu_main"}])
+        
+        text = """🧠 *NeuroTeacher*
+
+💫 *Выберите курс:*"""
+        
+        return {"text": text, "keyboard": {"inline_keyboard": course_buttons}}
+    
+    def _page_row(self, page, pages, page_callback):
+        """Кнопки листания страниц (пустой список, если страница одна)"""
+        if pages <= 1:
+            return []
+        row = []
+        if page > 0:
+            row.append({"text": "◀️", "callback_data": page_callback(page - 1)})
+        row.append({"text": f"{page + 1}/{pages}", "callback_data": page_callback(page)})
+        if page < pages - 1:
+            row.append({"text": "▶️", "callback_data": page_callback(page + 1)})
+        return row
+    
+    def get_enhanced_course_menu(self, course, user_id, page=0):
         # Проверяем, существует ли курс
-        if course_name not in COURSES:
+        if course is None:
             return {
                 "text": "❌ Курс не найден",
                 "keyboard": self.get_main_menu()["keyboard"]
             }
         
-        course_info = COURSES[course_name]
-        progress = USER_PROGRESS.get(user_id, {"пройденные_уроки": [], "уровень": 1, "баллы": 0})
+        progress = get_user_progress(user_id)
+        bits = course_bits(progress, course)
         
-        progress_data = dialog_teacher.create_progress_tracker(
-            len(progress['пройденные_уроки'])
-        )
+        progress_data = dialog_teacher.create_progress_tracker(popcount(bits), len(course.lessons))
         
+        page, lessons = page_slice(course.lessons, page, LESSONS_PER_PAGE)
         lesson_buttons = []
-        for i, lesson in enumerate(course_info['уроки']):
-            status = "✅" if lesson in progress['пройденные_уроки'] else "📖"
+        for lesson in lessons:
+            status = "✅" if bits & lesson.bit else "📖"
             lesson_buttons.append([
-                {"text": f"{status} Урок {i+1}: {lesson}", "callback_data": f"start_lesson_{course_name}_{i}"}
+                {"text": f"{status} Урок {lesson.index + 1}: {lesson.title}", "callback_data": lesson_callback(lesson.id)}
             ])
         
         progress_row = [{"text": f"📊 Прогресс: {progress_data['progress_bar']}", "callback_data": "show_progress"}]
@@ -254,13 +610,17 @@ class MenuManager:
             achievement_row = [{"text": f"🏆 {progress_data['achievements'][-1]}", "callback_data": "show_achievements"}]
             lesson_buttons.insert(1, achievement_row)
         
+        nav_row = self._page_row(page, course.pages(), lambda p: course_callback(course.id, p))
+        if nav_row:
+            lesson_buttons.append(nav_row)
+        
         lesson_buttons.append([{"text": "🔙 Назад к меню", "callback_data": "menu_main"}])
         
         keyboard = {"inline_keyboard": lesson_buttons}
         
-        text = f"""*{course_name}*
+        text = f"""*{course.name}*
 
-{course_info['описание']}
+{course.description}
 
 🤖 *Ваш прогресс:* {progress_data['completed']}/{progress_data['total']} уроков
 {progress_data['progress_bar']}
@@ -285,17 +645,20 @@ class MenuManager:
         
         return {"text": text, "keyboard": keyboard}
     
-    def get_premium_menu(self):
-        payment_link = generate_ton_payment_link("premium_user")
+    def get_premium_menu(self, chat_id):
+        payment_link = generate_ton_payment_link(chat_id)
+        premium_until = ledger.premium_until(chat_id)
         
         keyboard = {
             "inline_keyboard": [
-                [{"text": "💳 Активировать полный доступ", "url": payment_link}],
+                [{"text": "💳 Продлить доступ" if premium_until else "💳 Активировать полный доступ", "url": payment_link}],
                 [{"text": "🔙 Назад к меню", "callback_data": "menu_main"}]
             ]
         }
         
-        text = """💰 *ПРЕМИУМ ДОСТУП*
+        status = f"\n\n✅ *Премиум активен до {format_date(premium_until)}*" if premium_until else ""
+        
+        text = f"""💰 *ПРЕМИУМ ДОСТУП*
 
 Откройте полный потенциал NeuroTeacher:
 
@@ -304,12 +667,12 @@ class MenuManager:
 📊 Детальная аналитика прогресса
 🔮 Эксклюзивные материалы
 
-⚡ *Инвестиция в развитие: 10 TON/месяц*"""
+⚡ *Инвестиция в развитие: {format_ton(to_nano(PREMIUM_PRICE_TON))} TON/месяц*{status}"""
         
         return {"text": text, "keyboard": keyboard}
     
     def get_profile_menu(self, chat_id):
-        progress = USER_PROGRESS.get(chat_id, {"пройденные_уроки": [], "уровень": 1, "баллы": 0})
+        progress = get_user_progress(chat_id)
         
         keyboard = {
             "inline_keyboard": [
@@ -317,34 +680,57 @@ class MenuManager:
             ]
         }
         
+        totals = ledger.totals()
+        premium_until = ledger.premium_until(chat_id)
+        premium = f"до {format_date(premium_until)}" if premium_until else "не активен"
+        
         text = f"""👤 *ВАШ ПРОФИЛЬ*
 
 📊 Уровень: {progress['уровень']}
 🎯 Баллы: {progress['баллы']}
-📚 Пройдено уроков: {len(progress['пройденные_уроки'])}
+📚 Пройдено уроков: {progress['пройдено']}
+💰 Премиум: {premium}
 
 🌍 *ФОНД РАЗВИТИЯ*
-💫 Собрано в фонд: {DEVELOPMENT_FUND['development_fund']} TON
-🚀 Всего доходов: {DEVELOPMENT_FUND['total_income']} TON
+💫 Собрано в фонд: {format_ton(totals['development_fund'])} TON
+🚀 Всего доходов: {format_ton(totals['total_income'])} TON
 
 💫 *Продолжаем обучение!*"""
         
         return {"text": text, "keyboard": keyboard}
     
-    def get_dialog_lesson(self, chat_id, lesson_topic, user_input=None):
-        user_level = USER_PROGRESS.get(chat_id, {}).get('уровень', 1)
-        lesson_state = USER_LESSON_STATE.get(chat_id, {})
+    def get_dialog_lesson(self, chat_id, lesson_topic, user_input=None, on_partial=None):
+        # Читаем состояние под блокировкой чата, а Gemini вызываем уже без нее
+        with chat_locks(chat_id):
+            user_level = USER_PROGRESS.get(chat_id, {}).get('уровень', 1)
+            lesson_state = USER_LESSON_STATE.get(chat_id, {})
+            
+            # Старые реплики сворачиваются в краткое содержание (раз в несколько шагов)
+            if lesson_state:
+                dialog_teacher.context_builder.refresh_summary(lesson_state)
+            
+            # Снимок истории (copy-on-write) - параллельные реплики его не меняют
+            conversation_history = lesson_state["conversation"].snapshot() if lesson_state else Conversation()
+            current_step = lesson_state.get("step", 0)
+            summary = lesson_state.get("summary")
+            summary_upto = lesson_state.get("summary_upto", 0)
         
-        conversation_history = lesson_state.get("conversation", [])
-        current_step = lesson_state.get("step", 0)
+        # ПЕРВЫЙ ШАГ УРОКА - ГОТОВЫЙ ВАРИАНТ ИЗ ПАМЯТИ, БЕЗ GEMINI
+        teacher_response = None
+        if current_step == 0:
+            teacher_response = lesson_openers.pick(lesson_topic, user_level)
         
         # Генерируем следующий шаг урока через Gemini
-        teacher_response = dialog_teacher.generate_lesson_step(
-            lesson_topic, 
-            user_level, 
-            conversation_history, 
-            current_step
-        )
+        if teacher_response is None:
+            teacher_response = dialog_teacher.generate_lesson_step(
+                lesson_topic, 
+                user_level, 
+                conversation_history, 
+                current_step,
+                on_partial,
+                summary,
+                summary_upto
+            )
         
         # Добавляем ответ учителя в историю
         add_teacher_response(chat_id, teacher_response)
@@ -365,12 +751,23 @@ class MenuManager:
         
         return {"text": text, "keyboard": keyboard}
     
-    def get_neuropartner_response(self, chat_id, user_message):
+    def get_neuropartner_response(self, chat_id, user_message, on_partial=None):
         """Генерирует ответ NeuroPartner на сообщение пользователя"""
         try:
-            model = genai.GenerativeModel('gemini-2.0-flash-exp')
-            
-            system_prompt = f"""
+            normalized = cacheable_prompt(user_message)
+            if normalized is not None:
+                return response_cache.get_or_compute(
+                    ("neuropartner", normalized),
+                    lambda: self._generate_neuropartner_response(user_message, on_partial)
+                )
+            return self._generate_neuropartner_response(user_message, on_partial)
+        except Exception as e:
+            log.error("NeuroPartner error: %s", e)
+            reply_fallbacks.inc("neuropartner")
+            return "🌌 Извините, возникла техническая ошибка. Пожалуйста, попробуйте еще раз."
+    
+    def _generate_neuropartner_response(self, user_message, on_partial=None):
+        system_prompt = f"""
             Ты - NeuroPartner, дружелюбный AI-помощник. Отвечай на русском языке.
             
             Сообщение пользователя: {user_message}
@@ -382,76 +779,171 @@ class MenuManager:
             - Не будь слишком формальным
             - Максимум 3-4 предложения в ответе
             """
-            
-            response = model.generate_content(
-                system_prompt,
-                generation_config=genai.types.GenerationConfig(
-                    max_output_tokens=300,
-                    temperature=0.7
-                )
-            )
-            
-            return response.text
-        except Exception as e:
-            logging.error(f"NeuroPartner error: {e}")
-            return "🌌 Извините, возникла техническая ошибка. Пожалуйста, попробуйте еще раз."
+        
+        if on_partial is not None:
+            return llm_gateway.generate_stream(system_prompt, on_partial, max_output_tokens=300, temperature=0.7)
+        return llm_gateway.generate(system_prompt, max_output_tokens=300, temperature=0.7)
 
 # Инициализация менеджера
 menu_manager = MenuManager()
 
+# 🧱 ЭКРАНЫ БЕЗ ДАННЫХ ПОЛЬЗОВАТЕЛЯ СОБИРАЮТСЯ ОДИН РАЗ - ГОТОВЫЙ JSON ДЛЯ ОТПРАВКИ
+def compile_screen(menu_data):
+    return Screen(menu_data['text'], menu_data['keyboard'])
+
+MAIN_SCREEN = compile_screen(menu_manager.get_main_menu())
+NEUROPARTNER_SCREEN = compile_screen(menu_manager.get_neuropartner_menu())
+CATALOG_SCREENS = [compile_screen(menu_manager.get_catalog_menu(page)) for page in range(catalog.course_pages())]
+
+# ОТВЕТ ПРИ ПЕРЕГРУЗКЕ - СРАЗУ, БЕЗ ОЖИДАНИЯ МОДЕЛИ
+SHED_SCREENS = {
+    "lesson": Screen("""⏳ *Учитель сейчас отвечает многим ученикам*
+
+Ваше сообщение не потерялось - отправьте его еще раз через минуту.""",
+                     {"inline_keyboard": [[{"text": "🔙 Назад к курсу", "callback_data": "menu_course_back"}]]}),
+    "neuropartner": Screen("""⏳ *NeuroPartner сейчас перегружен*
+
+Попробуйте написать еще раз через минуту.""",
+                           {"inline_keyboard": [[{"text": "🔙 Назад к меню", "callback_data": "menu_main"}]]})
+}
+
+def course_screen(course, chat_id, page=0):
+    """Экран курса: пересобирается, только когда меняется прогресс по курсу"""
+    if course is None:
+        return compile_screen(menu_manager.get_enhanced_course_menu(None, chat_id))
+    with chat_locks(chat_id):
+        state_key = (course_bits(get_user_progress(chat_id), course), page)
+        return screen_memo.get(
+            chat_id, ("course", course.id), state_key,
+            lambda: compile_screen(menu_manager.get_enhanced_course_menu(course, chat_id, page))
+        )
+
+def profile_screen(chat_id):
+    """Экран профиля: пересобирается при смене уровня, баллов, премиума или сумм фонда"""
+    with chat_locks(chat_id):
+        progress = get_user_progress(chat_id)
+        totals = ledger.totals()
+        state_key = (progress['уровень'], progress['баллы'], progress['пройдено'],
+                     totals['development_fund'], totals['total_income'], ledger.premium_until(chat_id))
+        return screen_memo.get(chat_id, "profile", state_key,
+                               lambda: compile_screen(menu_manager.get_profile_menu(chat_id)))
+
+def premium_screen(chat_id):
+    """Экран премиума: ссылка на оплату со своим chat_id, срок доступа"""
+    return screen_memo.get(chat_id, "premium", ledger.premium_until(chat_id),
+                           lambda: compile_screen(menu_manager.get_premium_menu(chat_id)))
+
+def create_stream_editor(chat_id, header):
+    """Колбэк для потокового показа ответа или None, если стриминг выключен"""
+    message_id = USER_MESSAGE_IDS.get(chat_id)
+    if not STREAM_REPLIES or not message_id:
+        return None
+    # Частичные правки меняют сообщение в обход кэша отрисовки
+    render_cache.forget(chat_id)
+    return ProgressiveEditor(outbound, chat_id, message_id, header, interval=STREAM_EDIT_INTERVAL)
+
 def edit_main_message(chat_id, text, keyboard, message_id=None):
     """Редактирует сообщение или отправляет новое"""
+    return show_screen(chat_id, Screen(text, keyboard), message_id)
+
+def show_screen(chat_id, screen, message_id=None):
+    """Показывает готовый экран: правкой главного сообщения или новым сообщением"""
     
     # Используем сохраненный message_id если не передан
-    if message_id is None and chat_id in USER_MESSAGE_IDS:
-        message_id = USER_MESSAGE_IDS[chat_id]
+    if message_id is None:
+        message_id = USER_MESSAGE_IDS.get(chat_id)
+    
+    digest = screen.digest
     
     # Пытаемся отредактировать существующее сообщение
     if message_id:
-        try:
-            response = requests.post(
-                f"https://api.telegram.org/bot{TELEGRAM_TOKEN}/editMessageText",
-                json={
-                    "chat_id": chat_id,
-                    "message_id": message_id,
-                    "text": text,
-                    "reply_markup": keyboard,
-                    "parse_mode": "Markdown"
-                },
-                timeout=10
-            )
-            result = response.json()
-            if result.get('ok'):
-                return result
-        except Exception as e:
-            logging.error(f"Error editing message {message_id}: {e}")
+        # ТО ЖЕ САМОЕ УЖЕ НА ЭКРАНЕ - НИЧЕГО НЕ ОТПРАВЛЯЕМ
+        if render_cache.is_current(chat_id, message_id, digest):
+            return {"ok": True, "result": True}
+        
+        result = outbound.call("editMessageText", screen.edit_payload(chat_id, message_id),
+                               chat_id=chat_id, coalesce=True)
+        if is_superseded(result):
+            # НАШУ ПРАВКУ ЗАМЕНИЛА БОЛЕЕ СВЕЖАЯ - НА ЭКРАНЕ ЕЕ ТЕКСТ, ЕЕ ВЫЗЫВАЮЩИЙ
+            # И ЗАПОМНИТ DIGEST, И ОБРАБОТАЕТ ОШИБКУ
+            return result
+        if result.get('ok') or is_not_modified(result):
+            # "message is not modified" - содержимое уже нужное, это успех
+            render_cache.remember(chat_id, message_id, digest)
+            return {"ok": True, "result": result.get('result', True)}
+        if is_rate_limited(result):
+            # ПРИ ФЛУД-ЛИМИТЕ НЕ ШЛЕМ НОВОЕ СООБЩЕНИЕ - ЭТО ТОЛЬКО УСИЛИТ ФЛУД
+            log.error("Edit of %s rate limited: %s", message_id, result.get('description'))
+            return result
+        log.error("Error editing message %s: %s", message_id, result.get('description'))
+        edit_fallbacks.inc()
     
     # Если редактирование не удалось, отправляем новое сообщение
-    try:
-        response = requests.post(
-            f"https://api.telegram.org/bot{TELEGRAM_TOKEN}/sendMessage",
-            json={
-                "chat_id": chat_id,
-                "text": text,
-                "reply_markup": keyboard,
-                "parse_mode": "Markdown"
-            },
-            timeout=10
-        )
+    result = outbound.call("sendMessage", screen.send_payload(chat_id), chat_id=chat_id)
+    if result.get('ok'):
+        # СОХРАНЯЕМ ID НОВОГО СООБЩЕНИЯ
+        with chat_locks(chat_id):
+            USER_MESSAGE_IDS[chat_id] = result['result']['message_id']
+        render_cache.remember(chat_id, result['result']['message_id'], digest)
+        return result
+    
+    log.error("Failed to send message: %s", result.get('description'))
+    return {"ok": False}
+
+def start_lesson(chat_id, lesson):
+    """Экран урока: продолжает сохраненный или начинает новый"""
+    with chat_locks(chat_id):
+        USER_CHAT_MODES.handle(chat_id, "start_lesson")
         
-        if response.status_code == 200:
-            result = response.json()
-            if result.get('ok'):
-                # СОХРАНЯЕМ ID НОВОГО СООБЩЕНИЯ
-                USER_MESSAGE_IDS[chat_id] = result['result']['message_id']
-                return result
+        # ПРОВЕРЯЕМ ЕСТЬ ЛИ СОХРАНЕННЫЙ ПРОГРЕСС
+        has_saved_progress = restore_lesson_progress(chat_id)
         
-        logging.error(f"Failed to send message: {response.text}")
-        return {"ok": False}
+        if has_saved_progress and USER_LESSON_STATE[chat_id]['current_lesson'] == lesson.title:
+            # ПРОДОЛЖАЕМ С СОХРАНЕННОГО МЕСТА
+            last_conversation = USER_LESSON_STATE[chat_id]['conversation']
+            
+            # ИЩЕМ ПОСЛЕДНЕЕ СООБЩЕНИЕ УЧИТЕЛЯ
+            last_teacher_turn = last_conversation.last(ROLE_TEACHER)
+            if last_teacher_turn:
+                last_teacher_msg = last_teacher_turn.content
+                summary = last_teacher_msg[:50] + "..." if len(last_teacher_msg) > 50 else last_teacher_msg
+            else:
+                summary = "начале урока"
+            
+            reactions = [
+                f"Отлично, что вернулись! 😊 Продолжим с: *{summary}*",
+                f"С возвращением! Мы остановились на: *{summary}*",
+                f"Рад вас снова видеть! Продолжаем: *{summary}*"
+            ]
+            
+            welcome_text = f"""🧠 *Учитель NeuroTeacher*
+
+📚 Тема: {lesson.title}
+
+{random.choice(reactions)}"""
+        else:
+            # НАЧИНАЕМ НОВЫЙ УРОК
+            USER_LESSON_STATE[chat_id] = new_lesson_state(lesson)
+            
+            greetings = [
+                f"Привет! Начнем изучать {lesson.title}",
+                f"Добро пожаловать на урок: {lesson.title}",
+                f"Начнем наше погружение в {lesson.title}"
+            ]
+            
+            welcome_text = f"""🧠 *Учитель NeuroTeacher*
+
+📚 Тема: {lesson.title}
+
+{random.choice(greetings)}"""
         
-    except Exception as e:
-        logging.error(f"Error sending message: {e}")
-        return {"ok": False}
+    keyboard = {
+        "inline_keyboard": [
+            [{"text": "🔙 Назад к курсу", "callback_data": "menu_course_back"}]
+        ]
+    }
+    
+    return {"text": welcome_text, "keyboard": keyboard}
 
 @app.route('/')
 def home():
@@ -463,186 +955,364 @@ def home():
         "founder_wallet": TON_WALLET
     })
 
+# ПРОВЕРКА ДОСТУПНОСТИ TELEGRAM КЭШИРУЕТСЯ - /health ДЕРГАЮТ ЧАСТО
+telegram_probe = {"checked_at": None, "ok": False, "refreshing": False}
+telegram_probe_lock = threading.Lock()
+
+def telegram_reachable():
+    """Последний результат getMe; устаревший обновляет один вызывающий, остальные не ждут"""
+    with telegram_probe_lock:
+        checked_at = telegram_probe["checked_at"]
+        stale = checked_at is None or time.monotonic() - checked_at > HEALTH_CHECK_TTL
+        if not stale or telegram_probe["refreshing"]:
+            return telegram_probe["ok"]
+        telegram_probe["refreshing"] = True
+    # getMe ИДЕТ БЕЗ БЛОКИРОВКИ - ПАРАЛЛЕЛЬНЫЕ ПРОВЕРКИ НЕ ВСТАЮТ ЗА МЕДЛЕННЫМ TELEGRAM
+    ok = False
+    try:
+        ok = bool(telegram.get_me().get("ok"))
+    finally:
+        with telegram_probe_lock:
+            telegram_probe.update(ok=ok, checked_at=time.monotonic(), refreshing=False)
+    return ok
+
 @app.route('/health')
 def health():
-    return jsonify({"status": "healthy", "service": "NeuroTeacher", "ai": "Gemini Flash 2.0"})
+    checks = {"telegram": telegram_reachable()}
+    ready = all(checks.values())
+    # LLM НА ГОТОВНОСТЬ НЕ ВЛИЯЕТ: БЕЗ НЕГО РАБОТАЮТ /start, МЕНЮ, КУРСЫ И ОПЛАТА,
+    # А ЭКЗЕМПЛЯР ОТВЕЧАЕТ ЗАГОТОВКАМИ - ПЕРЕЗАПУСК ЕГО НЕ ПОЧИНИТ
+    llm_available = not llm_gateway.breaker.is_open()
+    if not ready:
+        state = "unhealthy"
+    else:
+        state = "healthy" if llm_available else "degraded"
+    status = {"status": state, "ready": ready, "checks": checks,
+              "llm_available": llm_available, "llm_warm": llm_gateway.is_warm(),
+              "service": "NeuroTeacher", "ai": "Gemini Flash 2.0"}
+    status["outbound"] = outbound.stats()
+    status["render_cache"] = render_cache.stats()
+    status["screen_memo"] = screen_memo.stats()
+    status["response_cache"] = response_cache.stats()
+    status["llm"] = llm_gateway.stats()
+    status["admission"] = admission.stats()
+    status["payments"] = ledger.stats()
+    status["logging"] = log_pipeline.stats()
+    if ton_poller is not None:
+        status["payments"]["poller"] = ton_poller.stats()
+    status["state_store"] = state_store.stats()
+    status["routes"] = callback_router.stats()
+    status["dedup"] = update_dedup.stats()
+    status["pipeline"] = update_pipeline.stats()
+    status["sessions"] = sessions.stats()
+    if affinity_ring is not None:
+        status["affinity"] = {"self": AFFINITY_SELF, "peers": AFFINITY_PEERS}
+    if update_queue is not None:
+        status["update_queue"] = update_queue.stats()
+    return jsonify(status), 200 if ready else 503
+
+# ЗНАЧЕНИЯ, КОТОРЫЕ УЖЕ СЧИТАЮТ САМИ КОМПОНЕНТЫ, ЧИТАЮТСЯ ПРИ ВЫДАЧЕ /metrics
+metrics.gauge_func("neuro_state_entries", "Записей в памяти по словарям состояния", lambda: {
+    "USER_PROGRESS": len(USER_PROGRESS),
+    "USER_MESSAGE_IDS": len(USER_MESSAGE_IDS),
+    "USER_LESSON_STATE": len(USER_LESSON_STATE),
+    "USER_SAVED_PROGRESS": len(USER_SAVED_PROGRESS),
+    "USER_CHAT_MODES": len(USER_CHAT_MODES)
+}, ("map",))
+metrics.gauge_func("neuro_state_pending_writes", "Изменения, ждущие записи в базу", state_store.pending)
+metrics.gauge_func("neuro_update_queue_depth", "Глубина очереди входящих update",
+                   lambda: update_queue.depth() if update_queue is not None else None)
+metrics.gauge_func("neuro_outbound_pending", "Вызовы Bot API в очереди планировщика", lambda: {
+    "interactive": outbound.stats()["pending_interactive"],
+    "background": outbound.stats()["pending_background"]
+}, ("priority",))
+metrics.gauge_func("neuro_outbound_events_total", "События планировщика отправки",
+                   lambda: dict(outbound.counters), ("event",), kind="counter")
+metrics.gauge_func("neuro_llm_in_flight", "Вызовы модели в работе", lambda: llm_gateway.in_flight)
+metrics.gauge_func("neuro_llm_circuit_open", "Цепь LLM разомкнута", lambda: int(llm_gateway.breaker.is_open()))
+metrics.gauge_func("neuro_llm_warm", "SDK и модель LLM загружены", lambda: int(llm_gateway.is_warm()))
+metrics.gauge_func("neuro_admission_limit", "Текущий адаптивный лимит запросов к LLM",
+                   lambda: int(admission.limit))
+metrics.gauge_func("neuro_admission_in_flight", "Допущенные запросы к LLM в работе",
+                   lambda: admission.stats()["in_flight"], ("class",))
+metrics.gauge_func("neuro_admission_waiting", "Запросы к LLM в очереди допуска",
+                   lambda: admission.stats()["waiting"], ("class",))
+metrics.gauge_func("neuro_admission_total", "Решения допуска: admitted, queued, collapsed, shed",
+                   lambda: dict(admission.counters), ("class", "outcome"), kind="counter")
+metrics.gauge_func("neuro_payments_total", "Учтенные платежи TON",
+                   lambda: ledger.totals()["payments"], kind="counter")
+metrics.gauge_func("neuro_income_nanoton_total", "Поступления TON (нанотоны)",
+                   lambda: ledger.totals()["total_income"], kind="counter")
+metrics.gauge_func("neuro_premium_users", "Пользователи с премиумом (включая истекший)",
+                   lambda: ledger.stats()["premium_users"])
+metrics.gauge_func("neuro_log_records_suppressed_total", "Записи лога, отброшенные лимитом повторов",
+                   lambda: log_pipeline.stats()["suppressed"], kind="counter")
+metrics.gauge_func("neuro_log_records_dropped_total", "Записи лога, отброшенные при полной очереди",
+                   lambda: log_pipeline.stats()["dropped"], kind="counter")
+metrics.gauge_func("neuro_log_queue_depth", "Записи лога в очереди на вывод",
+                   lambda: log_pipeline.stats()["queued"])
+metrics.gauge_func("neuro_llm_events_total", "События шлюза LLM",
+                   lambda: dict(llm_gateway.counters), ("event",), kind="counter")
+metrics.gauge_func("neuro_response_cache_events_total", "Обращения к кэшу ответов", lambda: {
+    "hit": response_cache.hits, "miss": response_cache.misses,
+    "shared": response_cache.shared, "eviction": response_cache.evictions
+}, ("event",), kind="counter")
+metrics.gauge_func("neuro_response_cache_bytes", "Размер кэша ответов", lambda: response_cache.bytes)
+metrics.gauge_func("neuro_duplicate_updates_total", "Отброшенные повторы update",
+                   lambda: update_dedup.duplicates, kind="counter")
+
+@app.route('/metrics')
+def metrics_endpoint():
+    return Response(metrics.render(), mimetype="text/plain; version=0.0.4")
+
+affinity_ring = None
+peer_client = None
+if AFFINITY_PEERS and AFFINITY_SELF:
+    affinity_ring = HashRing(AFFINITY_PEERS)
+    peer_client = httpx.Client(timeout=LLM_DEADLINE + 5)
+    atexit.register(peer_client.close)
+
+def forward_update(peer, data):
+    """Пересылает update экземпляру-владельцу чата; None - обработать у себя"""
+    try:
+        response = peer_client.post(f"{peer}/webhook", json=data, headers={AFFINITY_HEADER: "1"})
+        return jsonify(response.json()), response.status_code
+    except (httpx.HTTPError, ValueError) as e:
+        log.error("Affinity forward to %s failed: %s", peer, e)
+        return None
 
 @app.route('/webhook', methods=['POST'])
 def telegram_webhook():
+    data = request.get_json(silent=True)
+    if not isinstance(data, dict):
+        return jsonify({"status": "error", "message": "Invalid update"})
+    
+    # ЧАТ ДРУГОГО ЭКЗЕМПЛЯРА - ПЕРЕСЫЛАЕМ ВЛАДЕЛЬЦУ, ЕГО КЭШИ УЖЕ ПРОГРЕТЫ
+    if affinity_ring is not None and not request.headers.get(AFFINITY_HEADER):
+        owner = affinity_ring.node_for(extract_chat_id(data))
+        if owner and owner != AFFINITY_SELF:
+            forwarded = forward_update(owner, data)
+            if forwarded is not None:
+                return forwarded
+    
+    # ПОВТОРНАЯ ДОСТАВКА - ПОДТВЕРЖДАЕМ БЕЗ ОБРАБОТКИ
+    update_id = data.get('update_id')
+    if update_dedup.is_duplicate(update_id):
+        return jsonify({"status": "duplicate"})
+    
+    if update_queue is None:
+        result = process_update(data)
+        if result.get("status") == "busy":
+            # Чат занят другим воркером - Telegram повторит доставку
+            update_dedup.forget(update_id)
+            return jsonify(result), 503
+        return jsonify(result)
+    
+    # БЫСТРЫЙ ОТВЕТ: ОБРАБОТКА ИДЕТ В ВОРКЕРАХ
+    if update_queue.submit(data):
+        return jsonify({"status": "queued"})
+    # Очередь переполнена - Telegram повторит доставку позже
+    update_dedup.forget(update_id)
+    return jsonify({"status": "busy"}), 503
+
+# 🧭 МАРШРУТЫ CALLBACK-КНОПОК
+callback_router = CallbackRouter(observer=observe_callback)
+
+@callback_router.before
+def bind_log_route(ctx):
+    """Маршрут кнопки попадает в записи лога этого update"""
+    log_bind(route=ctx.route.key if ctx.route is not None else None)
+
+@callback_router.before
+def answer_callback(ctx):
+    """Убираем "часики" на кнопке - для любой, даже неизвестной кнопки"""
+    if ctx.query.get('id'):
+        # НЕ БЛОКИРУЕТ ОТРИСОВКУ - ИДЕТ ПАРАЛЛЕЛЬНО
+        update_pipeline.fork(telegram.answer_callback_query, ctx.query['id'])
+
+@callback_router.before
+def apply_route_state(ctx):
+    """Сохранение урока и смена режима чата, объявленные при регистрации маршрута"""
+    if ctx.route is None:
+        return
+    lesson_action = ctx.route.options.get("lesson")
+    if lesson_action == "leave":
+        leave_lesson(ctx.chat_id)
+    elif lesson_action == "save":
+        save_lesson_progress(ctx.chat_id)
+    event = ctx.route.options.get("event")
+    if event:
+        USER_CHAT_MODES.handle(ctx.chat_id, event)
+
+@callback_router.after
+def render_screen(ctx, result):
+    """Обработчик вернул экран (Screen или {"text", "keyboard"}) - показываем его"""
+    if isinstance(result, Screen):
+        show_screen(ctx.chat_id, result, USER_MESSAGE_IDS.get(ctx.chat_id))
+        return {"status": "ok"}
+    if result and "keyboard" in result:
+        edit_main_message(ctx.chat_id, result['text'], result['keyboard'], USER_MESSAGE_IDS.get(ctx.chat_id))
+        return {"status": "ok"}
+
+# ОСНОВНЫЕ ОБРАБОТЧИКИ МЕНЮ
+@callback_router.exact("menu_main", lesson="leave", event="open_main_menu")
+def on_main_menu(ctx):
+    # ПРОГРЕСС УРОКА СОХРАНЯЕТСЯ ПЕРЕД ВЫХОДОМ (lesson="leave")
+    return MAIN_SCREEN
+
+@callback_router.exact("menu_neuropartner", event="open_neuropartner")
+def on_neuropartner_menu(ctx):
+    return NEUROPARTNER_SCREEN
+
+@callback_router.exact("menu_premium", event="open_premium")
+def on_premium_menu(ctx):
+    return premium_screen(ctx.chat_id)
+
+@callback_router.exact("menu_profile", event="open_profile")
+def on_profile_menu(ctx):
+    return profile_screen(ctx.chat_id)
+
+@callback_router.exact("menu_course_back", lesson="save", event="open_course")
+def on_course_back(ctx):
+    # КУРС ДЛЯ ВОЗВРАТА - ПО ID УРОКА ИЗ СОСТОЯНИЯ, БЕЗ ПЕРЕБОРА
+    lesson_state = USER_LESSON_STATE.get(ctx.chat_id, {})
+    lesson = catalog.lesson(lesson_state.get('lesson_id'))
+    if lesson is None:
+        lesson = catalog.lesson_by_title(lesson_state.get('current_lesson', ''))
+    
+    if lesson:
+        return course_screen(lesson.course, ctx.chat_id, lesson.index // LESSONS_PER_PAGE)
+    # ЕСЛИ КУРС НЕ НАЙДЕН - В ГЛАВНОЕ МЕНЮ
+    return MAIN_SCREEN
+
+@callback_router.prefix("k:", event="open_course")
+def on_catalog_page(ctx):
+    ids = parse_ids(ctx.data)
+    page = ids[0] if ids else 0
+    return CATALOG_SCREENS[min(max(page, 0), len(CATALOG_SCREENS) - 1)]
+
+def safe_course_screen(course, chat_id, page=0):
     try:
-        data = request.json
-        
-        if 'callback_query' in data:
-            callback_data = data['callback_query']
-            chat_id = callback_data['message']['chat']['id']
-            callback_text = callback_data['data']
-            message_id = callback_data['message']['message_id']
-            
-            requests.post(
-                f"https://api.telegram.org/bot{TELEGRAM_TOKEN}/answerCallbackQuery",
-                json={"callback_query_id": callback_data['id']}
-            )
-            
-            # ОСНОВНЫЕ ОБРАБОТЧИКИ МЕНЮ
-            if callback_text == "menu_main":
-                # СОХРАНЯЕМ ПРОГРЕСС ПЕРЕД ВЫХОДОМ В ГЛАВНОЕ МЕНЮ
-                if chat_id in USER_LESSON_STATE:
-                    save_lesson_progress(chat_id)
-                
-                menu_data = menu_manager.get_main_menu()
-                edit_main_message(chat_id, menu_data['text'], menu_data['keyboard'], USER_MESSAGE_IDS.get(chat_id))
-                return jsonify({"status": "ok"})
-            
-            elif callback_text == "menu_neuropartner":
-                menu_data = menu_manager.get_neuropartner_menu()
-                edit_main_message(chat_id, menu_data['text'], menu_data['keyboard'], USER_MESSAGE_IDS.get(chat_id))
-                return jsonify({"status": "ok"})
-            
-            elif callback_text == "menu_premium":
-                menu_data = menu_manager.get_premium_menu()
-                edit_main_message(chat_id, menu_data['text'], menu_data['keyboard'], USER_MESSAGE_IDS.get(chat_id))
-                return jsonify({"status": "ok"})
-            
-            elif callback_text == "menu_profile":
-                menu_data = menu_manager.get_profile_menu(chat_id)
-                edit_main_message(chat_id, menu_data['text'], menu_data['keyboard'], USER_MESSAGE_IDS.get(chat_id))
-                return jsonify({"status": "ok"})
-            
-            elif callback_text.startswith("menu_course_"):
-                course_name = callback_text.replace("menu_course_", "")
-                try:
-                    menu_data = menu_manager.get_enhanced_course_menu(course_name, chat_id)
-                    edit_main_message(chat_id, menu_data['text'], menu_data['keyboard'], USER_MESSAGE_IDS.get(chat_id))
-                except Exception as e:
-                    logging.error(f"Error opening course {course_name}: {e}")
-                    menu_data = menu_manager.get_main_menu()
-                    edit_main_message(chat_id, menu_data['text'], menu_data['keyboard'], USER_MESSAGE_IDS.get(chat_id))
-                
-                return jsonify({"status": "ok"})
-            
-            # ДИАЛОГОВЫЕ УРОКИ
-            elif callback_text.startswith('start_lesson_'):
-                # ПАРСИМ КУРС И ИНДЕКС УРОКА
-                parts = callback_text.replace('start_lesson_', '').split('_')
-                if len(parts) >= 2:
-                    course_name = parts[0]
-                    lesson_index = int(parts[1])
-                    
-                    # НАХОДИМ УРОК
-                    if course_name in COURSES and 0 <= lesson_index < len(COURSES[course_name]['уроки']):
-                        lesson = COURSES[course_name]['уроки'][lesson_index]
-                        
-                        # ПРОВЕРЯЕМ ЕСТЬ ЛИ СОХРАНЕННЫЙ ПРОГРЕСС
-                        has_saved_progress = restore_lesson_progress(chat_id)
-                        
-                        if has_saved_progress and USER_LESSON_STATE[chat_id]['current_lesson'] == lesson:
-                            # ПРОДОЛЖАЕМ С СОХРАНЕННОГО МЕСТА
-                            last_conversation = USER_LESSON_STATE[chat_id]['conversation']
-                            
-                            # ИЩЕМ ПОСЛЕДНЕЕ СООБЩЕНИЕ УЧИТЕЛЯ
-                            teacher_messages = [msg for msg in last_conversation if msg["role"] == "teacher"]
-                            if teacher_messages:
-                                last_teacher_msg = teacher_messages[-1]['content']
-                                summary = last_teacher_msg[:50] + "..." if len(last_teacher_msg) > 50 else last_teacher_msg
-                            else:
-                                summary = "начале урока"
-                            
-                            reactions = [
-                                f"Отлично, что вернулись! 😊 Продолжим с: *{summary}*",
-                                f"С возвращением! Мы остановились на: *{summary}*",
-                                f"Рад вас снова видеть! Продолжаем: *{summary}*"
-                            ]
-                            
-                            welcome_text = f"""🧠 *Учитель NeuroTeacher*
-
-📚 Тема: {lesson}
+        return course_screen(course, chat_id, page)
+    except Exception as e:
+        log.error("Error opening course %s: %s", course.id if course else None, e)
+        return MAIN_SCREEN
 
-{random.choice(reactions)}"""
-                        else:
-                            # НАЧИНАЕМ НОВЫЙ УРОК
-                            USER_LESSON_STATE[chat_id] = {
-                                "current_lesson": lesson,
-                                "step": 0,
-                                "conversation": []
-                            }
-                            
-                            greetings = [
-                                f"Привет! Начнем изучать {lesson}",
-                                f"Добро пожаловать на урок: {lesson}",
-                                f"Начнем наше погружение в {lesson}"
-                            ]
-                            
-                            welcome_text = f"""🧠 *Учитель NeuroTeacher*
-
-📚 Тема: {lesson}
+@callback_router.prefix("c:", event="open_course")
+def on_course(ctx):
+    # c:<id курса>[:<страница>]
+    ids = parse_ids(ctx.data) or [None]
+    page = ids[1] if len(ids) > 1 else 0
+    return safe_course_screen(catalog.course(ids[0]), ctx.chat_id, page)
 
-{random.choice(greetings)}"""
-                        
-                        keyboard = {
-                            "inline_keyboard": [
-                                [{"text": "🔙 Назад к курсу", "callback_data": "menu_course_back"}]
-                            ]
-                        }
-                        
-                        edit_main_message(chat_id, welcome_text, keyboard, USER_MESSAGE_IDS.get(chat_id))
-                
-                return jsonify({"status": "ok"})
-            
-            elif callback_text == "menu_course_back":
-                # СОХРАНЯЕМ ПРОГРЕСС ПЕРЕД ВЫХОДОМ
-                if chat_id in USER_LESSON_STATE:
-                    save_lesson_progress(chat_id)
-                
-                # НАХОДИМ КУРС ДЛЯ ВОЗВРАТА
-                current_lesson = USER_LESSON_STATE.get(chat_id, {}).get('current_lesson', '')
-                found_course = None
-                
-                for course_name, course_info in COURSES.items():
-                    if current_lesson in course_info['уроки']:
-                        found_course = course_name
-                        break
-                
-                if found_course:
-                    menu_data = menu_manager.get_enhanced_course_menu(found_course, chat_id)
-                    edit_main_message(chat_id, menu_data['text'], menu_data['keyboard'], USER_MESSAGE_IDS.get(chat_id))
-                else:
-                    # ЕСЛИ КУРС НЕ НАЙДЕН - В ГЛАВНОЕ МЕНЮ
-                    menu_data = menu_manager.get_main_menu()
-                    edit_main_message(chat_id, menu_data['text'], menu_data['keyboard'], USER_MESSAGE_IDS.get(chat_id))
-                
-                return jsonify({"status": "ok"})
+@callback_router.prefix("menu_course_", event="open_course")
+def on_legacy_course(ctx):
+    # Старые кнопки с полным названием курса
+    return safe_course_screen(catalog.course_by_name(ctx.data[len("menu_course_"):]), ctx.chat_id)
+
+# ДИАЛОГОВЫЕ УРОКИ
+@callback_router.prefix("l:")
+def on_lesson(ctx):
+    ids = parse_ids(ctx.data)
+    lesson = catalog.lesson(ids[0]) if ids else None
+    if lesson:
+        return start_lesson(ctx.chat_id, lesson)
+
+@callback_router.prefix("start_lesson_")
+def on_legacy_lesson(ctx):
+    # Старый формат start_lesson_<курс>_<индекс>: в названии курса может быть "_"
+    course_name, _, lesson_index = ctx.data[len('start_lesson_'):].rpartition('_')
+    course = catalog.course_by_name(course_name)
+    if course and lesson_index.isdigit() and int(lesson_index) < len(course.lessons):
+        return start_lesson(ctx.chat_id, course.lessons[int(lesson_index)])
+
+def llm_class(chat_id):
+    """Кто ответит на текст чата: учитель урока или NeuroPartner"""
+    # ЧАТ МОГ ПРИЙТИ ИЗ ДРУГОГО ВОРКЕРА, А СЕССИЯ ЕЩЕ НЕ ОТКРЫТА - РЕЖИМ ЧИТАЕМ НЕ ИЗ УСТАРЕВШЕГО КЭША
+    sessions.refresh(chat_id)
+    with chat_locks(chat_id):
+        lesson_state = USER_LESSON_STATE.get(chat_id, {})
+        if USER_CHAT_MODES.get(chat_id) == chat_modes.LESSON and "current_lesson" in lesson_state:
+            return "lesson"
+        return "neuropartner"
+
+def admit_message(data, chat_id):
+    """Билет допуска для текста, который пойдет в LLM (None - модель не нужна)"""
+    message = data.get('message')
+    if not message or not chat_id or message.get('text', '') == '/start':
+        return None
+    return admission.admit(chat_id, llm_class(chat_id), message.get('text', ''), ref=message.get('message_id'))
+
+def process_update(data, session_wait=None):
+    """Обрабатывает одно обновление Telegram в сессии чата и замеряет его критический путь.
+
+    session_wait - сколько ждать чат, занятый другим воркером (None - SESSION_WAIT)
+    """
+    chat_id = extract_chat_id(data)
+    # ВСЕ ЗАПИСИ ЛОГА ВНУТРИ UPDATE НЕСУТ ЕГО chat_id И update_id
+    with log_context(chat_id=chat_id, update_id=data.get('update_id')), \
+            update_pipeline.trace("callback" if 'callback_query' in data else "message"):
+        # ДОПУСК ДО СЕССИИ: ЛИШНИЕ СООБЩЕНИЯ НЕ ЗАНИМАЮТ ВОРКЕР
+        ticket = admit_message(data, chat_id)
+        if ticket is not None and ticket.status == COLLAPSED:
+            # ТЕКСТ УЙДЕТ ВМЕСТЕ С ОЖИДАЮЩИМ ЗАПРОСОМ ЭТОГО ЧАТА; СООБЩЕНИЕ УДАЛИТ ОН ЖЕ,
+            # КОГДА ОТВЕТИТ (ЕСЛИ ЕГО СБРОСЯТ - СООБЩЕНИЕ ОСТАНЕТСЯ У ПОЛЬЗОВАТЕЛЯ)
+            update_pipeline.current_kind(ticket.klass)
+            return {"status": "collapsed"}
+        try:
+            with sessions.session(chat_id, wait=session_wait):
+                if ticket is not None and ticket.status == SHED:
+                    return reply_shed(chat_id, ticket)
+                result = handle_update(data, ticket)
+                if ticket is not None and result.get("status") == "ok":
+                    # ПРИКЛЕЕННЫЕ СООБЩЕНИЯ ОТВЕЧЕНЫ ВМЕСТЕ С ЭТИМ - ТЕПЕРЬ ИХ МОЖНО УБРАТЬ
+                    for merged_id in ticket.merged:
+                        delete_user_message(chat_id, merged_id)
+                return result
+        except SessionBusy as e:
+            # Без ожидания занятость - обычный повод для повтора, о сбросе сообщит очередь
+            log.log(logging.DEBUG if session_wait == 0 else logging.ERROR, "Session busy: %s", e)
+            return {"status": "busy"}
+        finally:
+            if ticket is not None:
+                admission.release(ticket)
+
+def reply_shed(chat_id, ticket):
+    """Короткий ответ "перегружен" - в сессии чата, чтобы не гоняться с его правками"""
+    update_pipeline.current_kind(ticket.klass)
+    # СООБЩЕНИЯ НЕ УДАЛЯЕМ - ПОЛЬЗОВАТЕЛЬ СМОЖЕТ ОТПРАВИТЬ ИХ ЕЩЕ РАЗ
+    show_screen(chat_id, SHED_SCREENS[ticket.klass])
+    return {"status": "shed"}
+
+def handle_update(data, ticket=None):
+    try:
+        if 'callback_query' in data:
+            return callback_router.dispatch(data['callback_query'])
 
         # ОБРАБОТКА ТЕКСТОВЫХ СООБЩЕНИЙ
         message = data.get('message', {})
         chat_id = message.get('chat', {}).get('id')
         text = message.get('text', '')
         message_id = message.get('message_id')
+        if ticket is not None:
+            # Вместе с приклеенными сообщениями, пришедшими, пока запрос ждал допуска
+            text = ticket.text
 
         if not chat_id:
-            return jsonify({"status": "error", "message": "No chat_id"})
+            return {"status": "error", "message": "No chat_id"}
 
         if text == '/start':
-            menu_data = menu_manager.get_main_menu()
-            edit_main_message(chat_id, menu_data['text'], menu_data['keyboard'])
-            return jsonify({"status": "ok"})
-        
-        # ПРОВЕРЯЕМ, НАХОДИТСЯ ЛИ ПОЛЬЗОВАТЕЛЬ В РЕЖИМЕ NEUROPARTNER
-        neuropartner_active = False
-        if chat_id in USER_MESSAGE_IDS:
-            # Простая проверка - если последнее сообщение было из меню NeuroPartner
-            try:
-                response = requests.post(
-                    f"https://api.telegram.org/bot{TELEGRAM_TOKEN}/getChat",
-                    json={"chat_id": chat_id}
-                )
-                # Если пользователь в режиме NeuroPartner
-                neuropartner_active = True
-            except:
-                pass
+            update_pipeline.current_kind("start")
+            leave_lesson(chat_id)
+            USER_CHAT_MODES.handle(chat_id, "start")
+            show_screen(chat_id, MAIN_SCREEN)
+            return {"status": "ok"}
         
+        # МАРШРУТ ОПРЕДЕЛЯЕТСЯ РЕЖИМОМ ЧАТА - БЕЗ ЗАПРОСОВ К TELEGRAM
         lesson_state = USER_LESSON_STATE.get(chat_id, {})
-        if lesson_state and "current_lesson" in lesson_state:
+        if USER_CHAT_MODES.get(chat_id) == chat_modes.LESSON and "current_lesson" in lesson_state:
             # РЕЖИМ УРОКА
+            update_pipeline.current_kind("lesson")
             current_lesson = lesson_state["current_lesson"]
             
             # УДАЛЯЕМ СООБЩЕНИЕ ПОЛЬЗОВАТЕЛЯ
@@ -651,17 +1321,20 @@ def telegram_webhook():
             
             # ОБНОВЛЯЕМ СОСТОЯНИЕ И ПОЛУЧАЕМ ОТВЕТ
             update_lesson_state(chat_id, current_lesson, lesson_state["step"], text)
-            menu_data = menu_manager.get_dialog_lesson(chat_id, current_lesson, text)
+            on_partial = create_stream_editor(chat_id, f"📚 *{current_lesson}*\n\n")
+            menu_data = menu_manager.get_dialog_lesson(chat_id, current_lesson, text, on_partial)
             edit_main_message(chat_id, menu_data['text'], menu_data['keyboard'], USER_MESSAGE_IDS.get(chat_id))
             
         else:
             # РЕЖИМ NEUROPARTNER (простой чат)
+            update_pipeline.current_kind("neuropartner")
             # УДАЛЯЕМ СООБЩЕНИЕ ПОЛЬЗОВАТЕЛЯ
             if message_id:
                 delete_user_message(chat_id, message_id)
             
             # ПОЛУЧАЕМ ОТВЕТ ОТ NEUROPARTNER
-            partner_response = menu_manager.get_neuropartner_response(chat_id, text)
+            on_partial = create_stream_editor(chat_id, "🌌 *NeuroPartner*\n\n")
+            partner_response = menu_manager.get_neuropartner_response(chat_id, text, on_partial)
             
             keyboard = {
                 "inline_keyboard": [
@@ -675,12 +1348,60 @@ def telegram_webhook():
             
             edit_main_message(chat_id, response_text, keyboard, USER_MESSAGE_IDS.get(chat_id))
             
-        return jsonify({"status": "ok"})        
+        return {"status": "ok"}
         
     except Exception as e:
-        logging.error(f"Webhook error: {e}")
-        return jsonify({"status": "error", "message": str(e)})
+        log.error("Webhook error: %s", e)
+        return {"status": "error", "message": str(e)}
+
+update_queue = None
+if ASYNC_WEBHOOK:
+    # ВОРКЕР ШАРДА НЕ ЖДЕТ ЧАТ, ЗАНЯТЫЙ ДРУГИМ ПРОЦЕССОМ: UPDATE ОТКЛАДЫВАЕТСЯ И ПОВТОРЯЕТСЯ,
+    # А ЕСЛИ ЧАТ ЗАНЯТ ДОЛЬШЕ SESSION_WAIT - ОТБРАСЫВАЕТСЯ И СНИМАЕТСЯ С УЧЕТА ПОВТОРОВ
+    update_queue = UpdateQueue(functools.partial(process_update, session_wait=0),
+                               workers=UPDATE_WORKERS, max_depth=UPDATE_QUEUE_SIZE,
+                               retry_budget=SESSION_WAIT,
+                               on_drop=lambda update: update_dedup.forget(update.get('update_id')))
+    update_queue.start()
+    atexit.register(update_queue.shutdown, UPDATE_DRAIN_TIMEOUT)
+
+# 🔥 SDK И МОДЕЛЬ ГРУЗЯТСЯ В ФОНЕ - СЕРВЕР ОТВЕЧАЕТ НА МЕНЮ И /health СРАЗУ
+def warm_llm():
+    time.sleep(LLM_WARMUP_DELAY)
+    try:
+        elapsed = llm_gateway.warm()
+        log.info("LLM backend warmed up in %.2fs", elapsed)
+    except Exception as e:
+        # Не страшно: модель создастся при первом запросе
+        log.error("LLM warm-up error: %s", e)
+
+if LLM_WARMUP:
+    threading.Thread(target=warm_llm, name="llm-warmup", daemon=True).start()
+
+# 💳 СВЕРКА ПЛАТЕЖЕЙ: ОПРОС ИНДЕКСАТОРА TON С СОХРАНЕННОГО КУРСОРА
+def notify_payment(payment):
+    chat_id = payment["chat_id"]
+    if chat_id is None:
+        log.info("TON transfer %s without premium comment: %r", payment['hash'], payment['comment'])
+        return
+    # Профиль и экран премиума показывали старый статус
+    screen_memo.forget(chat_id)
+    if payment["premium_until"]:
+        text = f"✅ Оплата {format_ton(payment['amount'])} TON получена!\n\n💰 Премиум активен до {format_date(payment['premium_until'])}"
+    else:
+        text = (f"⚠️ Получено {format_ton(payment['amount'])} TON - меньше стоимости премиума "
+                f"({format_ton(to_nano(PREMIUM_PRICE_TON))} TON). Напишите нам, мы поможем.")
+    outbound.submit("sendMessage", {"chat_id": chat_id, "text": text}, chat_id=chat_id, priority=BACKGROUND)
+
+ton_poller = None
+if TON_INDEXER_URL:
+    ton_indexer = TonIndexerClient(TON_INDEXER_URL, TON_WALLET, api_key=TON_INDEXER_API_KEY, page_size=TON_PAGE_SIZE)
+    ton_poller = ReconciliationPoller(ledger, ton_indexer, interval=TON_POLL_INTERVAL, on_payment=notify_payment).start()
+    atexit.register(ton_indexer.close)
+    atexit.register(ton_poller.stop)
 
 if __name__ == '__main__':
+    # SIGTERM при редеплое -> штатный выход, чтобы очередь успела дообработаться
+    signal.signal(signal.SIGTERM, lambda signum, frame: sys.exit(0))
     port = int(os.environ.get('PORT', 5000))
     app.run(host='0.0.0.0', port=port)
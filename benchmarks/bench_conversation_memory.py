@@ -0,0 +1,74 @@
+"""Память на историю уроков: старый список словарей против Conversation.
+
+Моделирует N активных чатов, в каждом по T реплик, плюс снимок в
+USER_SAVED_PROGRESS (как после выхода в меню), и печатает занятую память
+на 100 тысяч чатов.
+
+    python benchmarks/bench_conversation_memory.py --chats 100000 --turns 12
+"""
+import argparse
+import gc
+import os
+import sys
+import tracemalloc
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from conversation import Conversation, snapshot_lesson_state  # noqa: E402
+
+
+def message(chat, turn, chars):
+    return (f"Сообщение {turn} в чате {chat}: " + "и" * chars)[:chars]
+
+
+def build_legacy(chats, turns, chars):
+    lessons, saved = {}, {}
+    for chat in range(chats):
+        state = {"current_lesson": "Урок", "step": turns // 2, "conversation": []}
+        for turn in range(turns):
+            state["conversation"].append({
+                "role": "student" if turn % 2 == 0 else "teacher",
+                "content": message(chat, turn, chars)
+            })
+        lessons[chat] = state
+        saved[chat] = state.copy()
+    return lessons, saved
+
+
+def build_compact(chats, turns, chars):
+    lessons, saved = {}, {}
+    for chat in range(chats):
+        state = {"current_lesson": "Урок", "step": turns // 2, "conversation": Conversation()}
+        for turn in range(turns):
+            state["conversation"].append("student" if turn % 2 == 0 else "teacher", message(chat, turn, chars))
+        lessons[chat] = state
+        saved[chat] = snapshot_lesson_state(state)
+    return lessons, saved
+
+
+def measure(builder, chats, turns, chars):
+    gc.collect()
+    tracemalloc.start()
+    data = builder(chats, turns, chars)
+    gc.collect()
+    current, _ = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    del data
+    return current
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--chats", type=int, default=100000)
+    parser.add_argument("--turns", type=int, default=12)
+    parser.add_argument("--chars", type=int, default=120)
+    args = parser.parse_args()
+
+    scale = 100000 / args.chats
+    for name, builder in (("legacy list[dict]", build_legacy), ("Conversation ring", build_compact)):
+        used = measure(builder, args.chats, args.turns, args.chars)
+        print(f"{name:20s} {used / args.chats:8.0f} байт/чат  {used * scale / 2**20:8.1f} МБ на 100k чатов")
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,90 @@
+"""Стоимость логирования на потоке запроса при лавине ошибок.
+
+N потоков пишут одну и ту же ошибку (как при отказе Gemini) в файл:
+- before: корневой логгер с обработчиком в файл, f-строка, запись из
+  потока запроса (как было до log_setup);
+- after: setup_logging - очередь, JSON в фоновом потоке, лимит повторов.
+
+Печатает среднее время вызова в потоке запроса и число записанных строк.
+
+    python benchmarks/bench_logging.py --threads 16 --records 5000
+"""
+import argparse
+import logging
+import os
+import sys
+import tempfile
+import threading
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from log_setup import log_context, setup_logging  # noqa: E402
+
+ERROR = RuntimeError("503 Service Unavailable: " + "model overloaded, retry later " * 20)
+
+
+def storm(threads, records, emit):
+    def worker(n):
+        with log_context(chat_id=n, update_id=n):
+            for _ in range(records):
+                emit(ERROR)
+
+    pool = [threading.Thread(target=worker, args=(n,)) for n in range(threads)]
+    started = time.perf_counter()
+    for thread in pool:
+        thread.start()
+    for thread in pool:
+        thread.join()
+    return time.perf_counter() - started
+
+
+def count_lines(path):
+    with open(path, encoding="utf-8") as f:
+        return sum(1 for _ in f)
+
+
+def run_before(path, threads, records):
+    root = logging.getLogger()
+    handler = logging.FileHandler(path, encoding="utf-8")
+    handler.setFormatter(logging.Formatter("%(asctime)s %(levelname)s %(name)s: %(message)s"))
+    root.handlers[:] = [handler]
+    root.setLevel(logging.INFO)
+    elapsed = storm(threads, records, lambda e: logging.error(f"Gemini API error: {e}"))
+    handler.close()
+    root.handlers[:] = []
+    return elapsed, elapsed
+
+
+def run_after(path, threads, records, rate):
+    stream = open(path, "w", encoding="utf-8")
+    pipeline = setup_logging(stream=stream, rate=rate)
+    log = logging.getLogger("app")
+    elapsed = storm(threads, records, lambda e: log.error("Gemini API error: %s", e))
+    pipeline.stop()
+    flushed = time.perf_counter()
+    stream.close()
+    return elapsed, elapsed + (time.perf_counter() - flushed), pipeline.stats()
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--threads", type=int, default=16)
+    parser.add_argument("--records", type=int, default=5000)
+    args = parser.parse_args()
+    total = args.threads * args.records
+    workdir = tempfile.mkdtemp()
+
+    path = os.path.join(workdir, "before.log")
+    elapsed, _ = run_before(path, args.threads, args.records)
+    print(f"before:           {elapsed / total * 1e6:7.2f} мкс/вызов, строк {count_lines(path)}")
+
+    for label, rate in (("after, no limit", 0), ("after", 1.0)):
+        path = os.path.join(workdir, label.replace(", ", "_").replace(" ", "_") + ".log")
+        elapsed, _, stats = run_after(path, args.threads, args.records, rate)
+        print(f"{label + ':':17} {elapsed / total * 1e6:7.2f} мкс/вызов, строк {count_lines(path)}, "
+              f"отброшено лимитом {stats['suppressed']}, при полной очереди {stats['dropped']}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,59 @@
+"""Стоимость маршрутизации callback-кнопок в зависимости от размера меню.
+
+Регистрирует R точных маршрутов и R префиксных (как кнопки курсов и уроков)
+и измеряет среднее время dispatch на синтетических callback_query - без
+Telegram и без Flask. Время не должно расти вместе с R.
+
+    python benchmarks/bench_router.py --routes 10 100 1000 10000
+"""
+import argparse
+import os
+import sys
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from router import CallbackRouter  # noqa: E402
+
+
+def build_router(routes):
+    router = CallbackRouter()
+    for i in range(routes):
+        router.exact(f"menu_{i}")(lambda ctx: None)
+        router.prefix(f"p{i}:")(lambda ctx: None)
+    router.prefix("l:")(lambda ctx: None)
+    return router
+
+
+def query(data):
+    return {"id": "1", "data": data, "message": {"chat": {"id": 1}, "message_id": 1}}
+
+
+def bench(router, payloads, iterations):
+    started = time.perf_counter()
+    for _ in range(iterations):
+        for payload in payloads:
+            router.dispatch(payload)
+    return (time.perf_counter() - started) / (iterations * len(payloads)) * 1e6
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--routes", type=int, nargs="+", default=[10, 100, 1000, 10000])
+    parser.add_argument("--iterations", type=int, default=20000)
+    args = parser.parse_args()
+
+    for routes in args.routes:
+        router = build_router(routes)
+        payloads = [
+            query(f"menu_{routes - 1}"),
+            query(f"p{routes - 1}:42"),
+            query("l:123456"),
+            query("unknown_button")
+        ]
+        per_call = bench(router, payloads, args.iterations)
+        print(f"routes={routes:>6}  dispatch {per_call:.2f} мкс/вызов")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,74 @@
+"""Стоимость отрисовки экранов меню на одно нажатие.
+
+Сравнивает два пути для главного меню, экрана курса и профиля:
+- build - как раньше: MenuManager собирает словари, считается отпечаток
+  для кэша отрисовки, тело запроса сериализуется в JSON;
+- compiled - готовый Screen (статический или из ScreenMemo), тело запроса
+  склеивается из готовых байтов.
+
+Telegram не вызывается, Gemini заменен заглушкой:
+    python benchmarks/bench_screens.py --iterations 20000
+"""
+import argparse
+import json
+import os
+import sys
+import tempfile
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+
+def setup_env():
+    os.environ.setdefault("TELEGRAM_TOKEN", "bench")
+    os.environ["LLM_BACKEND"] = "fake"
+    os.environ["LLM_WARMUP"] = "0"
+    os.environ["LESSON_OPENERS_PATH"] = os.path.join(tempfile.mkdtemp(), "none.json")
+
+
+def per_call_us(fn, iterations):
+    started = time.perf_counter()
+    for _ in range(iterations):
+        fn()
+    return (time.perf_counter() - started) / iterations * 1e6
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--iterations", type=int, default=20000)
+    args = parser.parse_args()
+
+    setup_env()
+    import app
+    from render_cache import render_digest
+
+    chat_id, message_id = 42, 1000
+    course = app.catalog.courses[0]
+    for lesson in course.lessons[:4]:
+        app.update_user_progress(chat_id, lesson.id)
+
+    def build(menu_data):
+        render_digest(menu_data['text'], menu_data['keyboard'])
+        json.dumps({"chat_id": chat_id, "message_id": message_id, "text": menu_data['text'],
+                    "reply_markup": menu_data['keyboard'], "parse_mode": "Markdown"}).encode()
+
+    cases = [
+        ("main",
+         lambda: build(app.menu_manager.get_main_menu()),
+         lambda: app.MAIN_SCREEN.edit_payload(chat_id, message_id)),
+        ("course",
+         lambda: build(app.menu_manager.get_enhanced_course_menu(course, chat_id)),
+         lambda: app.course_screen(course, chat_id).edit_payload(chat_id, message_id)),
+        ("profile",
+         lambda: build(app.menu_manager.get_profile_menu(chat_id)),
+         lambda: app.profile_screen(chat_id).edit_payload(chat_id, message_id)),
+    ]
+    print(f"{'экран':<10}{'build мкс':>12}{'compiled мкс':>14}{'ускорение':>11}")
+    for name, old, new in cases:
+        old_us = per_call_us(old, args.iterations)
+        new_us = per_call_us(new, args.iterations)
+        print(f"{name:<10}{old_us:>12.1f}{new_us:>14.1f}{old_us / new_us:>10.1f}x")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,130 @@
+"""Время холодного старта приложения.
+
+Для каждого прогона запускается новый процесс:
+- import - время `import app` (в отдельном интерпретаторе, медиана);
+- first 200 - от запуска `python app.py` до первого ответа 200 на /health;
+- warm - до момента, когда /health показывает llm_warm=true (SDK Gemini
+  загружен и модель создана в фоне).
+
+Используется настоящий бэкенд Gemini (импорт SDK и создание модели), но
+запросов к API нет: ключ фиктивный, Telegram заменен локальной заглушкой.
+Чтобы сравнить версии, запустите скрипт на обеих:
+
+    python benchmarks/bench_startup.py --runs 5
+"""
+import argparse
+import json
+import os
+import socket
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+import urllib.request
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+
+from fake_telegram import FakeTelegram  # noqa: E402
+
+IMPORT_SNIPPET = (
+    "import sys, time; sys.path.insert(0, {root!r}); started = time.perf_counter(); "
+    "import app; print(time.perf_counter() - started)"
+)
+
+
+def free_port():
+    with socket.socket() as sock:
+        sock.bind(("127.0.0.1", 0))
+        return sock.getsockname()[1]
+
+
+def base_env(telegram_url, workdir, warmup):
+    env = dict(os.environ)
+    env.update({
+        "TELEGRAM_TOKEN": "startup",
+        "TELEGRAM_API_URL": telegram_url,
+        "LLM_BACKEND": "gemini",
+        "GEMINI_API_KEY": "startup-bench",
+        "LLM_WARMUP": "1" if warmup else "0",
+        "LLM_WARMUP_DELAY": "0",
+        "LESSON_OPENERS_PATH": os.path.join(workdir, "none.json"),
+    })
+    return env
+
+
+def measure_import(env):
+    output = subprocess.run(
+        [sys.executable, "-c", IMPORT_SNIPPET.format(root=ROOT)],
+        env=env, cwd=ROOT, capture_output=True, text=True, check=True
+    ).stdout
+    return float(output.strip().splitlines()[-1])
+
+
+def get_health(port):
+    try:
+        with urllib.request.urlopen(f"http://127.0.0.1:{port}/health", timeout=1) as response:
+            return response.status, json.loads(response.read())
+    except Exception:
+        return None, None
+
+
+def measure_serve(env, timeout):
+    """(секунды до первого 200, секунды до llm_warm или None)"""
+    port = free_port()
+    env = dict(env, PORT=str(port))
+    started = time.perf_counter()
+    process = subprocess.Popen([sys.executable, "app.py"], env=env, cwd=ROOT,
+                               stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+    first_ok = warm = None
+    try:
+        while time.perf_counter() - started < timeout:
+            status, body = get_health(port)
+            now = time.perf_counter() - started
+            if status == 200 and first_ok is None:
+                first_ok = now
+            if body and body.get("llm_warm"):
+                warm = now
+                break
+            time.sleep(0.01)
+    finally:
+        process.terminate()
+        process.wait(10)
+    return first_ok, warm
+
+
+def fmt(values):
+    values = [value for value in values if value is not None]
+    if not values:
+        return "      -"
+    return f"{statistics.median(values) * 1000:7.0f}"
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--runs", type=int, default=5)
+    parser.add_argument("--timeout", type=float, default=30.0)
+    args = parser.parse_args()
+
+    telegram = FakeTelegram().start()
+    workdir = tempfile.mkdtemp()
+    # Первый запуск прогревает файловый кэш и .pyc, в замер не идет
+    measure_import(base_env(telegram.url, workdir, warmup=False))
+
+    print(f"{'режим':<16}{'import мс':>10}{'first 200 мс':>14}{'warm мс':>10}   (медиана из {args.runs})")
+    for warmup in (False, True):
+        env = base_env(telegram.url, workdir, warmup)
+        imports, firsts, warms = [], [], []
+        for _ in range(args.runs):
+            imports.append(measure_import(env))
+            first_ok, warm = measure_serve(env, args.timeout)
+            firsts.append(first_ok)
+            warms.append(warm)
+        name = "LLM_WARMUP=1" if warmup else "LLM_WARMUP=0"
+        print(f"{name:<16}{fmt(imports):>10}{fmt(firsts):>14}{fmt(warms):>10}")
+    telegram.stop()
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,114 @@
+"""Пропускная способность при нескольких воркерах на общей базе состояния.
+
+Запускает N процессов-воркеров (как синхронные воркеры gunicorn) с
+SESSION_BACKEND=sqlite и общей базой. Каждый чат проходит сценарий
+/start -> курс -> урок -> M сообщений; очередной update чата попадает к
+любому свободному воркеру, так что чаты постоянно переходят между
+процессами. Gemini заменен заглушкой с задержкой, Telegram - локальным
+сервером.
+
+В конце проверяется, что история урока каждого чата в базе полная, то есть
+аренда чатов и сброс кэшей при переходе работают.
+
+    python benchmarks/bench_workers.py --workers 1 2 4 --chats 64 --messages 4
+"""
+import argparse
+import multiprocessing
+import os
+import sys
+import tempfile
+import time
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+
+from fake_telegram import FakeTelegram  # noqa: E402
+
+app = None
+
+
+def init_worker(env):
+    global app
+    os.environ.update(env)
+    sys.path.insert(0, ROOT)
+    import app as app_module
+    app = app_module
+
+
+def handle(update):
+    return app.process_update(update).get("status")
+
+
+def chat_script(chat_id, messages):
+    message = {"chat": {"id": chat_id}, "message_id": 1}
+    updates = [
+        {"message": dict(message, text="/start")},
+        {"callback_query": {"id": f"{chat_id}-c", "data": "c:1", "message": message}},
+        {"callback_query": {"id": f"{chat_id}-l", "data": "l:1", "message": message}},
+    ]
+    for i in range(messages):
+        updates.append({"message": dict(message, text=f"вопрос {i} от {chat_id}")})
+    return updates
+
+
+def run(workers, chats, messages, llm_latency, telegram_url):
+    db_path = os.path.join(tempfile.mkdtemp(), "state.db")
+    env = {
+        "TELEGRAM_TOKEN": "bench",
+        "TELEGRAM_API_URL": telegram_url,
+        "TELEGRAM_GLOBAL_RATE": "100000",
+        "TELEGRAM_CHAT_RATE": "100000",
+        "TELEGRAM_CHAT_BURST": "100000",
+        "LLM_BACKEND": "fake",
+        "FAKE_LLM_LATENCY": str(llm_latency),
+        "STATE_DB_PATH": db_path,
+        "SESSION_BACKEND": "sqlite",
+        "RESPONSE_CACHE_MAX_PROMPT": "0",
+        "LESSON_OPENERS_PATH": os.path.join(os.path.dirname(db_path), "none.json"),
+    }
+    scripts = [chat_script(chat_id, messages) for chat_id in range(1, chats + 1)]
+
+    context = multiprocessing.get_context("spawn")
+    with context.Pool(workers, initializer=init_worker, initargs=(env,)) as pool:
+        # Дожидаемся, пока все воркеры импортируют приложение
+        pool.map(time.sleep, [0.2] * workers * 2, chunksize=1)
+        started = time.perf_counter()
+        statuses = []
+        for step in range(len(scripts[0])):
+            statuses += pool.map(handle, [script[step] for script in scripts], chunksize=1)
+        elapsed = time.perf_counter() - started
+
+    os.environ["STATE_DB_PATH"] = db_path
+    from state_store import StateStore
+    store = StateStore(db_path)
+    broken = 0
+    for chat_id in range(1, chats + 1):
+        lesson = store.load("lesson", chat_id)
+        if not isinstance(lesson, dict) or lesson.get("conversation_total") != 2 * messages:
+            broken += 1
+    store.close()
+    errors = sum(1 for status in statuses if status != "ok")
+    return len(statuses) / elapsed, errors, broken
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--workers", type=int, nargs="+", default=[1, 2, 4])
+    parser.add_argument("--chats", type=int, default=64)
+    parser.add_argument("--messages", type=int, default=4)
+    parser.add_argument("--llm-latency", type=float, default=0.05)
+    args = parser.parse_args()
+
+    telegram = FakeTelegram().start()
+    baseline = None
+    for workers in args.workers:
+        throughput, errors, broken = run(workers, args.chats, args.messages, args.llm_latency, telegram.url)
+        baseline = baseline or throughput
+        print(f"workers={workers:>2}  {throughput:7.1f} update/с  x{throughput / baseline:.2f}  "
+              f"ошибок: {errors}  чатов с неполной историей: {broken}")
+    telegram.stop()
+
+
+if __name__ == "__main__":
+    main()
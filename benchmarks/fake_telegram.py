@@ -0,0 +1,126 @@
+"""Локальная заглушка Bot API для бенчмарков.
+
+Отвечает успехом на любой метод, для sendMessage выдает новые message_id
+и считает вызовы по методам. Приложение направляется на нее через
+TELEGRAM_API_URL=http://127.0.0.1:<порт>.
+
+Чтобы нагрузка была похожа на настоящую, заглушка умеет:
+- отвечать с задержкой (latency + случайная добавка до jitter);
+- с вероятностью rate_limit_rate отвечать 429 с parameters.retry_after;
+- с вероятностью not_modified_rate отвечать на editMessageText ошибкой
+  "message is not modified".
+Последние вызовы (метод, payload) лежат в recent - по ним тесты проверяют,
+что именно ушло в Telegram.
+Случайность берется из генератора с seed, поэтому прогоны повторяемы.
+"""
+import itertools
+import json
+import random
+import threading
+import time
+from collections import Counter, deque
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+# Служебные методы ошибок не получают - иначе ломается проверка /health
+NEVER_FAIL = {"getMe"}
+
+
+class FakeTelegram:
+    def __init__(self, host="127.0.0.1", port=0, latency=0.0, jitter=0.0,
+                 rate_limit_rate=0.0, retry_after=1, not_modified_rate=0.0, seed=None, recent=1000):
+        self.latency = latency
+        self.jitter = jitter
+        self.rate_limit_rate = rate_limit_rate
+        self.retry_after = retry_after
+        self.not_modified_rate = not_modified_rate
+        self.calls = Counter()
+        self.injected = Counter()
+        self.recent = deque(maxlen=recent)
+        self._random = random.Random(seed)
+        self._message_ids = itertools.count(1000)
+        self._lock = threading.Lock()
+        self._server = ThreadingHTTPServer((host, port), self._handler_class())
+        self._server.daemon_threads = True
+        self._thread = None
+
+    @property
+    def url(self):
+        host, port = self._server.server_address[:2]
+        return f"http://{host}:{port}"
+
+    def _handler_class(self):
+        fake = self
+
+        class Handler(BaseHTTPRequestHandler):
+            protocol_version = "HTTP/1.1"
+
+            def do_POST(self):
+                length = int(self.headers.get("Content-Length", 0))
+                payload = json.loads(self.rfile.read(length) or b"{}")
+                method = self.path.rsplit("/", 1)[-1]
+                status, body = fake.respond(method, payload)
+                data = json.dumps(body).encode()
+                self.send_response(status)
+                self.send_header("Content-Type", "application/json")
+                self.send_header("Content-Length", str(len(data)))
+                self.end_headers()
+                self.wfile.write(data)
+
+            def log_message(self, *args):
+                pass
+
+        return Handler
+
+    def _draw(self):
+        """(задержка, случайное число для ошибок) - под блокировкой, чтобы seed работал"""
+        with self._lock:
+            return self.latency + self._random.uniform(0, self.jitter), self._random.random()
+
+    def respond(self, method, payload):
+        delay, roll = self._draw()
+        if delay > 0:
+            time.sleep(delay)
+        with self._lock:
+            self.calls[method] += 1
+            self.recent.append((method, payload))
+
+        if method not in NEVER_FAIL:
+            if roll < self.rate_limit_rate:
+                with self._lock:
+                    self.injected["429"] += 1
+                return 429, {
+                    "ok": False,
+                    "error_code": 429,
+                    "description": f"Too Many Requests: retry after {self.retry_after}",
+                    "parameters": {"retry_after": self.retry_after}
+                }
+            if method == "editMessageText" and roll < self.rate_limit_rate + self.not_modified_rate:
+                with self._lock:
+                    self.injected["not_modified"] += 1
+                return 400, {
+                    "ok": False,
+                    "error_code": 400,
+                    "description": "Bad Request: message is not modified: specified new message "
+                                   "content and reply markup are exactly the same"
+                }
+
+        if method == "sendMessage":
+            return 200, {"ok": True, "result": {"message_id": next(self._message_ids)}}
+        if method == "getMe":
+            return 200, {"ok": True, "result": {"id": 1, "is_bot": True, "username": "fake_bot"}}
+        return 200, {"ok": True, "result": True}
+
+    def reset(self):
+        with self._lock:
+            self.calls.clear()
+            self.injected.clear()
+            self.recent.clear()
+
+    def start(self):
+        self._thread = threading.Thread(target=self._server.serve_forever, name="fake-telegram", daemon=True)
+        self._thread.start()
+        return self
+
+    def stop(self):
+        self._server.shutdown()
+        self._server.server_close()
@@ -0,0 +1,98 @@
+"""Локальная заглушка индексатора TON (формат toncenter API v3).
+
+GET /transactions?account=...&start_lt=...&limit=...&sort=asc отдает
+транзакции кошелька постранично, как настоящий индексатор. Переводы
+добавляются через add_transfer(); приложение направляется на заглушку
+через TON_INDEXER_URL=http://127.0.0.1:<порт>.
+"""
+import itertools
+import json
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import parse_qs, urlparse
+
+
+class FakeTonIndexer:
+    def __init__(self, host="127.0.0.1", port=0):
+        self.transactions = []
+        self.requests = 0
+        self._lt = itertools.count(1000, 7)
+        self._lock = threading.Lock()
+        self._server = ThreadingHTTPServer((host, port), self._handler_class())
+        self._server.daemon_threads = True
+        self._thread = None
+
+    @property
+    def url(self):
+        host, port = self._server.server_address[:2]
+        return f"http://{host}:{port}"
+
+    def add_transfer(self, comment, amount, source="EQfakeSender", aborted=False):
+        with self._lock:
+            lt = next(self._lt)
+            self.transactions.append({
+                "hash": f"tx{lt}",
+                "lt": str(lt),
+                "now": int(time.time()),
+                "description": {"aborted": aborted},
+                "in_msg": {
+                    "source": source,
+                    "value": str(amount),
+                    "message_content": {"decoded": {"type": "text_comment", "comment": comment}}
+                        if comment is not None else {}
+                }
+            })
+            return lt
+
+    def add_external(self):
+        """Транзакция без входящего перевода (например, отправка с кошелька)"""
+        with self._lock:
+            lt = next(self._lt)
+            self.transactions.append({"hash": f"tx{lt}", "lt": str(lt), "now": int(time.time()),
+                                      "in_msg": {"source": None, "value": "0"}})
+            return lt
+
+    def _handler_class(self):
+        fake = self
+
+        class Handler(BaseHTTPRequestHandler):
+            protocol_version = "HTTP/1.1"
+
+            def do_GET(self):
+                url = urlparse(self.path)
+                query = {key: values[0] for key, values in parse_qs(url.query).items()}
+                if not url.path.endswith("/transactions"):
+                    status, body = 404, {"error": "not found"}
+                else:
+                    status, body = 200, fake.page(query)
+                data = json.dumps(body).encode()
+                self.send_response(status)
+                self.send_header("Content-Type", "application/json")
+                self.send_header("Content-Length", str(len(data)))
+                self.end_headers()
+                self.wfile.write(data)
+
+            def log_message(self, *args):
+                pass
+
+        return Handler
+
+    def page(self, query):
+        start_lt = int(query.get("start_lt", 0))
+        limit = int(query.get("limit", 100))
+        offset = int(query.get("offset", 0))
+        with self._lock:
+            self.requests += 1
+            matching = [tx for tx in self.transactions if int(tx["lt"]) >= start_lt]
+        matching.sort(key=lambda tx: int(tx["lt"]), reverse=query.get("sort") == "desc")
+        return {"transactions": matching[offset:offset + limit]}
+
+    def start(self):
+        self._thread = threading.Thread(target=self._server.serve_forever, name="fake-ton-indexer", daemon=True)
+        self._thread.start()
+        return self
+
+    def stop(self):
+        self._server.shutdown()
+        self._server.server_close()
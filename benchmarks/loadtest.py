@@ -0,0 +1,287 @@
+"""Нагрузочный тест вебхука без настоящих Telegram и Gemini.
+
+Приложение запускается в этом же процессе против локальной заглушки Bot API
+(fake_telegram.py) и заглушки LLM (LLM_BACKEND=fake). Генератор строит
+реалистичные сценарии пользователей: /start, нажатия меню, урок с
+несколькими вопросами, чат с NeuroPartner. Сценарии проигрываются через
+POST /webhook, сообщения одного чата идут по порядку, как их доставляет
+Telegram, разные чаты - параллельно.
+
+Отчет: p50/p95/p99 времени ответа вебхука (всего и по видам update),
+update/с, вызовов Bot API на update, рост памяти процесса.
+
+Результаты повторяемы: сценарии, задержки заглушек и внедряемые ошибки
+берутся из генераторов с --seed, перед замером идет прогрев. Для сравнения
+версий удобно сохранять отчет в JSON:
+
+    python benchmarks/loadtest.py --users 200 --concurrency 32 --json before.json
+    python benchmarks/loadtest.py --users 200 --concurrency 32 --tg-429 0.02 --tg-not-modified 0.1
+"""
+import argparse
+import gc
+import json
+import math
+import os
+import random
+import resource
+import sys
+import tempfile
+import threading
+import time
+from collections import defaultdict
+from concurrent.futures import ThreadPoolExecutor
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+
+from fake_telegram import FakeTelegram  # noqa: E402
+
+QUESTIONS = [
+    "Что такое нейросеть?",
+    "А можно пример попроще?",
+    "Как это применить в работе?",
+    "Почему так происходит?",
+    "Объясни еще раз, пожалуйста",
+    "Какие здесь бывают ошибки?",
+]
+
+IDEAS = [
+    "Хочу сделать бота для записи к врачу",
+    "Как продвигать канал про нейросети?",
+    "Помоги составить план запуска продукта",
+    "Какую нишу выбрать для AI-сервиса?",
+]
+
+
+class Workload:
+    """Сценарии пользователей: список (вид, update) на каждый чат"""
+
+    def __init__(self, seed, lessons, questions=4, ideas=2):
+        self._random = random.Random(seed)
+        self.lessons = lessons
+        self.questions = questions
+        self.ideas = ideas
+        self._update_id = 0
+
+    def _next_id(self):
+        self._update_id += 1
+        return self._update_id
+
+    def _message(self, chat_id, text):
+        return {"update_id": self._next_id(), "message": {
+            "message_id": self._update_id, "chat": {"id": chat_id}, "from": {"id": chat_id}, "text": text
+        }}
+
+    def _callback(self, chat_id, data):
+        return {"update_id": self._next_id(), "callback_query": {
+            "id": f"q{self._update_id}", "data": data, "from": {"id": chat_id},
+            "message": {"message_id": 1, "chat": {"id": chat_id}}
+        }}
+
+    def user(self, chat_id):
+        rnd = self._random
+        steps = [("start", self._message(chat_id, "/start"))]
+        for _ in range(rnd.randint(1, 3)):
+            flow = rnd.choices(("lesson", "neuropartner", "menu"), weights=(6, 3, 2))[0]
+            if flow == "lesson":
+                steps.append(("menu", self._callback(chat_id, "c:1")))
+                steps.append(("menu", self._callback(chat_id, f"l:{rnd.choice(self.lessons)}")))
+                for _ in range(rnd.randint(1, self.questions)):
+                    steps.append(("lesson", self._message(chat_id, rnd.choice(QUESTIONS))))
+                steps.append(("menu", self._callback(chat_id, "menu_course_back")))
+            elif flow == "neuropartner":
+                steps.append(("menu", self._callback(chat_id, "menu_neuropartner")))
+                for _ in range(rnd.randint(1, self.ideas)):
+                    steps.append(("neuropartner", self._message(chat_id, rnd.choice(IDEAS))))
+            else:
+                for data in rnd.sample(("menu_profile", "menu_premium", "menu_main"), 2):
+                    steps.append(("menu", self._callback(chat_id, data)))
+            steps.append(("menu", self._callback(chat_id, "menu_main")))
+        return steps
+
+
+def setup_env(args, telegram_url, workdir):
+    os.environ.update({
+        "TELEGRAM_TOKEN": "loadtest",
+        "TELEGRAM_API_URL": telegram_url,
+        # Лимиты Bot API изображает заглушка (--tg-429), свои снимаем
+        "TELEGRAM_GLOBAL_RATE": str(args.telegram_rate),
+        "TELEGRAM_CHAT_RATE": str(args.telegram_rate),
+        "TELEGRAM_CHAT_BURST": str(int(args.telegram_rate)),
+        "LLM_BACKEND": "fake",
+        "FAKE_LLM_LATENCY": str(args.llm_latency),
+        "FAKE_LLM_JITTER": str(args.llm_jitter),
+        "FAKE_LLM_DISTRIBUTION": args.llm_distribution,
+        "FAKE_LLM_FAILURE_RATE": str(args.llm_failures),
+        "FAKE_LLM_SEED": str(args.seed),
+        "LESSON_OPENERS_PATH": os.path.join(workdir, "none.json"),
+        "ASYNC_WEBHOOK": "0",
+    })
+    if args.state_db:
+        os.environ["STATE_DB_PATH"] = os.path.join(workdir, "state.db")
+    if args.stream:
+        os.environ["STREAM_REPLIES"] = "1"
+
+
+def rss_mb():
+    """Текущий RSS процесса (Linux) или пиковый, если /proc недоступен"""
+    try:
+        with open("/proc/self/statm") as f:
+            return int(f.read().split()[1]) * os.sysconf("SC_PAGE_SIZE") / 2 ** 20
+    except (OSError, ValueError):
+        peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+        return peak / 2 ** 20 if sys.platform == "darwin" else peak / 1024
+
+
+def percentile(values, q):
+    if not values:
+        return 0.0
+    ordered = sorted(values)
+    # Ближайший ранг: без интерполяции, одинаково для любых версий Python
+    index = min(len(ordered) - 1, max(0, math.ceil(q / 100 * len(ordered)) - 1))
+    return ordered[index]
+
+
+def settle(app, telegram, timeout=30.0):
+    """Ждет, пока фоновые вызовы (answerCallbackQuery, deleteMessage) закончатся"""
+    deadline = time.monotonic() + timeout
+    last, quiet_since = None, time.monotonic()
+    while time.monotonic() < deadline:
+        stats = app.outbound.stats()
+        pending = stats["pending_interactive"] + stats["pending_background"] + stats["in_flight"]
+        total = sum(telegram.calls.values())
+        if total != last or pending:
+            last, quiet_since = total, time.monotonic()
+        elif time.monotonic() - quiet_since > 0.3:
+            return
+        time.sleep(0.05)
+
+
+def replay(app, users, concurrency):
+    """Проигрывает сценарии; возвращает ({вид: [секунды]}, статусы, время)"""
+    latencies = defaultdict(list)
+    statuses = defaultdict(int)
+    lock = threading.Lock()
+    local = threading.local()
+
+    def run_user(steps):
+        client = getattr(local, "client", None)
+        if client is None:
+            client = local.client = app.app.test_client()
+        for kind, update in steps:
+            started = time.perf_counter()
+            response = client.post("/webhook", json=update)
+            elapsed = time.perf_counter() - started
+            status = (response.get_json(silent=True) or {}).get("status", response.status_code)
+            with lock:
+                latencies[kind].append(elapsed)
+                statuses[status] += 1
+
+    started = time.perf_counter()
+    with ThreadPoolExecutor(concurrency) as pool:
+        for future in [pool.submit(run_user, steps) for steps in users]:
+            future.result()
+    return latencies, statuses, time.perf_counter() - started
+
+
+def summarize(values):
+    return {
+        "count": len(values),
+        "p50_ms": round(percentile(values, 50) * 1000, 2),
+        "p95_ms": round(percentile(values, 95) * 1000, 2),
+        "p99_ms": round(percentile(values, 99) * 1000, 2),
+        "max_ms": round(max(values) * 1000, 2) if values else 0.0,
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--users", type=int, default=100)
+    parser.add_argument("--warmup-users", type=int, default=10)
+    parser.add_argument("--concurrency", type=int, default=16)
+    parser.add_argument("--seed", type=int, default=1)
+    parser.add_argument("--llm-latency", type=float, default=0.2, help="медиана/среднее задержки LLM, с")
+    parser.add_argument("--llm-jitter", type=float, default=0.5)
+    parser.add_argument("--llm-distribution", default="lognormal", choices=("uniform", "lognormal", "exponential"))
+    parser.add_argument("--llm-failures", type=float, default=0.0)
+    parser.add_argument("--tg-latency", type=float, default=0.01)
+    parser.add_argument("--tg-jitter", type=float, default=0.02)
+    parser.add_argument("--tg-429", type=float, default=0.0, help="доля ответов 429")
+    parser.add_argument("--tg-retry-after", type=float, default=1.0)
+    parser.add_argument("--tg-not-modified", type=float, default=0.0,
+                        help="доля editMessageText с ответом 'message is not modified'")
+    parser.add_argument("--telegram-rate", type=float, default=100000,
+                        help="лимиты исходящих вызовов приложения (вызовов/с)")
+    parser.add_argument("--state-db", action="store_true", help="хранить состояние в SQLite")
+    parser.add_argument("--stream", action="store_true", help="STREAM_REPLIES=1")
+    parser.add_argument("--json", help="сохранить отчет в файл")
+    args = parser.parse_args()
+
+    telegram = FakeTelegram(
+        latency=args.tg_latency, jitter=args.tg_jitter,
+        rate_limit_rate=args.tg_429, retry_after=args.tg_retry_after,
+        not_modified_rate=args.tg_not_modified, seed=args.seed
+    ).start()
+    setup_env(args, telegram.url, tempfile.mkdtemp())
+
+    rss_before_import = rss_mb()
+    import app  # noqa: E402
+
+    lessons = [lesson.id for lesson in app.catalog.course(1).lessons]
+    workload = Workload(args.seed, lessons)
+    warmup = [workload.user(chat_id) for chat_id in range(1, args.warmup_users + 1)]
+    first_chat = args.warmup_users + 1
+    users = [workload.user(chat_id) for chat_id in range(first_chat, first_chat + args.users)]
+
+    replay(app, warmup, args.concurrency)
+    settle(app, telegram)
+    telegram.reset()
+    gc.collect()
+    rss_before = rss_mb()
+
+    latencies, statuses, elapsed = replay(app, users, args.concurrency)
+    settle(app, telegram)
+    gc.collect()
+    rss_after = rss_mb()
+
+    everything = [value for values in latencies.values() for value in values]
+    updates = len(everything)
+    outbound_calls = sum(count for method, count in telegram.calls.items() if method != "getMe")
+    report = {
+        "config": vars(args),
+        "updates": updates,
+        "elapsed_s": round(elapsed, 3),
+        "updates_per_s": round(updates / elapsed, 1),
+        "latency": summarize(everything),
+        "latency_by_kind": {kind: summarize(values) for kind, values in sorted(latencies.items())},
+        "statuses": dict(statuses),
+        "telegram_calls_per_update": round(outbound_calls / updates, 3),
+        "telegram_calls": dict(telegram.calls),
+        "telegram_injected": dict(telegram.injected),
+        "llm_calls": app.llm_backend.calls,
+        "rss_import_mb": round(rss_before - rss_before_import, 1),
+        "rss_growth_mb": round(rss_after - rss_before, 1),
+        "rss_growth_kb_per_user": round((rss_after - rss_before) * 1024 / max(1, args.users), 1),
+    }
+
+    print(f"update: {updates} за {elapsed:.2f} с - {report['updates_per_s']} update/с, "
+          f"пользователей {args.users}, параллельно {args.concurrency}")
+    print(f"{'вид':<14}{'кол-во':>8}{'p50 мс':>10}{'p95 мс':>10}{'p99 мс':>10}{'max мс':>10}")
+    for kind, row in [("все", report["latency"])] + list(report["latency_by_kind"].items()):
+        print(f"{kind:<14}{row['count']:>8}{row['p50_ms']:>10}{row['p95_ms']:>10}{row['p99_ms']:>10}{row['max_ms']:>10}")
+    print(f"вызовов Bot API на update: {report['telegram_calls_per_update']}  {report['telegram_calls']}")
+    if report["telegram_injected"]:
+        print(f"внедренные ошибки: {report['telegram_injected']}")
+    print(f"статусы: {report['statuses']}")
+    print(f"память: +{report['rss_growth_mb']} МБ за прогон ({report['rss_growth_kb_per_user']} КБ на пользователя)")
+
+    if args.json:
+        with open(args.json, "w", encoding="utf-8") as f:
+            json.dump(report, f, ensure_ascii=False, indent=2)
+
+    telegram.stop()
+
+
+if __name__ == "__main__":
+    main()
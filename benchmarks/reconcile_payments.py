@@ -0,0 +1,122 @@
+"""Проверка сверки платежей TON на заглушке индексатора.
+
+Индексатор отдает P переводов: оплаты премиума (в том числе с переплатой
+на несколько месяцев), недоплаты, переводы без комментария, внешние и
+неуспешные транзакции. Сверка идет страницами, затем журнал открывается
+заново (как после рестарта) и опрашивает индексатор еще раз, плюс второй
+"процесс" опрашивает ту же базу параллельно. В конце проверяется, что
+ничего не учтено дважды, суммы совпадают с ожидаемыми, курсор дошел до
+конца, и измеряется стоимость is_premium.
+
+    python benchmarks/reconcile_payments.py --payments 2000 --page-size 100
+"""
+import argparse
+import os
+import random
+import sys
+import tempfile
+import threading
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+
+from fake_ton_indexer import FakeTonIndexer  # noqa: E402
+from payments import NANO, PaymentLedger, ReconciliationPoller, TonIndexerClient  # noqa: E402
+
+PRICE = 10 * NANO
+FUND_SHARE = 0.5
+
+
+def fill(indexer, count, users, seed):
+    """Добавляет переводы; возвращает ожидаемые (доход, фонд, число платежей, премиум-чаты)"""
+    rnd = random.Random(seed)
+    income = fund = payments = 0
+    premium = set()
+    for _ in range(count):
+        kind = rnd.choices(("premium", "multi", "under", "nocomment", "external", "aborted"),
+                           weights=(70, 5, 5, 10, 5, 5))[0]
+        chat_id = rnd.randint(1, users)
+        if kind == "external":
+            indexer.add_external()
+            continue
+        amount = {"premium": PRICE, "multi": 3 * PRICE, "under": PRICE // 2}.get(kind, rnd.randint(1, 5) * NANO)
+        comment = None if kind == "nocomment" else f"premium_{chat_id}"
+        indexer.add_transfer(comment, amount, aborted=kind == "aborted")
+        if kind == "aborted":
+            continue
+        income += amount
+        fund += int(amount * FUND_SHARE)
+        payments += 1
+        if kind in ("premium", "multi"):
+            premium.add(chat_id)
+    return income, fund, payments, premium
+
+
+def open_poller(db_path, indexer_url, page_size, on_payment=None):
+    ledger = PaymentLedger(db_path, price=PRICE, period=10 * 365 * 86400, fund_share=FUND_SHARE)
+    client = TonIndexerClient(indexer_url, "EQwallet", page_size=page_size)
+    return ReconciliationPoller(ledger, client, on_payment=on_payment, max_pages=10 ** 6)
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--payments", type=int, default=2000)
+    parser.add_argument("--users", type=int, default=300)
+    parser.add_argument("--page-size", type=int, default=100)
+    parser.add_argument("--seed", type=int, default=1)
+    args = parser.parse_args()
+
+    indexer = FakeTonIndexer().start()
+    db_path = os.path.join(tempfile.mkdtemp(), "state.db")
+    half = args.payments // 2
+    expected = fill(indexer, half, args.users, args.seed)
+
+    notified = []
+    started = time.perf_counter()
+    first = open_poller(db_path, indexer.url, args.page_size, notified.append)
+    first.poll_once()
+    elapsed = time.perf_counter() - started
+
+    # Еще переводы, затем рестарт первого и параллельный второй процесс
+    more = fill(indexer, args.payments - half, args.users, args.seed + 1)
+    expected = (expected[0] + more[0], expected[1] + more[1], expected[2] + more[2], expected[3] | more[3])
+    first.ledger.close()
+    restarted = open_poller(db_path, indexer.url, args.page_size, notified.append)
+    other = open_poller(db_path, indexer.url, args.page_size, notified.append)
+    threads = [threading.Thread(target=poller.poll_once) for poller in (restarted, other)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    restarted.poll_once()
+
+    ledger = restarted.ledger
+    totals = ledger.totals()
+    income, fund, payments, premium = expected
+    checks = {
+        "доход": totals["total_income"] == income,
+        "фонд": totals["development_fund"] == fund,
+        "платежей": totals["payments"] == payments,
+        "уведомлений (без повторов)": len(notified) == payments,
+        "премиум": {chat for chat in range(1, args.users + 1) if ledger.is_premium(chat)} == premium,
+        "курсор": ledger.cursor == max(int(tx["lt"]) for tx in indexer.transactions),
+    }
+
+    iterations = 200000
+    lookup_started = time.perf_counter()
+    for i in range(iterations):
+        ledger.is_premium(i % args.users)
+    lookup_ns = (time.perf_counter() - lookup_started) / iterations * 1e9
+
+    print(f"транзакций: {len(indexer.transactions)}, запросов к индексатору: {indexer.requests}, "
+          f"первая сверка: {elapsed * 1000:.0f} мс")
+    for name, ok in checks.items():
+        print(f"{'OK ' if ok else 'FAIL'} {name}")
+    print(f"is_premium: {lookup_ns:.0f} нс")
+    indexer.stop()
+    sys.exit(0 if all(checks.values()) else 1)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,120 @@
+"""Нагрузочная проверка блокировок состояния.
+
+Много потоков одновременно меняют состояние одного чата и множества
+чатов (реплики урока, шаги, прогресс, сохранение/восстановление урока),
+пока фоновый поток пишет состояние в SQLite. В конце проверяются
+инварианты: ни одна реплика и ни один пройденный урок не потеряны, баллы
+не начислены дважды, база совпадает с памятью.
+
+Telegram не нужен, Gemini заменен заглушкой:
+    python benchmarks/stress_state.py --threads 32 --chats 200 --rounds 50
+"""
+import argparse
+import json
+import os
+import sys
+import tempfile
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+
+def setup_env(db_path):
+    os.environ["LLM_BACKEND"] = "fake"
+    os.environ["FAKE_LLM_LATENCY"] = "0.001"
+    os.environ["TELEGRAM_TOKEN"] = "stress"
+    os.environ["STATE_DB_PATH"] = db_path
+    os.environ["STATE_FLUSH_INTERVAL"] = "0.01"
+    os.environ["LESSON_OPENERS_PATH"] = os.path.join(os.path.dirname(db_path), "none.json")
+    os.environ["RESPONSE_CACHE_MAX_PROMPT"] = "0"
+    os.environ["CONVERSATION_CAPACITY"] = "100000"
+
+
+def lesson_turns(app, chat_id, lesson, rounds):
+    """Реплика ученика + ответ учителя, rounds раз"""
+    for i in range(rounds):
+        app.update_lesson_state(chat_id, lesson.title, app.USER_LESSON_STATE[chat_id]["step"], f"вопрос {i}")
+        app.menu_manager.get_dialog_lesson(chat_id, lesson.title, f"вопрос {i}")
+
+
+def progress_all(app, chat_id):
+    for lesson in app.catalog.iter_lessons():
+        app.update_user_progress(chat_id, lesson.id)
+
+
+def save_restore(app, chat_id, rounds):
+    for _ in range(rounds):
+        app.save_lesson_progress(chat_id)
+        app.get_user_progress(chat_id)
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--threads", type=int, default=32)
+    parser.add_argument("--chats", type=int, default=200)
+    parser.add_argument("--rounds", type=int, default=20)
+    parser.add_argument("--switch-interval", type=float, default=1e-6,
+                        help="интервал переключения потоков GIL: чем меньше, тем чаще гонки")
+    args = parser.parse_args()
+    sys.setswitchinterval(args.switch_interval)
+
+    tmp = tempfile.mkdtemp()
+    setup_env(os.path.join(tmp, "stress.db"))
+    import app
+
+    lesson = next(app.catalog.iter_lessons())
+    total_lessons = sum(1 for _ in app.catalog.iter_lessons())
+    hot_chat = -1
+    chats = [hot_chat] + list(range(1, args.chats + 1))
+    for chat_id in chats:
+        app.USER_LESSON_STATE[chat_id] = app.new_lesson_state(lesson)
+
+    started = time.perf_counter()
+    with ThreadPoolExecutor(max_workers=args.threads) as pool:
+        futures = []
+        # Один "горячий" чат: все потоки пишут в него одновременно
+        for _ in range(args.threads):
+            futures.append(pool.submit(lesson_turns, app, hot_chat, lesson, args.rounds))
+            futures.append(pool.submit(progress_all, app, hot_chat))
+            futures.append(pool.submit(save_restore, app, hot_chat, args.rounds))
+        # Много чатов параллельно
+        for chat_id in chats[1:]:
+            futures.append(pool.submit(lesson_turns, app, chat_id, lesson, 2))
+            futures.append(pool.submit(progress_all, app, chat_id))
+    elapsed = time.perf_counter() - started
+
+    errors = [f"исключение: {future.exception()!r}" for future in futures if future.exception()]
+    expected_hot = 2 * args.threads * args.rounds
+    hot_total = app.USER_LESSON_STATE[hot_chat]["conversation"].total
+    if hot_total != expected_hot:
+        errors.append(f"горячий чат: {hot_total} реплик вместо {expected_hot}")
+    for chat_id in chats:
+        progress = app.USER_PROGRESS[chat_id]
+        if progress["пройдено"] != total_lessons or progress["баллы"] != 10 * total_lessons:
+            errors.append(f"чат {chat_id}: прогресс {progress}")
+        if chat_id != hot_chat and app.USER_LESSON_STATE[chat_id]["conversation"].total != 4:
+            errors.append(f"чат {chat_id}: {app.USER_LESSON_STATE[chat_id]['conversation'].total} реплик вместо 4")
+
+    try:
+        app.state_store.flush()
+    except Exception as e:
+        errors.append(f"запись в базу: {e!r}")
+    for chat_id in (hot_chat, chats[-1]):
+        stored = app.state_store.load("progress", chat_id)
+        if stored != json.loads(json.dumps(app.USER_PROGRESS[chat_id], ensure_ascii=False)):
+            errors.append(f"чат {chat_id}: в базе {stored}")
+
+    updates = len(futures)
+    print(f"{updates} задач в {args.threads} потоках за {elapsed:.2f} с, "
+          f"записей в базу: {app.state_store.rows_written}")
+    if errors:
+        print("ОШИБКИ:")
+        for error in errors[:20]:
+            print(" ", error)
+        sys.exit(1)
+    print("OK: состояние согласовано")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,143 @@
+"""Каталог курсов с индексами для обработки меню за O(1).
+
+Курсы загружаются из courses.json. При загрузке строятся индексы
+id -> курс, id -> урок и название урока -> урок, поэтому ни один обработчик
+не перебирает списки уроков.
+
+callback_data кодируется короткими числовыми id ("c:1", "c:1:2", "l:7"),
+что укладывается в лимит Telegram 64 байта при любых названиях курсов.
+
+Прогресс по курсу хранится битовой маской: бит i - урок с позицией i в
+курсе. Новые уроки нужно добавлять в конец списка, иначе сохраненные маски
+укажут не на те уроки.
+"""
+import json
+
+# Курс до 12 уроков помещается в одну клавиатуру без листания
+LESSONS_PER_PAGE = 12
+COURSES_PER_PAGE = 8
+
+
+class Lesson:
+    __slots__ = ("id", "title", "course", "index")
+
+    def __init__(self, lesson_id, title, course, index):
+        self.id = lesson_id
+        self.title = title
+        self.course = course
+        self.index = index
+
+    @property
+    def bit(self):
+        return 1 << self.index
+
+
+class Course:
+    __slots__ = ("id", "name", "level", "description", "lessons")
+
+    def __init__(self, course_id, name, level, description):
+        self.id = course_id
+        self.name = name
+        self.level = level
+        self.description = description
+        self.lessons = []
+
+    def pages(self, per_page=LESSONS_PER_PAGE):
+        return max(1, -(-len(self.lessons) // per_page))
+
+
+class Catalog:
+    def __init__(self, courses_data):
+        self.courses = []
+        self._courses_by_id = {}
+        self._courses_by_name = {}
+        self._lessons_by_id = {}
+        self._lessons_by_title = {}
+
+        for course_data in courses_data:
+            course = Course(
+                course_data["id"], course_data["name"],
+                course_data.get("level", ""), course_data.get("description", "")
+            )
+            if course.id in self._courses_by_id:
+                raise ValueError(f"Duplicate course id {course.id}")
+            for index, lesson_data in enumerate(course_data.get("lessons", [])):
+                lesson = Lesson(lesson_data["id"], lesson_data["title"], course, index)
+                if lesson.id in self._lessons_by_id:
+                    raise ValueError(f"Duplicate lesson id {lesson.id}")
+                course.lessons.append(lesson)
+                self._lessons_by_id[lesson.id] = lesson
+                self._lessons_by_title.setdefault(lesson.title, lesson)
+            self.courses.append(course)
+            self._courses_by_id[course.id] = course
+            self._courses_by_name[course.name] = course
+
+    @classmethod
+    def load(cls, path):
+        with open(path, encoding='utf-8') as f:
+            return cls(json.load(f)["courses"])
+
+    def course(self, course_id):
+        return self._courses_by_id.get(course_id)
+
+    def course_by_name(self, name):
+        return self._courses_by_name.get(name)
+
+    def lesson(self, lesson_id):
+        return self._lessons_by_id.get(lesson_id)
+
+    def lesson_by_title(self, title):
+        return self._lessons_by_title.get(title)
+
+    def progress_bits(self, lesson_titles):
+        """Старый формат прогресса (названия пройденных уроков) -> {str(id курса): маска}"""
+        courses = {}
+        for title in lesson_titles:
+            lesson = self.lesson_by_title(title)
+            if lesson:
+                key = str(lesson.course.id)
+                courses[key] = courses.get(key, 0) | lesson.bit
+        return courses
+
+    def iter_lessons(self):
+        for course in self.courses:
+            yield from course.lessons
+
+    def course_pages(self, per_page=COURSES_PER_PAGE):
+        return max(1, -(-len(self.courses) // per_page))
+
+    def __len__(self):
+        return len(self.courses)
+
+
+# ---- компактные callback_data ----
+
+def course_callback(course_id, page=0):
+    return f"c:{course_id}:{page}" if page else f"c:{course_id}"
+
+
+def lesson_callback(lesson_id):
+    return f"l:{lesson_id}"
+
+
+def catalog_callback(page=0):
+    return f"k:{page}"
+
+
+def parse_ids(callback_text):
+    """"c:1:2" -> [1, 2]; None, если формат не числовой"""
+    try:
+        return [int(part) for part in callback_text.split(":")[1:]]
+    except ValueError:
+        return None
+
+
+# ---- прогресс битовой маской ----
+
+def popcount(bits):
+    return bin(bits).count("1")
+
+
+def page_slice(items, page, per_page):
+    page = min(max(0, page), max(0, -(-len(items) // per_page) - 1))
+    return page, items[page * per_page:(page + 1) * per_page]
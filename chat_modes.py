@@ -0,0 +1,38 @@
+"""Режим каждого чата: главное меню, меню курса, урок или NeuroPartner.
+
+Режим меняют обработчики кнопок, а маршрутизация текстовых сообщений
+сводится к поиску режима в памяти - без запросов к Telegram.
+"""
+MAIN_MENU = "main_menu"
+COURSE_MENU = "course_menu"
+LESSON = "lesson"
+NEUROPARTNER = "neuropartner"
+
+# Событие -> режим, в который переходит чат
+TRANSITIONS = {
+    "start": MAIN_MENU,
+    "open_main_menu": MAIN_MENU,
+    "open_premium": MAIN_MENU,
+    "open_profile": MAIN_MENU,
+    "open_course": COURSE_MENU,
+    "start_lesson": LESSON,
+    "open_neuropartner": NEUROPARTNER
+}
+
+
+class ChatModes:
+    def __init__(self, storage=None):
+        self._modes = {} if storage is None else storage
+
+    def get(self, chat_id):
+        return self._modes.get(chat_id, MAIN_MENU)
+
+    def handle(self, chat_id, event):
+        """Применяет событие и возвращает новый режим чата"""
+        mode = TRANSITIONS[event]
+        if self._modes.get(chat_id) != mode:
+            self._modes[chat_id] = mode
+        return mode
+
+    def __len__(self):
+        return len(self._modes)
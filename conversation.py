@@ -0,0 +1,128 @@
+"""Компактная история диалога урока.
+
+Вместо растущего списка словарей история хранится в кольцевом буфере
+фиксированной емкости из записей Turn со __slots__, а роли - это
+интернированные строки. Сохраненный прогресс (snapshot) делит буфер с
+активным уроком и копирует его только при следующей записи (copy-on-write).
+
+Ограничения памяти на пользователя:
+- в истории не больше CONVERSATION_CAPACITY реплик (по умолчанию 8);
+- реплика обрезается до MAX_TURN_CHARS символов (по умолчанию 2000);
+то есть активный урок занимает не больше capacity * max_chars символов
+текста, а снимок в USER_SAVED_PROGRESS до следующей реплики не стоит ничего.
+"""
+import os
+import sys
+
+CONVERSATION_CAPACITY = int(os.getenv('CONVERSATION_CAPACITY', '8'))
+MAX_TURN_CHARS = int(os.getenv('MAX_TURN_CHARS', '2000'))
+
+ROLE_STUDENT = sys.intern("student")
+ROLE_TEACHER = sys.intern("teacher")
+_ROLES = {ROLE_STUDENT: ROLE_STUDENT, ROLE_TEACHER: ROLE_TEACHER}
+
+
+class Turn:
+    __slots__ = ("role", "content")
+
+    def __init__(self, role, content):
+        self.role = _ROLES.get(role) or sys.intern(role)
+        self.content = content[:MAX_TURN_CHARS]
+
+
+class Conversation:
+    __slots__ = ("capacity", "total", "_items", "_start", "_size", "_shared")
+
+    def __init__(self, capacity=None):
+        self.capacity = capacity or CONVERSATION_CAPACITY
+        # Сколько реплик добавлено за все время (включая вытесненные)
+        self.total = 0
+        self._items = [None] * self.capacity
+        self._start = 0
+        self._size = 0
+        self._shared = False
+
+    def append(self, role, content):
+        if self._shared:
+            self._items = list(self._items)
+            self._shared = False
+        turn = Turn(role, content)
+        if self._size < self.capacity:
+            self._items[(self._start + self._size) % self.capacity] = turn
+            self._size += 1
+        else:
+            self._items[self._start] = turn
+            self._start = (self._start + 1) % self.capacity
+        self.total += 1
+
+    def __len__(self):
+        return self._size
+
+    def __iter__(self):
+        items, start, capacity = self._items, self._start, self.capacity
+        for i in range(self._size):
+            yield items[(start + i) % capacity]
+
+    def recent(self, n):
+        """Последние n реплик, от старых к новым"""
+        turns = list(self)
+        return turns[-n:] if n else []
+
+    def last(self, role):
+        """Последняя реплика с указанной ролью или None"""
+        for turn in reversed(list(self)):
+            if turn.role == role:
+                return turn
+        return None
+
+    def snapshot(self):
+        """Копия истории без копирования буфера (copy-on-write)"""
+        clone = Conversation.__new__(Conversation)
+        clone.capacity = self.capacity
+        clone.total = self.total
+        clone._items = self._items
+        clone._start = self._start
+        clone._size = self._size
+        clone._shared = self._shared = True
+        return clone
+
+    def to_list(self):
+        return [[turn.role, turn.content] for turn in self]
+
+    @classmethod
+    def from_list(cls, data, capacity=None, total=None):
+        conversation = cls(capacity)
+        for item in data:
+            # Поддерживаем и старый формат {"role": ..., "content": ...}
+            if isinstance(item, dict):
+                conversation.append(item["role"], item["content"])
+            else:
+                conversation.append(item[0], item[1])
+        if total is not None:
+            conversation.total = max(total, conversation.total)
+        return conversation
+
+
+def snapshot_lesson_state(state):
+    """Снимок состояния урока: словарь копируется, история - copy-on-write"""
+    snapshot = dict(state)
+    snapshot["conversation"] = state["conversation"].snapshot()
+    return snapshot
+
+
+def encode_lesson_state(state):
+    """Состояние урока -> JSON-совместимый словарь для хранилища"""
+    encoded = dict(state)
+    conversation = state["conversation"]
+    encoded["conversation"] = conversation.to_list()
+    encoded["conversation_total"] = conversation.total
+    return encoded
+
+
+def decode_lesson_state(data):
+    state = dict(data)
+    state["conversation"] = Conversation.from_list(
+        data.get("conversation", []),
+        total=state.pop("conversation_total", None)
+    )
+    return state
@@ -0,0 +1,128 @@
+"""Защита от повторной обработки обновлений Telegram.
+
+Если вебхук не ответил вовремя, Telegram доставляет тот же update еще раз.
+Повтор означал бы второй запрос к Gemini, лишнюю реплику в истории урока и
+лишние сообщения, поэтому update_id, уже попавшие в окно, подтверждаются
+сразу и без побочных эффектов.
+
+Окно в памяти - это очередь (update_id, время) в порядке поступления плюс
+словарь для проверки за O(1); старые записи вытесняются по времени и по
+размеру. Оно отвечает на повторы, которые пришли в тот же процесс.
+
+С общей базой (STATE_DB_PATH) решение принимает таблица seen_updates:
+update_id принят тем, кто первым вставил строку (INSERT OR IGNORE), поэтому
+повтор, попавший в другой воркер или пришедший после рестарта, тоже
+отсеивается. Строки старше окна удаляются по ходу работы.
+"""
+import sqlite3
+import threading
+import time
+from collections import deque
+
+# Как часто (в принятых update) удалять из базы записи старше окна
+CLEANUP_EVERY = 1000
+
+
+class UpdateDeduplicator:
+    def __init__(self, window=3600, max_entries=100000, path=None):
+        self.window = window
+        self.max_entries = max_entries
+        self._order = deque()
+        self._seen = {}
+        self._lock = threading.Lock()
+        self.checked = 0
+        self.duplicates = 0
+        self.shared_duplicates = 0
+        self._inserted = 0
+        self._conn = None
+        self._db_lock = threading.Lock()
+        if path:
+            # Таблицу делят все воркеры: ждем чужую запись, а не падаем
+            self._conn = sqlite3.connect(path, timeout=30, check_same_thread=False, isolation_level=None)
+            self._conn.execute("PRAGMA journal_mode=WAL")
+            self._conn.execute("PRAGMA synchronous=NORMAL")
+            self._conn.execute(
+                "CREATE TABLE IF NOT EXISTS seen_updates ("
+                "update_id INTEGER PRIMARY KEY, seen_at REAL NOT NULL)"
+            )
+            self._cleanup(time.time())
+
+    def _remember(self, update_id, now):
+        """Под self._lock"""
+        self._order.append((update_id, now))
+        self._seen[update_id] = now
+        self._evict(now)
+
+    def _evict(self, now):
+        cutoff = now - self.window
+        order, seen = self._order, self._seen
+        while order and (order[0][1] < cutoff or len(order) > self.max_entries):
+            update_id, seen_at = order.popleft()
+            # Запись могла быть забыта и добавлена заново - удаляем только свою
+            if seen.get(update_id) == seen_at:
+                del seen[update_id]
+
+    def _claim(self, update_id, now):
+        """True, если эта строка вставлена нами (update еще никем не принят)"""
+        with self._db_lock:
+            inserted = self._conn.execute(
+                "INSERT OR IGNORE INTO seen_updates (update_id, seen_at) VALUES (?, ?)",
+                (update_id, now)
+            ).rowcount
+            if inserted:
+                self._inserted += 1
+                if self._inserted % CLEANUP_EVERY == 0:
+                    self._cleanup(now)
+        return bool(inserted)
+
+    def _cleanup(self, now):
+        self._conn.execute("DELETE FROM seen_updates WHERE seen_at < ?", (now - self.window,))
+
+    def is_duplicate(self, update_id):
+        """True, если update уже принят (этим или другим воркером); иначе принимает его"""
+        if update_id is None:
+            return False
+        now = time.time()
+        with self._lock:
+            self.checked += 1
+            if update_id in self._seen:
+                self.duplicates += 1
+                return True
+            if self._conn is None:
+                self._remember(update_id, now)
+                return False
+        # Кто первым вставил строку, тот и обрабатывает - в любом воркере и потоке
+        claimed = self._claim(update_id, now)
+        with self._lock:
+            self._remember(update_id, now)
+            if not claimed:
+                self.duplicates += 1
+                self.shared_duplicates += 1
+        return not claimed
+
+    def forget(self, update_id):
+        """Снимает отметку, если update не удалось принять (Telegram пришлет его снова)"""
+        with self._lock:
+            self._seen.pop(update_id, None)
+        if self._conn is not None:
+            with self._db_lock:
+                self._conn.execute("DELETE FROM seen_updates WHERE update_id = ?", (update_id,))
+
+    def __len__(self):
+        return len(self._seen)
+
+    def stats(self):
+        return {
+            "window": len(self._seen),
+            "checked": self.checked,
+            "duplicates": self.duplicates,
+            "shared_duplicates": self.shared_duplicates,
+            "duplicate_rate": round(self.duplicates / self.checked, 4) if self.checked else 0.0,
+            "durable": self._conn is not None
+        }
+
+    def close(self):
+        if self._conn is not None:
+            with self._db_lock:
+                self._conn.close()
+            self._conn = None
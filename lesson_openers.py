@@ -0,0 +1,204 @@
+"""Заранее сгенерированные первые шаги уроков.
+
+Первый ответ учителя зависит только от темы урока и уровня ученика, поэтому
+его можно сгенерировать заранее для всех пар (урок, уровень), по несколько
+вариантов на пару, и отдавать из памяти без обращения к Gemini.
+
+Результат хранится в версионированном JSON-файле. У каждой пары есть
+отпечаток (тема, уровень, текст промпта): при изменении курсов или промпта
+перегенерируются только изменившиеся пары, удаленные уроки вычищаются.
+
+Сборка при деплое:
+    python lesson_openers.py
+
+Сборку при старте (PREGENERATE_OPENERS=1) в нескольких воркерах выполняет
+один процесс - тот, кто взял файловую блокировку <артефакт>.lock; остальные
+подхватывают записанный им файл по mtime.
+"""
+import hashlib
+import json
+import logging
+import os
+import random
+import tempfile
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import contextmanager
+
+try:
+    import fcntl
+except ImportError:  # Windows: блокировки нет, каждый процесс собирает сам
+    fcntl = None
+
+log = logging.getLogger(__name__)
+
+ARTIFACT_VERSION = 1
+USER_LEVELS = range(1, 6)
+
+
+def _entry_key(lesson_topic, user_level):
+    return f"{lesson_topic}|{user_level}"
+
+
+def _fingerprint(lesson_topic, user_level, prompt):
+    raw = json.dumps([lesson_topic, user_level, prompt], ensure_ascii=False)
+    return hashlib.sha256(raw.encode('utf-8')).hexdigest()[:16]
+
+
+class LessonOpeners:
+    def __init__(self, path, variants=3, reload_interval=30.0):
+        self.path = path
+        self.variants = variants
+        # Как часто pick() проверяет, не записал ли файл другой процесс
+        self.reload_interval = reload_interval
+        self._entries = {}
+        self._lock = threading.Lock()
+        self._mtime = None
+        self._checked = time.monotonic()
+        self._building = False
+        self.load()
+
+    def _stat_mtime(self):
+        try:
+            return os.stat(self.path).st_mtime_ns
+        except OSError:
+            return None
+
+    def load(self):
+        if not self.path or not os.path.exists(self.path):
+            return
+        mtime = self._stat_mtime()
+        try:
+            with open(self.path, encoding='utf-8') as f:
+                data = json.load(f)
+        except (OSError, ValueError) as e:
+            log.error("Cannot load lesson openers %s: %s", self.path, e)
+            return
+        self._mtime = mtime
+        if data.get("version") != ARTIFACT_VERSION:
+            log.error("Lesson openers %s: unsupported version %s", self.path, data.get('version'))
+            return
+        self._entries = data.get("entries", {})
+
+    def _maybe_reload(self):
+        """Перечитывает файл, если его обновил другой процесс (не чаще reload_interval)"""
+        now = time.monotonic()
+        if not self.path or self._building or now - self._checked < self.reload_interval:
+            return
+        self._checked = now
+        mtime = self._stat_mtime()
+        if mtime is not None and mtime != self._mtime:
+            self.load()
+            log.info("Lesson openers reloaded: %d pairs", len(self._entries))
+
+    @contextmanager
+    def _build_lock(self):
+        """True - сборку выполняет этот процесс, False - ее уже ведет другой"""
+        if fcntl is None or not self.path:
+            yield True
+            return
+        with open(self.path + ".lock", "a") as lock_file:
+            try:
+                fcntl.flock(lock_file, fcntl.LOCK_EX | fcntl.LOCK_NB)
+            except BlockingIOError:
+                yield False
+                return
+            try:
+                yield True
+            finally:
+                fcntl.flock(lock_file, fcntl.LOCK_UN)
+
+    def save(self):
+        # Свой временный файл у каждого процесса: воркеры, стартующие вместе,
+        # не пишут в один .tmp и не переносят на место разорванный файл
+        directory, name = os.path.split(os.path.abspath(self.path))
+        with self._lock:
+            data = {"version": ARTIFACT_VERSION, "entries": self._entries}
+            with tempfile.NamedTemporaryFile('w', encoding='utf-8', dir=directory, prefix=name + ".",
+                                             suffix=".tmp", delete=False) as f:
+                tmp_path = f.name
+                try:
+                    json.dump(data, f, ensure_ascii=False, indent=1, sort_keys=True)
+                except Exception:
+                    f.close()
+                    os.unlink(tmp_path)
+                    raise
+        # NamedTemporaryFile создает файл 0600 - артефакт должен читаться как обычный файл
+        os.chmod(tmp_path, 0o644)
+        os.replace(tmp_path, self.path)
+        self._mtime = self._stat_mtime()
+
+    def pick(self, lesson_topic, user_level):
+        """Случайный готовый вариант первого шага или None"""
+        self._maybe_reload()
+        entry = self._entries.get(_entry_key(lesson_topic, user_level))
+        if not entry or not entry["variants"]:
+            return None
+        return random.choice(entry["variants"])
+
+    def __len__(self):
+        return len(self._entries)
+
+    def build(self, lessons, build_prompt, generate, levels=USER_LEVELS, workers=4):
+        """Догенерирует недостающие варианты для всех пар (урок, уровень).
+
+        build_prompt(тема, уровень) -> промпт, generate(промпт) -> текст.
+        Возвращает число сгенерированных вариантов (0, если сборку ведет
+        другой процесс - его результат подхватит pick()).
+        """
+        with self._build_lock() as owner:
+            if not owner:
+                log.info("Lesson openers are being built by another process")
+                return 0
+            self._building = True
+            try:
+                # Файл мог уже собрать процесс, который взял блокировку раньше
+                self.load()
+                return self._build(lessons, build_prompt, generate, levels, workers)
+            finally:
+                self._building = False
+
+    def _build(self, lessons, build_prompt, generate, levels, workers):
+        jobs = []
+        wanted = set()
+        for lesson_topic in lessons:
+            for user_level in levels:
+                key = _entry_key(lesson_topic, user_level)
+                wanted.add(key)
+                prompt = build_prompt(lesson_topic, user_level)
+                fingerprint = _fingerprint(lesson_topic, user_level, prompt)
+                with self._lock:
+                    entry = self._entries.get(key)
+                    if entry is None or entry["fingerprint"] != fingerprint:
+                        entry = self._entries[key] = {"fingerprint": fingerprint, "variants": []}
+                    missing = self.variants - len(entry["variants"])
+                jobs.extend((key, prompt) for _ in range(max(0, missing)))
+
+        with self._lock:
+            removed = [k for k in self._entries if k not in wanted]
+            for key in removed:
+                del self._entries[key]
+
+        def run(job):
+            key, prompt = job
+            try:
+                text = generate(prompt)
+            except Exception as e:
+                log.error("Opener generation failed for %s: %s", key, e)
+                return 0
+            with self._lock:
+                self._entries[key]["variants"].append(text)
+            return 1
+
+        with ThreadPoolExecutor(max_workers=workers) as pool:
+            generated = sum(pool.map(run, jobs))
+        if jobs or removed:
+            self.save()
+        log.info("Lesson openers: %d/%d variants generated, %d pairs", generated, len(jobs), len(self._entries))
+        return generated
+
+
+if __name__ == '__main__':
+    import app
+    app.build_lesson_openers()
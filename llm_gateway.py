@@ -0,0 +1,424 @@
+"""Единая точка вызова языковой модели.
+
+Все запросы к Gemini (уроки и NeuroPartner) идут через LLMGateway:
+- экземпляры моделей создаются один раз и переиспользуются;
+- число одновременных вызовов ограничено семафором;
+- у каждого вызова есть дедлайн, по истечении которого вызывающий получает
+  LLMTimeout и отвечает своей запасной фразой;
+- circuit breaker при серии ошибок сразу отказывает, не дожидаясь таймаутов;
+- опционально (hedge) через p95 задержки запускается вторая попытка, и
+  берется тот ответ, что пришел первым.
+
+Ответ можно получать потоком (generate_stream): частичный текст передается
+в колбэк по мере генерации, чтобы пользователь видел начало ответа сразу.
+
+Бэкенд подменяемый: FakeLLMBackend с настраиваемой задержкой нужен для
+тестов и бенчмарков без обращения к Gemini.
+"""
+import logging
+import queue
+import random
+import threading
+import time
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor, wait, FIRST_COMPLETED
+
+log = logging.getLogger(__name__)
+
+
+class LLMError(Exception):
+    pass
+
+
+class LLMTimeout(LLMError):
+    pass
+
+
+class CircuitOpenError(LLMError):
+    pass
+
+
+class GeminiBackend:
+    """Gemini через google.generativeai.
+
+    SDK импортируется и настраивается при первом вызове (или в warm()), а не
+    при создании: импорт занимает около секунды, а меню и /start модель не
+    нужна. Так процесс начинает отвечать раньше.
+    """
+    name = "gemini"
+
+    def __init__(self, api_key, model_name='gemini-2.0-flash-exp'):
+        self.api_key = api_key
+        self.model_name = model_name
+        self._genai = None
+        self._models = {}
+        self._lock = threading.Lock()
+
+    def _sdk(self):
+        if self._genai is None:
+            with self._lock:
+                if self._genai is None:
+                    import google.generativeai as genai
+                    genai.configure(api_key=self.api_key)
+                    self._genai = genai
+        return self._genai
+
+    def _model(self, model_name):
+        model = self._models.get(model_name)
+        if model is None:
+            genai = self._sdk()
+            with self._lock:
+                model = self._models.get(model_name)
+                if model is None:
+                    model = genai.GenerativeModel(model_name)
+                    self._models[model_name] = model
+        return model
+
+    def warm(self):
+        """Импортирует SDK и создает модель заранее, без запроса к API"""
+        self._model(self.model_name)
+
+    def is_warm(self):
+        return self.model_name in self._models
+
+    def generate(self, prompt, max_output_tokens, temperature):
+        response = self._model(self.model_name).generate_content(
+            prompt,
+            generation_config=self._genai.types.GenerationConfig(
+                max_output_tokens=max_output_tokens,
+                temperature=temperature
+            )
+        )
+        return response.text
+
+    def stream(self, prompt, max_output_tokens, temperature):
+        response = self._model(self.model_name).generate_content(
+            prompt,
+            generation_config=self._genai.types.GenerationConfig(
+                max_output_tokens=max_output_tokens,
+                temperature=temperature
+            ),
+            stream=True
+        )
+        for chunk in response:
+            yield chunk.text
+
+
+FAKE_DISTRIBUTIONS = ("uniform", "lognormal", "exponential")
+
+
+class FakeLLMBackend:
+    """Локальная замена Gemini: отвечает шаблонным текстом с заданной задержкой.
+
+    Распределение задержки (distribution):
+    - uniform - latency + случайная добавка до jitter;
+    - lognormal - медиана latency, jitter - сигма логарифма (длинный хвост,
+      как у настоящих ответов модели);
+    - exponential - среднее latency.
+    """
+    name = "fake"
+
+    def __init__(self, latency=0.0, jitter=0.0, failure_rate=0.0, reply=None, seed=None,
+                 distribution="uniform"):
+        if distribution not in FAKE_DISTRIBUTIONS:
+            raise ValueError(f"Unknown fake LLM latency distribution: {distribution}")
+        self.latency = latency
+        self.jitter = jitter
+        self.distribution = distribution
+        self.failure_rate = failure_rate
+        self.reply = reply
+        self._random = random.Random(seed)
+        self.calls = 0
+
+    def warm(self):
+        pass
+
+    def is_warm(self):
+        return True
+
+    def _delay(self):
+        if self.latency <= 0:
+            return self._random.uniform(0, self.jitter)
+        if self.distribution == "lognormal":
+            return self.latency * self._random.lognormvariate(0, self.jitter)
+        if self.distribution == "exponential":
+            return self._random.expovariate(1 / self.latency)
+        return self.latency + self._random.uniform(0, self.jitter)
+
+    def _reply(self):
+        self.calls += 1
+        if self._random.random() < self.failure_rate:
+            raise LLMError("Fake LLM failure")
+        return self.reply or "🧠 Отличный вопрос! Давайте разберем его по шагам."
+
+    def generate(self, prompt, max_output_tokens, temperature):
+        delay = self._delay()
+        if delay > 0:
+            time.sleep(delay)
+        return self._reply()
+
+    def stream(self, prompt, max_output_tokens, temperature, chunks=4):
+        # Задержка распределяется между кусками, как при настоящем стриминге
+        delay = self._delay() / chunks
+        words = self._reply().split(" ")
+        step = max(1, -(-len(words) // chunks))
+        for i in range(0, len(words), step):
+            if delay > 0:
+                time.sleep(delay)
+            tail = " " if i + step < len(words) else ""
+            yield " ".join(words[i:i + step]) + tail
+
+
+class CircuitBreaker:
+    CLOSED = "closed"
+    OPEN = "open"
+    HALF_OPEN = "half_open"
+
+    def __init__(self, failure_threshold=5, reset_timeout=30.0):
+        self.failure_threshold = failure_threshold
+        self.reset_timeout = reset_timeout
+        self.state = self.CLOSED
+        self._failures = 0
+        self._opened_at = 0.0
+        self._trial_in_flight = False
+        self._lock = threading.Lock()
+
+    def allow(self):
+        with self._lock:
+            if self.state == self.CLOSED:
+                return True
+            if self.state == self.OPEN:
+                if time.monotonic() - self._opened_at < self.reset_timeout:
+                    return False
+                self.state = self.HALF_OPEN
+                self._trial_in_flight = False
+            # HALF_OPEN: пропускаем один пробный вызов
+            if self._trial_in_flight:
+                return False
+            self._trial_in_flight = True
+            return True
+
+    def is_open(self):
+        """Вызовы сейчас отклоняются (цепь разомкнута и время сброса не прошло)"""
+        with self._lock:
+            return self.state == self.OPEN and time.monotonic() - self._opened_at < self.reset_timeout
+
+    def cancel(self):
+        """Вызов так и не дошел до бэкенда - пробный слот свободен"""
+        with self._lock:
+            self._trial_in_flight = False
+
+    def record_success(self):
+        with self._lock:
+            self._failures = 0
+            self._trial_in_flight = False
+            self.state = self.CLOSED
+
+    def record_failure(self):
+        with self._lock:
+            self._failures += 1
+            self._trial_in_flight = False
+            if self.state == self.HALF_OPEN or self._failures >= self.failure_threshold:
+                if self.state != self.OPEN:
+                    log.error("LLM circuit opened after %d failures", self._failures)
+                self.state = self.OPEN
+                self._opened_at = time.monotonic()
+
+
+class LLMGateway:
+    def __init__(self, backend, max_concurrency=16, deadline=15.0, hedge=False,
+                 hedge_min_delay=1.0, breaker=None, observer=None):
+        self.backend = backend
+        # observer(режим, "ok"/"error", секунды, промпт, ответ) после каждого вызова модели
+        self.observer = observer
+        self.max_concurrency = max_concurrency
+        self.deadline = deadline
+        self.hedge = hedge
+        self.hedge_min_delay = hedge_min_delay
+        self.breaker = breaker or CircuitBreaker()
+        self._slots = threading.BoundedSemaphore(max_concurrency)
+        self._executor = ThreadPoolExecutor(max_workers=max_concurrency, thread_name_prefix="llm")
+        self._latencies = deque(maxlen=256)
+        self._in_flight_lock = threading.Lock()
+        self.in_flight = 0
+        self.counters = {
+            "calls": 0, "failures": 0, "timeouts": 0, "rejected": 0,
+            "hedged": 0, "hedge_wins": 0
+        }
+
+    # ---- задержки ----
+
+    def _percentile(self, q):
+        samples = sorted(self._latencies)
+        if not samples:
+            return None
+        return samples[min(len(samples) - 1, int(len(samples) * q))]
+
+    def hedge_delay(self):
+        p95 = self._percentile(0.95) if len(self._latencies) >= 20 else None
+        return max(self.hedge_min_delay, p95 or 0.0)
+
+    # ---- вызов ----
+
+    def _start(self, prompt, max_output_tokens, temperature, timeout):
+        """Занимает слот и запускает вызов бэкенда; None - слот не получен"""
+        if not self._slots.acquire(timeout=max(0.0, timeout)):
+            return None
+        with self._in_flight_lock:
+            self.in_flight += 1
+
+        def run():
+            started = time.monotonic()
+            text = None
+            try:
+                text = self.backend.generate(prompt, max_output_tokens, temperature)
+                self._latencies.append(time.monotonic() - started)
+                return text
+            finally:
+                self._observe("generate", started, prompt, text)
+                with self._in_flight_lock:
+                    self.in_flight -= 1
+                self._slots.release()
+
+        return self._executor.submit(run)
+
+    def generate(self, prompt, max_output_tokens=500, temperature=0.7, deadline=None):
+        """Возвращает текст ответа модели или бросает LLMError"""
+        if not self.breaker.allow():
+            self.counters["rejected"] += 1
+            raise CircuitOpenError("LLM circuit is open")
+
+        self.counters["calls"] += 1
+        deadline_at = time.monotonic() + (deadline or self.deadline)
+
+        first = self._start(prompt, max_output_tokens, temperature, deadline_at - time.monotonic())
+        if first is None:
+            self.counters["rejected"] += 1
+            self.breaker.cancel()
+            raise LLMTimeout("No free LLM slots before deadline")
+        pending = {first}
+
+        if self.hedge:
+            delay = min(self.hedge_delay(), deadline_at - time.monotonic())
+            done, _ = wait(pending, timeout=max(0.0, delay))
+            if not done:
+                second = self._start(prompt, max_output_tokens, temperature, 0)
+                if second is not None:
+                    self.counters["hedged"] += 1
+                    pending.add(second)
+
+        error = None
+        while pending:
+            remaining = deadline_at - time.monotonic()
+            if remaining <= 0:
+                break
+            done, pending = wait(pending, timeout=remaining, return_when=FIRST_COMPLETED)
+            for future in done:
+                if future.exception() is None:
+                    if future is not first:
+                        self.counters["hedge_wins"] += 1
+                    self.breaker.record_success()
+                    return future.result()
+                error = future.exception()
+
+        self.breaker.record_failure()
+        if error is not None and not pending:
+            self.counters["failures"] += 1
+            raise LLMError(str(error)) from error
+        self.counters["timeouts"] += 1
+        raise LLMTimeout(f"LLM call exceeded {deadline or self.deadline:.1f}s deadline")
+
+    def generate_stream(self, prompt, on_partial, max_output_tokens=500, temperature=0.7, deadline=None):
+        """Генерирует ответ потоком, вызывая on_partial(накопленный_текст).
+
+        Возвращает полный текст. Дедлайн действует на весь ответ целиком.
+        """
+        if not self.breaker.allow():
+            self.counters["rejected"] += 1
+            raise CircuitOpenError("LLM circuit is open")
+
+        self.counters["calls"] += 1
+        deadline_at = time.monotonic() + (deadline or self.deadline)
+        if not self._slots.acquire(timeout=max(0.0, deadline_at - time.monotonic())):
+            self.counters["rejected"] += 1
+            self.breaker.cancel()
+            raise LLMTimeout("No free LLM slots before deadline")
+        with self._in_flight_lock:
+            self.in_flight += 1
+
+        chunks = queue.Queue()
+        done = object()
+
+        def produce():
+            started = time.monotonic()
+            text = ""
+            completed = False
+            try:
+                for chunk in self.backend.stream(prompt, max_output_tokens, temperature):
+                    text += chunk
+                    chunks.put(chunk)
+                self._latencies.append(time.monotonic() - started)
+                completed = True
+                chunks.put(done)
+            except Exception as e:
+                chunks.put(e)
+            finally:
+                self._observe("stream", started, prompt, text if completed else None)
+                with self._in_flight_lock:
+                    self.in_flight -= 1
+                self._slots.release()
+
+        self._executor.submit(produce)
+
+        text = ""
+        while True:
+            try:
+                item = chunks.get(timeout=max(0.0, deadline_at - time.monotonic()))
+            except queue.Empty:
+                self.breaker.record_failure()
+                self.counters["timeouts"] += 1
+                raise LLMTimeout(f"LLM stream exceeded {deadline or self.deadline:.1f}s deadline")
+            if item is done:
+                self.breaker.record_success()
+                return text
+            if isinstance(item, Exception):
+                self.breaker.record_failure()
+                self.counters["failures"] += 1
+                raise LLMError(str(item)) from item
+            text += item
+            try:
+                on_partial(text)
+            except Exception as e:
+                log.error("Stream callback error: %s", e)
+
+    def warm(self):
+        """Готовит бэкенд к первому вызову (импорт SDK, создание модели)"""
+        started = time.monotonic()
+        self.backend.warm()
+        return time.monotonic() - started
+
+    def is_warm(self):
+        return self.backend.is_warm()
+
+    def _observe(self, mode, started, prompt, text):
+        if self.observer is None:
+            return
+        try:
+            self.observer(mode, "ok" if text is not None else "error", time.monotonic() - started, prompt, text or "")
+        except Exception as e:
+            log.error("LLM observer error: %s", e)
+
+    def stats(self):
+        p50 = self._percentile(0.5)
+        p95 = self._percentile(0.95)
+        stats = dict(self.counters)
+        stats.update({
+            "backend": self.backend.name,
+            "in_flight": self.in_flight,
+            "max_concurrency": self.max_concurrency,
+            "circuit": self.breaker.state,
+            "warm": self.is_warm(),
+            "p50": round(p50, 3) if p50 is not None else None,
+            "p95": round(p95, 3) if p95 is not None else None
+        })
+        return stats
@@ -0,0 +1,26 @@
+"""Блокировки состояния чатов для многопоточной обработки.
+
+Состояние одного чата (урок, прогресс, id сообщения) меняется только под
+блокировкой его шарда: chat_id хэшируется в один из N RLock. Разные чаты
+почти никогда не ждут друг друга, а память не растет с числом чатов.
+RLock позволяет вложенные вызовы (get_dialog_lesson -> add_teacher_response
+-> update_lesson_state) в одном потоке.
+
+Под блокировкой выполняются только изменения в памяти - запросы к Gemini
+и Telegram делаются без нее, иначе долгий ответ модели задерживал бы
+все чаты своего шарда.
+"""
+import threading
+
+
+class ShardedLocks:
+    def __init__(self, shards=64):
+        self.shards = max(1, shards)
+        self._locks = [threading.RLock() for _ in range(self.shards)]
+
+    def for_key(self, key):
+        return self._locks[hash(key) % self.shards]
+
+    def __call__(self, key):
+        """with chat_locks(chat_id): ..."""
+        return self.for_key(key)
@@ -0,0 +1,259 @@
+"""Логирование, которое не тормозит обработку update.
+
+- Поток запроса только кладет запись в ограниченную очередь (QueueHandler);
+  сборка текста, JSON и запись в поток вывода идут в отдельном потоке
+  (QueueListener). Если очередь переполнена, запись отбрасывается и
+  учитывается в dropped - запрос не ждет вывод.
+- Записи структурированные (JSON): кроме текста в них попадает контекст
+  текущего update - chat_id, update_id, вид, маршрут кнопки, задержка:
+
+      with log_context(chat_id=chat_id, update_id=update_id):
+          ...
+          log_bind(route="menu_main")
+
+- Повторяющиеся записи (одинаковые логгер и шаблон сообщения, например
+  "Gemini API error: %s" при отказе модели) ограничены: burst записей
+  сразу, дальше rate в секунду, сверх этого проходит одна из sample.
+  Число пропущенных записей попадает в следующую прошедшую (suppressed).
+- Уровни задаются по компонентам: LOG_LEVELS="llm_gateway=WARNING,app.updates=DEBUG".
+  Отключенный уровень отсекается логгером еще до создания записи.
+
+Компоненты пишут в свои логгеры с отложенным форматированием:
+log.error("Telegram %s error: %s", method, e) - текст собирается только
+для записей, которые дойдут до вывода. Аргументы должны быть неизменяемыми
+(строки, числа, исключения): форматирование идет уже в потоке вывода.
+"""
+import contextvars
+import json
+import logging
+import logging.handlers
+import queue
+import sys
+import threading
+import time
+from contextlib import contextmanager
+
+CONTEXT_FIELDS = ("chat_id", "update_id", "kind", "route", "latency_ms")
+# httpx пишет INFO на каждый HTTP-запрос - это вызовы Bot API на каждом update
+DEFAULT_LEVELS = {"httpx": "WARNING", "httpcore": "WARNING"}
+TEXT_FORMAT = "%(asctime)s %(levelname)s %(name)s: %(message)s"
+
+_context = contextvars.ContextVar("log_context", default={})
+
+
+@contextmanager
+def log_context(**fields):
+    """Контекст, который попадет во все записи внутри блока"""
+    token = _context.set({**_context.get(), **fields})
+    try:
+        yield
+    finally:
+        _context.reset(token)
+
+
+def log_bind(**fields):
+    """Дополняет контекст текущего блока log_context (например, маршрутом кнопки)"""
+    _context.set({**_context.get(), **fields})
+
+
+def parse_levels(spec):
+    """"llm_gateway=WARNING, app.updates=DEBUG" -> {"llm_gateway": "WARNING", ...}"""
+    levels = {}
+    for item in (spec or "").split(","):
+        name, _, level = item.partition("=")
+        if name.strip() and level.strip():
+            levels[name.strip()] = level.strip().upper()
+    return levels
+
+
+class ContextFilter(logging.Filter):
+    """Запоминает контекст update в записи - в потоке запроса, пока он еще доступен"""
+
+    def filter(self, record):
+        record.context = _context.get()
+        return True
+
+
+class _Bucket:
+    __slots__ = ("tokens", "updated", "over", "suppressed")
+
+    def __init__(self, tokens, now):
+        self.tokens = tokens
+        self.updated = now
+        self.over = 0
+        self.suppressed = 0
+
+
+class RateLimitFilter(logging.Filter):
+    """Ограничивает повторяющиеся записи по ключу (логгер, шаблон сообщения)"""
+
+    def __init__(self, rate=1.0, burst=10, sample=100, max_keys=1024):
+        super().__init__()
+        self.rate = rate
+        self.burst = burst
+        self.sample = sample
+        self.max_keys = max_keys
+        self.suppressed = 0
+        self._buckets = {}
+        self._lock = threading.Lock()
+
+    def filter(self, record):
+        key = (record.name, record.msg if isinstance(record.msg, str) else type(record.msg))
+        now = time.monotonic()
+        with self._lock:
+            bucket = self._buckets.get(key)
+            if bucket is None:
+                if len(self._buckets) >= self.max_keys:
+                    # Ключей слишком много (шаблоны из f-строк) - начинаем учет заново
+                    self._buckets.clear()
+                bucket = self._buckets[key] = _Bucket(self.burst, now)
+            bucket.tokens = min(self.burst, bucket.tokens + (now - bucket.updated) * self.rate)
+            bucket.updated = now
+            if bucket.tokens >= 1:
+                bucket.tokens -= 1
+            else:
+                # Лавина: пропускаем каждую sample-ю запись, чтобы она оставалась видна
+                bucket.over += 1
+                if not self.sample or bucket.over % self.sample:
+                    bucket.suppressed += 1
+                    self.suppressed += 1
+                    return False
+            if bucket.suppressed:
+                record.suppressed = bucket.suppressed
+                bucket.suppressed = 0
+        return True
+
+
+class BoundedQueueHandler(logging.handlers.QueueHandler):
+    """QueueHandler, который отбрасывает записи при полной очереди вместо ожидания"""
+
+    def __init__(self, log_queue):
+        super().__init__(log_queue)
+        self.dropped = 0
+
+    def prepare(self, record):
+        # Текст не собираем - это сделает форматтер в потоке вывода
+        return record
+
+    def enqueue(self, record):
+        try:
+            self.queue.put_nowait(record)
+        except queue.Full:
+            self.dropped += 1
+
+
+class DrainingQueueListener(logging.handlers.QueueListener):
+    """QueueListener, который при остановке дописывает и полную очередь.
+
+    Штатный stop() кладет метку конца через put_nowait и при полной очереди
+    падает с queue.Full, не дождавшись потока вывода.
+    """
+
+    def enqueue_sentinel(self):
+        # Поток вывода разбирает очередь - место для метки освободится
+        if self._thread is not None and self._thread.is_alive():
+            self.queue.put(self._sentinel)
+
+
+class JsonFormatter(logging.Formatter):
+    """Одна запись - одна строка JSON"""
+
+    def __init__(self, max_message=2000):
+        super().__init__()
+        self.max_message = max_message
+
+    def format(self, record):
+        message = record.getMessage()
+        if self.max_message and len(message) > self.max_message:
+            message = message[:self.max_message] + "…"
+        entry = {
+            "ts": round(record.created, 3),
+            "level": record.levelname,
+            "logger": record.name,
+            "msg": message
+        }
+        entry.update(getattr(record, "context", None) or {})
+        for field in CONTEXT_FIELDS:
+            # Поля, переданные явно через extra={...}, важнее контекста
+            if field in record.__dict__:
+                entry[field] = record.__dict__[field]
+        if getattr(record, "suppressed", 0):
+            entry["suppressed"] = record.suppressed
+        if record.exc_info:
+            entry["exc"] = self.formatException(record.exc_info)
+        return json.dumps(entry, ensure_ascii=False, default=str)
+
+
+class TextFormatter(logging.Formatter):
+    """Человекочитаемый вывод для локального запуска: контекст в конце строки"""
+
+    def __init__(self, max_message=2000):
+        super().__init__(TEXT_FORMAT)
+        self.max_message = max_message
+
+    def formatMessage(self, record):
+        if self.max_message and len(record.message) > self.max_message:
+            record.message = record.message[:self.max_message] + "…"
+        text = super().formatMessage(record)
+        fields = dict(getattr(record, "context", None) or {})
+        fields.update({field: record.__dict__[field] for field in CONTEXT_FIELDS if field in record.__dict__})
+        if getattr(record, "suppressed", 0):
+            fields["suppressed"] = record.suppressed
+        if fields:
+            text += " [" + " ".join(f"{key}={value}" for key, value in fields.items()) + "]"
+        return text
+
+
+class LogPipeline:
+    """Установленная конфигурация: очередь, поток вывода и счетчики"""
+
+    def __init__(self, handler, listener, limiter):
+        self.handler = handler
+        self.listener = listener
+        self.limiter = limiter
+
+    def stats(self):
+        return {
+            "queued": self.handler.queue.qsize(),
+            "dropped": self.handler.dropped,
+            "suppressed": self.limiter.suppressed if self.limiter is not None else 0
+        }
+
+    def stop(self):
+        """Дописывает очередь и останавливает поток вывода"""
+        logging.getLogger().removeHandler(self.handler)
+        self.listener.stop()
+
+
+def setup_logging(level="INFO", levels=None, fmt="json", queue_size=10000,
+                  rate=1.0, burst=10, sample=100, max_message=2000, stream=None):
+    """Настраивает корневой логгер: очередь -> поток вывода -> stream (stderr)"""
+    output = logging.StreamHandler(stream or sys.stderr)
+    output.setFormatter(TextFormatter(max_message) if fmt == "text" else JsonFormatter(max_message))
+
+    handler = BoundedQueueHandler(queue.Queue(queue_size))
+    limiter = None
+    if rate > 0:
+        # Сначала лимит: отброшенной записи контекст не нужен
+        limiter = RateLimitFilter(rate=rate, burst=burst, sample=sample)
+        handler.addFilter(limiter)
+    handler.addFilter(ContextFilter())
+
+    # Файл и строка вызова, pid и процесс в записи не выводятся - не собираем их
+    # (см. раздел "Optimization" в Logging HOWTO): поиск вызывающего кадра - самая
+    # дорогая часть создания записи
+    logging._srcfile = None
+    logging.logProcesses = False
+    logging.logMultiprocessing = False
+
+    root = logging.getLogger()
+    for old in list(root.handlers):
+        root.removeHandler(old)
+    root.addHandler(handler)
+    root.setLevel(level.upper() if isinstance(level, str) else level)
+    for name, component_level in {**DEFAULT_LEVELS, **parse_levels(levels)}.items():
+        logging.getLogger(name).setLevel(component_level)
+
+    listener = DrainingQueueListener(handler.queue, output)
+    listener.start()
+    return LogPipeline(handler, listener, limiter)
@@ -0,0 +1,212 @@
+"""Метрики в формате Prometheus без блокировок на горячем пути.
+
+Каждый поток пишет в свою ячейку (threading.local), поэтому inc() и
+observe() не берут блокировок и не конкурируют между потоками. Блокировка
+нужна только когда поток впервые регистрирует свою ячейку и когда поток
+завершается: его ячейка вливается в общую базовую и перестает храниться
+отдельно (потоковый сервер создает поток на каждый запрос). При выдаче
+/metrics суммируются база и ячейки живых потоков.
+
+Значения, которые и так хранят другие компоненты (размеры словарей,
+глубина очередей, счетчики планировщика), не дублируются: они читаются
+функцией в момент выдачи (gauge_func).
+"""
+import bisect
+import threading
+import weakref
+
+DEFAULT_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0)
+TOKEN_BUCKETS = (16, 32, 64, 128, 256, 512, 1024, 2048, 4096)
+
+
+def _escape(value):
+    return str(value).replace("\\", "\\\\").replace("\"", "\\\"").replace("\n", "\\n")
+
+
+def _labels_text(labelnames, labels, extra=None):
+    pairs = [f'{name}="{_escape(value)}"' for name, value in zip(labelnames, labels)]
+    if extra:
+        pairs.append(extra)
+    return "{" + ",".join(pairs) + "}" if pairs else ""
+
+
+def _number(value):
+    if isinstance(value, float) and value.is_integer():
+        return str(int(value))
+    return str(value)
+
+
+class _Owner:
+    """Хранится в threading.local: исчезает, когда поток завершается"""
+    __slots__ = ("cells", "__weakref__")
+
+    def __init__(self):
+        self.cells = {}
+
+
+class _ThreadCells:
+    """Словарь метки -> значение, отдельный для каждого потока.
+
+    merge(база, ячейки) вливает ячейки завершившегося потока в базу.
+    """
+
+    def __init__(self, merge):
+        self._merge = merge
+        self._local = threading.local()
+        self._base = {}
+        self._all = {}
+        self._lock = threading.Lock()
+
+    def mine(self):
+        owner = getattr(self._local, "owner", None)
+        if owner is None:
+            owner = self._local.owner = _Owner()
+            cells = owner.cells
+            with self._lock:
+                self._all[id(cells)] = cells
+            weakref.finalize(owner, self._retire, cells).atexit = False
+        return owner.cells
+
+    def _retire(self, cells):
+        # Поток завершился - в его ячейку больше никто не пишет
+        with self._lock:
+            self._all.pop(id(cells), None)
+            self._merge(self._base, cells)
+
+    def live(self):
+        """Число ячеек живых потоков"""
+        with self._lock:
+            return len(self._all)
+
+    def snapshots(self):
+        with self._lock:
+            # copy() словаря атомарна под GIL - владелец может писать параллельно
+            return [self._base.copy()] + [shard.copy() for shard in self._all.values()]
+
+
+class Counter:
+    kind = "counter"
+
+    def __init__(self, name, help_text, labelnames=()):
+        self.name = name
+        self.help = help_text
+        self.labelnames = tuple(labelnames)
+        self._cells = _ThreadCells(self._merge)
+
+    @staticmethod
+    def _merge(base, cells):
+        for labels, value in cells.items():
+            base[labels] = base.get(labels, 0) + value
+
+    def inc(self, *labels, amount=1):
+        cells = self._cells.mine()
+        cells[labels] = cells.get(labels, 0) + amount
+
+    def collect(self):
+        totals = {}
+        for shard in self._cells.snapshots():
+            self._merge(totals, shard)
+        return totals
+
+    def render(self):
+        for labels, value in sorted(self.collect().items()):
+            yield f"{self.name}{_labels_text(self.labelnames, labels)} {_number(value)}"
+
+
+class Histogram:
+    kind = "histogram"
+
+    def __init__(self, name, help_text, labelnames=(), buckets=DEFAULT_BUCKETS):
+        self.name = name
+        self.help = help_text
+        self.labelnames = tuple(labelnames)
+        self.buckets = tuple(buckets)
+        self._cells = _ThreadCells(self._merge)
+
+    @staticmethod
+    def _merge(base, cells):
+        for labels, cell in cells.items():
+            total = base.get(labels)
+            # Новый список, а не правка на месте: снимок базы мог уже уйти в collect()
+            base[labels] = list(cell) if total is None else [a + b for a, b in zip(total, cell)]
+
+    def observe(self, value, *labels):
+        cells = self._cells.mine()
+        cell = cells.get(labels)
+        if cell is None:
+            # [счетчики по корзинам..., +Inf, сумма]
+            cell = cells[labels] = [0] * (len(self.buckets) + 1) + [0.0]
+        cell[bisect.bisect_left(self.buckets, value)] += 1
+        cell[-1] += value
+
+    def collect(self):
+        totals = {}
+        for shard in self._cells.snapshots():
+            self._merge(totals, shard)
+        return totals
+
+    def render(self):
+        for labels, cell in sorted(self.collect().items()):
+            cumulative = 0
+            for bound, count in zip(self.buckets + ("+Inf",), cell):
+                cumulative += count
+                le = f'le="{_number(float(bound)) if bound != "+Inf" else bound}"'
+                yield f"{self.name}_bucket{_labels_text(self.labelnames, labels, le)} {cumulative}"
+            yield f"{self.name}_sum{_labels_text(self.labelnames, labels)} {_number(round(cell[-1], 6))}"
+            yield f"{self.name}_count{_labels_text(self.labelnames, labels)} {cumulative}"
+
+
+class GaugeFunc:
+    """Значение читается функцией при выдаче: число или {метки: число}"""
+
+    def __init__(self, name, help_text, func, labelnames=(), kind="gauge"):
+        self.name = name
+        self.help = help_text
+        self.func = func
+        self.labelnames = tuple(labelnames)
+        self.kind = kind
+
+    def render(self):
+        value = self.func()
+        if value is None:
+            return
+        if not isinstance(value, dict):
+            value = {(): value}
+        for labels, number in sorted(value.items()):
+            if number is None:
+                continue
+            if not isinstance(labels, tuple):
+                labels = (labels,)
+            yield f"{self.name}{_labels_text(self.labelnames, labels)} {_number(number)}"
+
+
+class MetricsRegistry:
+    def __init__(self):
+        self._metrics = []
+
+    def _add(self, metric):
+        self._metrics.append(metric)
+        return metric
+
+    def counter(self, name, help_text, labelnames=()):
+        return self._add(Counter(name, help_text, labelnames))
+
+    def histogram(self, name, help_text, labelnames=(), buckets=DEFAULT_BUCKETS):
+        return self._add(Histogram(name, help_text, labelnames, buckets))
+
+    def gauge_func(self, name, help_text, func, labelnames=(), kind="gauge"):
+        return self._add(GaugeFunc(name, help_text, func, labelnames, kind))
+
+    def render(self):
+        """Текстовый формат Prometheus 0.0.4"""
+        lines = []
+        for metric in self._metrics:
+            try:
+                samples = list(metric.render())
+            except Exception as e:
+                lines.append(f"# {metric.name} unavailable: {_escape(e)}")
+                continue
+            lines.append(f"# HELP {metric.name} {metric.help}")
+            lines.append(f"# TYPE {metric.name} {metric.kind}")
+            lines.extend(samples)
+        return "\n".join(lines) + "\n"
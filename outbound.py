@@ -0,0 +1,292 @@
+"""Планировщик исходящих вызовов Telegram с ограничением скорости.
+
+Telegram разрешает боту около 30 сообщений в секунду всего и около одного
+сообщения в секунду на чат. Планировщик держит token bucket на весь бот и
+на каждый чат, выполняет интерактивные правки раньше фоновых операций,
+склеивает несколько ожидающих правок одного сообщения в последнюю и при
+ответе 429 ждет ровно parameters.retry_after перед повтором.
+"""
+import itertools
+import logging
+import threading
+import time
+from collections import OrderedDict
+from concurrent.futures import Future, ThreadPoolExecutor, TimeoutError as FutureTimeout
+
+log = logging.getLogger(__name__)
+
+INTERACTIVE = 0
+BACKGROUND = 1
+
+# Ответы самого планировщика (запрос не дошел до Telegram)
+DROPPED = {"ok": False, "error_code": 429, "description": "Dropped by outbound scheduler"}
+TIMED_OUT = {"ok": False, "error_code": 429, "description": "Outbound scheduler timeout"}
+
+
+def is_rate_limited(result):
+    """True, если вызов не выполнен из-за лимитов (429 или сброс в очереди)"""
+    return result.get('error_code') == 429
+
+
+def is_superseded(result):
+    """True, если правку заменила более свежая и в Telegram ушел чужой текст"""
+    return bool(result.get('superseded'))
+
+
+def _resolved(result):
+    future = Future()
+    future.set_result(result)
+    return future
+
+
+class TokenBucket:
+    __slots__ = ("rate", "capacity", "tokens", "updated")
+
+    def __init__(self, rate, capacity, now):
+        self.rate = rate
+        self.capacity = capacity
+        self.tokens = capacity
+        self.updated = now
+
+    def wait_time(self, now):
+        """Сколько секунд ждать до следующего токена (0 - можно сейчас)"""
+        self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+        if self.tokens >= 1:
+            return 0.0
+        return (1 - self.tokens) / self.rate
+
+    def take(self):
+        self.tokens -= 1
+
+    def is_full(self, now):
+        return self.tokens + (now - self.updated) * self.rate >= self.capacity
+
+
+class _Operation:
+    __slots__ = ("method", "payload", "chat_id", "priority", "key", "future", "superseded", "attempts", "throttled")
+
+    def __init__(self, method, payload, chat_id, priority, key):
+        self.method = method
+        self.payload = payload
+        self.chat_id = chat_id
+        self.priority = priority
+        self.key = key
+        self.future = Future()
+        # Future вызывающих, чей payload заменен более свежим (склейка правок)
+        self.superseded = []
+        self.attempts = 0
+        self.throttled = False
+
+
+class OutboundScheduler:
+    def __init__(self, client, global_rate=30.0, chat_rate=1.0, chat_burst=3,
+                 max_pending=1000, max_retries=3, workers=8, max_chat_buckets=10000):
+        self.client = client
+        self.chat_rate = chat_rate
+        self.chat_burst = chat_burst
+        self.max_pending = max_pending
+        self.max_retries = max_retries
+        self.max_chat_buckets = max_chat_buckets
+        self._cond = threading.Condition()
+        self._queues = {INTERACTIVE: OrderedDict(), BACKGROUND: OrderedDict()}
+        self._global = TokenBucket(global_rate, global_rate, time.monotonic())
+        self._chat_buckets = {}
+        self._blocked_until = {}
+        self._busy_chats = set()
+        self._seq = itertools.count()
+        self._closed = False
+        self._executor = ThreadPoolExecutor(max_workers=workers, thread_name_prefix="outbound")
+        self.counters = {"sent": 0, "throttled": 0, "coalesced": 0, "dropped": 0, "retried": 0}
+        self._thread = threading.Thread(target=self._run, name="outbound-scheduler", daemon=True)
+        self._thread.start()
+
+    # ---- постановка в очередь ----
+
+    def submit(self, method, payload, chat_id=None, priority=INTERACTIVE, coalesce=False):
+        """Ставит вызов в очередь и возвращает Future с ответом Telegram.
+
+        coalesce=True для editMessageText: если правка того же сообщения еще
+        ждет отправки, ее текст заменяется новым. Вызывающие получают общий
+        результат, но у тех, чей текст заменен, в нем есть superseded=True:
+        на экране не их содержимое.
+        """
+        if coalesce:
+            key = (method, chat_id, payload.get("message_id"))
+        else:
+            key = next(self._seq)
+
+        with self._cond:
+            queue = self._queues[priority]
+            pending = queue.get(key)
+            if pending is not None:
+                pending.payload = payload
+                pending.superseded.append(pending.future)
+                pending.future = Future()
+                self.counters["coalesced"] += 1
+                return pending.future
+
+            if self._closed:
+                return _resolved(DROPPED)
+            if self._pending_count() >= self.max_pending:
+                # Интерактивная правка вытесняет самую старую фоновую операцию
+                if priority == BACKGROUND or not self._drop_oldest_background():
+                    self.counters["dropped"] += 1
+                    return _resolved(DROPPED)
+
+            op = _Operation(method, payload, chat_id, priority, key)
+            queue[key] = op
+            self._cond.notify()
+            return op.future
+
+    def call(self, method, payload, chat_id=None, priority=INTERACTIVE, coalesce=False, timeout=30.0):
+        """Синхронная обертка над submit()"""
+        future = self.submit(method, payload, chat_id, priority, coalesce)
+        try:
+            return future.result(timeout=timeout)
+        except FutureTimeout:
+            log.error("Outbound %s for %s timed out in queue", method, chat_id)
+            return TIMED_OUT
+
+    def _pending_count(self):
+        return len(self._queues[INTERACTIVE]) + len(self._queues[BACKGROUND])
+
+    def _drop_oldest_background(self):
+        background = self._queues[BACKGROUND]
+        if not background:
+            return False
+        _, op = background.popitem(last=False)
+        self.counters["dropped"] += 1
+        self._resolve(op, DROPPED)
+        return True
+
+    # ---- цикл планировщика ----
+
+    def _chat_bucket(self, chat_id, now):
+        bucket = self._chat_buckets.get(chat_id)
+        if bucket is None:
+            if len(self._chat_buckets) >= self.max_chat_buckets:
+                self._prune(now)
+            bucket = TokenBucket(self.chat_rate, self.chat_burst, now)
+            self._chat_buckets[chat_id] = bucket
+        return bucket
+
+    def _prune(self, now):
+        """Убирает корзины простаивающих чатов и истекшие блокировки"""
+        for chat_id in [c for c, b in self._chat_buckets.items()
+                        if c not in self._busy_chats and b.is_full(now)]:
+            del self._chat_buckets[chat_id]
+        for chat_id in [c for c, t in self._blocked_until.items() if t <= now]:
+            del self._blocked_until[chat_id]
+
+    def _pick(self, now):
+        """Выбирает следующую операцию: (op, 0) или (None, сколько ждать)"""
+        if not self._pending_count():
+            return None, None
+
+        global_wait = max(self._blocked_until.get(None, 0) - now, self._global.wait_time(now))
+        if global_wait > 0:
+            return None, global_wait
+
+        best_wait = None
+        for priority in (INTERACTIVE, BACKGROUND):
+            for key, op in self._queues[priority].items():
+                chat_id = op.chat_id
+                if chat_id is not None and chat_id in self._busy_chats:
+                    continue
+                wait = 0.0
+                if chat_id is not None:
+                    wait = max(self._blocked_until.get(chat_id, 0) - now,
+                               self._chat_bucket(chat_id, now).wait_time(now))
+                if wait <= 0:
+                    del self._queues[priority][key]
+                    self._global.take()
+                    if chat_id is not None:
+                        self._chat_buckets[chat_id].take()
+                    return op, 0.0
+                if not op.throttled:
+                    op.throttled = True
+                    self.counters["throttled"] += 1
+                if best_wait is None or wait < best_wait:
+                    best_wait = wait
+        return None, best_wait
+
+    def _run(self):
+        while True:
+            with self._cond:
+                while True:
+                    if self._closed and not self._pending_count():
+                        return
+                    op, wait = self._pick(time.monotonic())
+                    if op is not None:
+                        break
+                    self._cond.wait(wait)
+                if op.chat_id is not None:
+                    self._busy_chats.add(op.chat_id)
+            try:
+                self._executor.submit(self._execute, op)
+            except RuntimeError:
+                # Интерпретатор завершается и пул уже закрыт - дорабатываем сами
+                self._execute(op)
+
+    def _execute(self, op):
+        try:
+            result = self.client.call(op.method, op.payload)
+        except Exception as e:
+            result = {"ok": False, "description": str(e)}
+
+        done = True
+        with self._cond:
+            self._busy_chats.discard(op.chat_id)
+            self._cond.notify()
+
+            if result.get('error_code') != 429:
+                self.counters["sent"] += 1
+            else:
+                # 429: ЖДЕМ retry_after ДЛЯ ЭТОГО ЧАТА И ПОВТОРЯЕМ
+                retry_after = result.get('parameters', {}).get('retry_after', 1)
+                self._blocked_until[op.chat_id] = time.monotonic() + retry_after
+
+                if op.attempts >= self.max_retries or self._closed:
+                    self.counters["dropped"] += 1
+                else:
+                    done = False
+                    op.attempts += 1
+                    self.counters["retried"] += 1
+                    queue = self._queues[op.priority]
+                    newer = queue.get(op.key)
+                    if newer is not None:
+                        # Пока ждали, пришла более свежая правка - она и станет ответом
+                        self.counters["coalesced"] += 1
+                        newer.superseded.extend(op.superseded)
+                        newer.superseded.append(op.future)
+                    else:
+                        queue[op.key] = op
+                        queue.move_to_end(op.key, last=False)
+
+        if done:
+            self._resolve(op, result)
+
+    @staticmethod
+    def _resolve(op, result):
+        for future in op.superseded:
+            future.set_result(dict(result, superseded=True))
+        op.future.set_result(result)
+
+    # ---- служебное ----
+
+    def stats(self):
+        with self._cond:
+            stats = dict(self.counters)
+            stats["pending_interactive"] = len(self._queues[INTERACTIVE])
+            stats["pending_background"] = len(self._queues[BACKGROUND])
+            stats["in_flight"] = len(self._busy_chats)
+            return stats
+
+    def close(self, timeout=10.0):
+        """Дожидается отправки уже поставленных вызовов и останавливает планировщик"""
+        with self._cond:
+            self._closed = True
+            self._cond.notify()
+        self._thread.join(timeout)
+        self._executor.shutdown(wait=True)
@@ -0,0 +1,288 @@
+"""Учет платежей TON и премиум-доступ.
+
+Оплата - перевод на TON_WALLET с комментарием premium_<chat_id>. Входящие
+транзакции кошелька читаются из индексатора (совместимого с toncenter
+API v3: GET /transactions?account=...&start_lt=...&sort=asc) постранично,
+начиная с сохраненного курсора - logical time последней учтенной
+транзакции.
+
+PaymentLedger - журнал только на добавление в SQLite:
+- страница транзакций, суммы и курсор записываются одной транзакцией
+  базы, поэтому после рестарта ничего не учитывается дважды и не теряется;
+- повтор той же транзакции (hash) игнорируется - несколько процессов могут
+  опрашивать индексатор одновременно;
+- суммы total_income и development_fund ведутся нарастающим итогом и
+  читаются из памяти за O(1), без обхода журнала;
+- оплата на сумму от цены премиума продлевает доступ на period за каждую
+  полную цену; сроки доступа лежат в словаре в памяти, и проверка
+  is_premium на горячем пути - одно обращение к словарю.
+
+Суммы хранятся в нанотонах (1 TON = 10^9).
+"""
+import logging
+import re
+import sqlite3
+import threading
+import time
+
+import httpx
+
+log = logging.getLogger(__name__)
+
+NANO = 10 ** 9
+COMMENT_PATTERN = re.compile(r"^\s*premium_(-?\d+)\s*$", re.IGNORECASE)
+
+
+def to_nano(ton):
+    return int(round(ton * NANO))
+
+
+def format_ton(nano):
+    """10000000000 -> "10", 1500000000 -> "1.5\""""
+    text = f"{nano / NANO:.4f}".rstrip("0").rstrip(".")
+    return text or "0"
+
+
+def payment_comment(chat_id):
+    return f"premium_{chat_id}"
+
+
+def parse_comment(comment):
+    """chat_id из комментария premium_<chat_id> или None"""
+    match = COMMENT_PATTERN.match(comment or "")
+    return int(match.group(1)) if match else None
+
+
+def parse_transaction(tx):
+    """Входящий перевод из транзакции индексатора или None"""
+    in_msg = tx.get("in_msg") or {}
+    if not in_msg.get("source") or (tx.get("description") or {}).get("aborted"):
+        # Внешние сообщения и неуспешные транзакции - не оплата
+        return None
+    decoded = (in_msg.get("message_content") or {}).get("decoded") or {}
+    return {
+        "hash": tx["hash"],
+        "lt": int(tx["lt"]),
+        "utime": int(tx.get("now") or 0),
+        "source": in_msg["source"],
+        "amount": int(in_msg.get("value") or 0),
+        "comment": decoded.get("comment") if decoded.get("type") == "text_comment" else None
+    }
+
+
+class PaymentLedger:
+    def __init__(self, path=None, price=10 * NANO, period=30 * 86400, fund_share=0.5):
+        self.price = price
+        self.period = period
+        self.fund_share = fund_share
+        self._lock = threading.Lock()
+        # Без пути - база в памяти: журнал живет до рестарта, как и остальное состояние
+        self._conn = sqlite3.connect(path or ":memory:", timeout=30, check_same_thread=False, isolation_level=None)
+        if path:
+            self._conn.execute("PRAGMA journal_mode=WAL")
+        self._conn.executescript(
+            "CREATE TABLE IF NOT EXISTS payments ("
+            "hash TEXT PRIMARY KEY, lt INTEGER NOT NULL, utime INTEGER NOT NULL, "
+            "source TEXT NOT NULL, amount INTEGER NOT NULL, comment TEXT, chat_id INTEGER, "
+            "granted INTEGER NOT NULL DEFAULT 0);"
+            "CREATE TABLE IF NOT EXISTS ledger_meta (key TEXT PRIMARY KEY, value INTEGER NOT NULL);"
+            "CREATE TABLE IF NOT EXISTS entitlements ("
+            "chat_id INTEGER PRIMARY KEY, premium_until REAL NOT NULL);"
+        )
+        self._meta = {}
+        self._premium_until = {}
+        self.refresh()
+
+    # ---- чтение (из памяти) ----
+
+    def is_premium(self, chat_id, now=None):
+        return self._premium_until.get(chat_id, 0) > (now or time.time())
+
+    def premium_until(self, chat_id):
+        """Окончание премиума (unix time) или None"""
+        until = self._premium_until.get(chat_id)
+        return until if until and until > time.time() else None
+
+    @property
+    def cursor(self):
+        return self._meta.get("cursor_lt", 0)
+
+    def totals(self):
+        meta = self._meta
+        return {
+            "total_income": meta.get("total_income", 0),
+            "development_fund": meta.get("development_fund", 0),
+            "payments": meta.get("payments", 0)
+        }
+
+    def refresh(self):
+        """Перечитывает суммы и сроки из базы (их мог записать другой процесс)"""
+        with self._lock:
+            meta = dict(self._conn.execute("SELECT key, value FROM ledger_meta"))
+            premium_until = dict(self._conn.execute("SELECT chat_id, premium_until FROM entitlements"))
+        self._meta = meta
+        self._premium_until = premium_until
+
+    # ---- запись ----
+
+    def record(self, transfers, cursor=None):
+        """Учитывает страницу переводов; возвращает новые (ранее не учтенные) платежи.
+
+        cursor - logical time, до которого страница прочитана полностью.
+        """
+        recorded = []
+        with self._lock:
+            self._conn.execute("BEGIN IMMEDIATE")
+            try:
+                meta = dict(self._conn.execute("SELECT key, value FROM ledger_meta"))
+                for transfer in transfers:
+                    chat_id = parse_comment(transfer["comment"])
+                    inserted = self._conn.execute(
+                        "INSERT OR IGNORE INTO payments (hash, lt, utime, source, amount, comment, chat_id) "
+                        "VALUES (?, ?, ?, ?, ?, ?, ?)",
+                        (transfer["hash"], transfer["lt"], transfer["utime"], transfer["source"],
+                         transfer["amount"], transfer["comment"], chat_id)
+                    ).rowcount
+                    if not inserted:
+                        continue
+                    meta["total_income"] = meta.get("total_income", 0) + transfer["amount"]
+                    meta["development_fund"] = meta.get("development_fund", 0) + int(transfer["amount"] * self.fund_share)
+                    meta["payments"] = meta.get("payments", 0) + 1
+                    payment = dict(transfer, chat_id=chat_id, premium_until=None)
+                    if chat_id is not None and transfer["amount"] >= self.price:
+                        payment["premium_until"] = self._grant(chat_id, transfer)
+                    recorded.append(payment)
+                if cursor is not None and cursor > meta.get("cursor_lt", 0):
+                    meta["cursor_lt"] = cursor
+                self._conn.executemany(
+                    "INSERT INTO ledger_meta (key, value) VALUES (?, ?) "
+                    "ON CONFLICT (key) DO UPDATE SET value = excluded.value",
+                    meta.items()
+                )
+                self._conn.execute("COMMIT")
+            except Exception:
+                self._conn.execute("ROLLBACK")
+                raise
+            self._meta = meta
+            for payment in recorded:
+                if payment["premium_until"]:
+                    self._premium_until[payment["chat_id"]] = payment["premium_until"]
+        return recorded
+
+    def _grant(self, chat_id, transfer):
+        # Каждая полная цена - еще один период; продлеваем от текущего срока
+        row = self._conn.execute("SELECT premium_until FROM entitlements WHERE chat_id = ?", (chat_id,)).fetchone()
+        start = max(row[0] if row else 0, transfer["utime"] or time.time())
+        until = start + self.period * (transfer["amount"] // self.price)
+        self._conn.execute(
+            "INSERT INTO entitlements (chat_id, premium_until) VALUES (?, ?) "
+            "ON CONFLICT (chat_id) DO UPDATE SET premium_until = excluded.premium_until",
+            (chat_id, until)
+        )
+        self._conn.execute("UPDATE payments SET granted = 1 WHERE hash = ?", (transfer["hash"],))
+        return until
+
+    def payments(self, chat_id, limit=20):
+        with self._lock:
+            rows = self._conn.execute(
+                "SELECT hash, utime, amount, granted FROM payments WHERE chat_id = ? ORDER BY lt DESC LIMIT ?",
+                (chat_id, limit)
+            ).fetchall()
+        return [{"hash": h, "utime": utime, "amount": amount, "granted": bool(granted)}
+                for h, utime, amount, granted in rows]
+
+    def stats(self):
+        stats = self.totals()
+        stats.update({"cursor_lt": self.cursor, "premium_users": len(self._premium_until)})
+        return stats
+
+    def close(self):
+        with self._lock:
+            self._conn.close()
+
+
+class TonIndexerClient:
+    """Входящие транзакции кошелька из индексатора (формат toncenter API v3)"""
+
+    def __init__(self, base_url, account, api_key=None, page_size=100, timeout=10.0):
+        self.base_url = base_url.rstrip('/')
+        self.account = account
+        self.page_size = page_size
+        headers = {"X-API-Key": api_key} if api_key else {}
+        self._http = httpx.Client(timeout=timeout, headers=headers)
+
+    def page(self, after_lt):
+        """(переводы, lt последней транзакции страницы, страница полная?)"""
+        response = self._http.get(f"{self.base_url}/transactions", params={
+            "account": self.account,
+            "start_lt": after_lt + 1,
+            "limit": self.page_size,
+            "offset": 0,
+            "sort": "asc"
+        })
+        response.raise_for_status()
+        transactions = response.json().get("transactions", [])
+        last_lt = max((int(tx["lt"]) for tx in transactions), default=after_lt)
+        transfers = [transfer for transfer in map(parse_transaction, transactions) if transfer]
+        return transfers, last_lt, len(transactions) >= self.page_size
+
+    def close(self):
+        self._http.close()
+
+
+class ReconciliationPoller:
+    """Фоновый опрос индексатора: страницы от курсора до конца, затем пауза"""
+
+    def __init__(self, ledger, indexer, interval=30.0, on_payment=None, max_pages=50):
+        self.ledger = ledger
+        self.indexer = indexer
+        self.interval = interval
+        self.on_payment = on_payment
+        self.max_pages = max_pages
+        self._stop = threading.Event()
+        self._thread = None
+        self.polls = 0
+        self.errors = 0
+        self.last_poll = None
+
+    def poll_once(self):
+        """Догоняет индексатор; возвращает число новых платежей"""
+        # Курсор мог сдвинуть другой процесс - читаем его и суммы заново
+        self.ledger.refresh()
+        recorded = 0
+        for _ in range(self.max_pages):
+            transfers, last_lt, full = self.indexer.page(self.ledger.cursor)
+            for payment in self.ledger.record(transfers, cursor=last_lt):
+                recorded += 1
+                if self.on_payment is not None:
+                    try:
+                        self.on_payment(payment)
+                    except Exception as e:
+                        log.error("Payment callback error: %s", e)
+            if not full:
+                break
+        self.polls += 1
+        self.last_poll = time.time()
+        return recorded
+
+    def _run(self):
+        while not self._stop.is_set():
+            try:
+                self.poll_once()
+            except Exception as e:
+                self.errors += 1
+                log.error("TON indexer poll error: %s", e)
+            self._stop.wait(self.interval)
+
+    def start(self):
+        self._thread = threading.Thread(target=self._run, name="ton-poller", daemon=True)
+        self._thread.start()
+        return self
+
+    def stop(self):
+        self._stop.set()
+        if self._thread is not None:
+            self._thread.join(5)
+
+    def stats(self):
+        return {"polls": self.polls, "errors": self.errors, "last_poll": self.last_poll}
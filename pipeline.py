@@ -0,0 +1,141 @@
+"""Параллельное выполнение независимых побочных действий одного update.
+
+Ответ на callback_query и удаление сообщения пользователя не нужны для
+того, чтобы сгенерировать и показать ответ, поэтому они уходят в небольшой
+пул потоков (или в планировщик отправки) и идут одновременно с Gemini.
+На критическом пути остаются только генерация и финальная правка
+сообщения, и время обработки становится примерно max(Gemini, Telegram),
+а не их суммой.
+
+Для каждого вида update считается длительность критического пути, для
+побочных действий - число, ошибки и среднее время.
+"""
+import logging
+import threading
+import time
+from concurrent.futures import Future, ThreadPoolExecutor
+from contextlib import contextmanager
+
+log = logging.getLogger(__name__)
+
+
+def _failed(future):
+    if future.exception() is not None:
+        return True
+    # Ответы Bot API приходят словарем {"ok": ...}
+    result = future.result()
+    return isinstance(result, dict) and not result.get("ok", True)
+
+
+class _KindStats:
+    __slots__ = ("count", "total", "max")
+
+    def __init__(self):
+        self.count = 0
+        self.total = 0.0
+        self.max = 0.0
+
+
+class UpdatePipeline:
+    def __init__(self, workers=4, observer=None):
+        # observer(вид update, секунды критического пути) - для метрик
+        self.observer = observer
+        self._pool = ThreadPoolExecutor(max_workers=workers, thread_name_prefix="side-effect")
+        self._local = threading.local()
+        self._lock = threading.Lock()
+        self._kinds = {}
+        self.effects = 0
+        self.effect_errors = 0
+        self.effect_time = 0.0
+
+    # ---- критический путь ----
+
+    @contextmanager
+    def trace(self, kind="update"):
+        """Замеряет критический путь обработки одного update.
+
+        Вид можно уточнить по ходу обработки: current_kind(...).
+        """
+        self._local.kind = kind
+        started = time.perf_counter()
+        try:
+            yield
+        finally:
+            elapsed = time.perf_counter() - started
+            kind = self._local.kind
+            self._local.kind = None
+            self._record_kind(kind, elapsed)
+            if self.observer is not None:
+                self.observer(kind, elapsed)
+
+    def current_kind(self, kind):
+        self._local.kind = kind
+
+    def _record_kind(self, kind, elapsed):
+        with self._lock:
+            stats = self._kinds.get(kind)
+            if stats is None:
+                stats = self._kinds[kind] = _KindStats()
+            stats.count += 1
+            stats.total += elapsed
+            if elapsed > stats.max:
+                stats.max = elapsed
+
+    # ---- побочные действия ----
+
+    def fork(self, fn, *args):
+        """Запускает fn(*args) параллельно с обработкой; ошибки только логируются"""
+        submitted = time.perf_counter()
+
+        def run():
+            try:
+                return fn(*args)
+            except Exception as e:
+                log.error("Side effect %s failed: %s", getattr(fn, '__name__', fn), e)
+                raise
+
+        try:
+            future = self._pool.submit(run)
+        except RuntimeError:
+            # Пул уже остановлен (выход интерпретатора) - выполняем сразу
+            future = Future()
+            try:
+                future.set_result(run())
+            except Exception as e:
+                future.set_exception(e)
+        return self.track(future, submitted)
+
+    def track(self, future, submitted=None):
+        """Учитывает уже запущенное действие (например, Future планировщика)"""
+        if submitted is None:
+            submitted = time.perf_counter()
+        future.add_done_callback(lambda f: self._record_effect(submitted, _failed(f)))
+        return future
+
+    def _record_effect(self, submitted, failed):
+        elapsed = time.perf_counter() - submitted
+        with self._lock:
+            self.effects += 1
+            self.effect_time += elapsed
+            if failed:
+                self.effect_errors += 1
+
+    def stats(self):
+        with self._lock:
+            critical_path = {
+                kind: {
+                    "count": stats.count,
+                    "avg_ms": round(stats.total / stats.count * 1000, 2),
+                    "max_ms": round(stats.max * 1000, 2)
+                }
+                for kind, stats in self._kinds.items()
+            }
+            return {
+                "critical_path": critical_path,
+                "side_effects": self.effects,
+                "side_effect_errors": self.effect_errors,
+                "side_effect_avg_ms": round(self.effect_time / self.effects * 1000, 2) if self.effects else 0
+            }
+
+    def close(self):
+        self._pool.shutdown(wait=True)
@@ -0,0 +1,150 @@
+"""Сборка промпта урока в пределах бюджета токенов.
+
+Промпт состоит из трех частей:
+- статический префикс (роль, тема, уровень, правила) - одинаковый для всех
+  шагов урока и собирается один раз;
+- скользящее краткое содержание старых реплик, которое обновляется не на
+  каждом шаге, а раз в SUMMARY_EVERY шагов;
+- последние реплики дословно, сколько влезает в оставшийся бюджет.
+
+Так длинный урок не теряет нить, а размер промпта (и задержка Gemini)
+остаются постоянными.
+"""
+import logging
+import re
+from functools import lru_cache
+
+from conversation import ROLE_STUDENT
+
+log = logging.getLogger(__name__)
+
+# Грубая оценка: для русского текста Gemini тратит ~1 токен на 3 символа
+CHARS_PER_TOKEN = 3
+
+_SENTENCE_END = re.compile(r"(?<=[.!?…])\s")
+
+
+def estimate_tokens(text):
+    return len(text) // CHARS_PER_TOKEN + 1
+
+
+def _role_name(role):
+    return "Ученик" if role == ROLE_STUDENT else "Учитель"
+
+
+@lru_cache(maxsize=256)
+def lesson_prefix(lesson_topic, user_level):
+    """Статическая часть промпта урока"""
+    return f"""Ты - опытный AI-преподаватель NeuroTeacher. Веди естественный диалог с учеником.
+
+Тема урока: {lesson_topic}
+Уровень ученика: {user_level}/5
+
+Важные правила:
+1. Будь естественным и вовлекающим
+2. Адаптируй объяснения под уровень понимания
+3. Задавай открытые вопросы
+4. Будь немного креативным в подаче
+5. Не будь слишком формальным
+6. Отвечай на русском языке
+7. Будь кратким, но информативным (максимум 3-4 предложения)
+"""
+
+
+PROMPT_TAIL = "\nПродолжи урок естественным образом:"
+
+
+class LessonContextBuilder:
+    def __init__(self, token_budget=1000, summary_budget=250, recent_turns=4, summary_every=2,
+                 summary_line_chars=120, capacity=None):
+        # За summary_every шагов в историю приходит до 2 * summary_every реплик (ученик и учитель).
+        # Если они вместе с последними recent_turns не помещаются в буфер истории, реплики
+        # вытесняются раньше, чем попадут в краткое содержание, и пропадают из промпта совсем
+        if capacity is not None and capacity < 2 * summary_every + recent_turns:
+            raise ValueError(
+                f"Conversation capacity {capacity} is too small: need at least "
+                f"2 * summary_every ({summary_every}) + recent_turns ({recent_turns})"
+            )
+        self.token_budget = token_budget
+        self.summary_budget = summary_budget
+        self.recent_turns = recent_turns
+        self.summary_every = summary_every
+        self.summary_line_chars = summary_line_chars
+
+    # ---- краткое содержание ----
+
+    def _compress(self, turn):
+        first_sentence = _SENTENCE_END.split(turn.content.strip(), 1)[0]
+        if len(first_sentence) > self.summary_line_chars:
+            first_sentence = first_sentence[:self.summary_line_chars - 1] + "…"
+        return f"- {_role_name(turn.role)}: {first_sentence}"
+
+    def refresh_summary(self, lesson_state):
+        """Дописывает в краткое содержание реплики, вышедшие из окна последних.
+
+        Обновляется только раз в summary_every шагов. Возвращает True, если
+        состояние урока изменилось.
+        """
+        step = lesson_state.get("step", 0)
+        if step - lesson_state.get("summary_step", 0) < self.summary_every:
+            return False
+
+        conversation = lesson_state["conversation"]
+        first_index = conversation.total - len(conversation)
+        fold_until = conversation.total - self.recent_turns
+        start = max(lesson_state.get("summary_upto", 0), first_index)
+        lesson_state["summary_step"] = step
+        if start >= fold_until:
+            return True
+
+        turns = list(conversation)
+        lines = list(lesson_state.get("summary", []))
+        for index in range(start, fold_until):
+            lines.append(self._compress(turns[index - first_index]))
+
+        # Старые пункты вытесняются, если содержание не влезает в свой бюджет
+        while lines and estimate_tokens("\n".join(lines)) > self.summary_budget:
+            lines.pop(0)
+
+        lesson_state["summary"] = lines
+        lesson_state["summary_upto"] = fold_until
+        return True
+
+    # ---- сборка ----
+
+    def build(self, lesson_topic, user_level, conversation, summary=None, summary_upto=0):
+        """Возвращает (промпт, оценка числа токенов).
+
+        Дословно идут все реплики, еще не попавшие в краткое содержание (но
+        не меньше recent_turns), пока они помещаются в бюджет.
+        """
+        prefix = lesson_prefix(lesson_topic, user_level)
+        remaining = self.token_budget - estimate_tokens(prefix) - estimate_tokens(PROMPT_TAIL)
+
+        summary_block = ""
+        if summary:
+            summary_block = "\nКраткое содержание урока:\n" + "\n".join(summary) + "\n"
+            remaining -= estimate_tokens(summary_block)
+
+        verbatim = max(self.recent_turns, conversation.total - summary_upto)
+        recent = []
+        for turn in reversed(conversation.recent(verbatim)):
+            line = f"{_role_name(turn.role)}: {turn.content}"
+            cost = estimate_tokens(line)
+            if cost > remaining:
+                if not recent and remaining > 0:
+                    # Последняя реплика важнее всего - обрезаем, но оставляем
+                    recent.append(line[:remaining * CHARS_PER_TOKEN])
+                break
+            recent.append(line)
+            remaining -= cost
+        recent.reverse()
+
+        history = "\n".join(recent) if recent else "Диалог только начинается"
+        prompt = f"{prefix}{summary_block}\nИстория диалога:\n{history}\n{PROMPT_TAIL}"
+        tokens = estimate_tokens(prompt)
+        if log.isEnabledFor(logging.INFO):
+            # Повторяется на каждом шаге урока - в вывод попадает выборка (лимит повторов log_setup)
+            log.info("Lesson prompt: ~%d токенов (префикс %d, содержание %d пунктов, реплик %d)",
+                     tokens, estimate_tokens(prefix), len(summary or []), len(recent))
+        return prompt, tokens
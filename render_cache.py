@@ -0,0 +1,58 @@
+"""Кэш последнего отрисованного содержимого главного сообщения чата.
+
+Если пользователь повторно нажимает ту же кнопку, текст и клавиатура не
+меняются, и editMessageText можно не вызывать вовсе. Храним по чату
+message_id и хэш (текст, клавиатура, parse_mode); размер ограничен, старые
+чаты вытесняются по LRU.
+"""
+import hashlib
+import json
+import threading
+from collections import OrderedDict
+
+NOT_MODIFIED = "message is not modified"
+
+
+def render_digest(text, keyboard, parse_mode="Markdown"):
+    """Хэш содержимого сообщения"""
+    raw = json.dumps([text, keyboard, parse_mode], ensure_ascii=False, sort_keys=True)
+    return hashlib.blake2b(raw.encode('utf-8'), digest_size=16).digest()
+
+
+def is_not_modified(result):
+    """Ответ Telegram "message is not modified" - содержимое уже такое"""
+    return not result.get('ok') and NOT_MODIFIED in (result.get('description') or '')
+
+
+class RenderCache:
+    def __init__(self, max_chats=50000):
+        self.max_chats = max_chats
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+
+    def is_current(self, chat_id, message_id, digest):
+        """True, если в сообщении уже отрисовано именно это содержимое"""
+        with self._lock:
+            entry = self._entries.get(chat_id)
+            if entry is not None and entry == (message_id, digest):
+                self._entries.move_to_end(chat_id)
+                self.hits += 1
+                return True
+            self.misses += 1
+            return False
+
+    def remember(self, chat_id, message_id, digest):
+        with self._lock:
+            self._entries[chat_id] = (message_id, digest)
+            self._entries.move_to_end(chat_id)
+            while len(self._entries) > self.max_chats:
+                self._entries.popitem(last=False)
+
+    def forget(self, chat_id):
+        with self._lock:
+            self._entries.pop(chat_id, None)
+
+    def stats(self):
+        return {"chats": len(self._entries), "hits": self.hits, "misses": self.misses}
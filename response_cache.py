@@ -0,0 +1,127 @@
+"""Кэш ответов Gemini для повторяющихся запросов.
+
+Большинство пользователей начинают с одних и тех же фраз ("привет", "что ты
+умеешь"), поэтому ответы на нормализованный запрос кэшируются с TTL и
+вытеснением по LRU с ограничением по памяти. Одинаковые запросы, пришедшие
+одновременно, ждут один общий вызов модели (single-flight).
+"""
+import re
+import threading
+import time
+from collections import OrderedDict
+
+_SPACES = re.compile(r"\s+")
+_EDGE_PUNCTUATION = " \t\n.,!?…;:)(\"'«»-"
+
+
+def normalize_prompt(text):
+    """Приводит запрос к каноническому виду для ключа кэша"""
+    text = _SPACES.sub(" ", (text or "").lower().replace("ё", "е"))
+    return text.strip(_EDGE_PUNCTUATION)
+
+
+class _Flight:
+    __slots__ = ("event", "value", "error")
+
+    def __init__(self):
+        self.event = threading.Event()
+        self.value = None
+        self.error = None
+
+
+class ResponseCache:
+    def __init__(self, ttl=600.0, max_entries=5000, max_bytes=8 * 1024 * 1024):
+        self.ttl = ttl
+        self.max_entries = max_entries
+        self.max_bytes = max_bytes
+        self._entries = OrderedDict()
+        self._inflight = {}
+        self._lock = threading.Lock()
+        self.bytes = 0
+        self.hits = 0
+        self.misses = 0
+        self.shared = 0
+        self.evictions = 0
+
+    @staticmethod
+    def _size(key, value):
+        return len(repr(key).encode('utf-8')) + len(value.encode('utf-8'))
+
+    def get_or_compute(self, key, compute, wait_timeout=None):
+        """Возвращает ответ из кэша или вычисляет его через compute().
+
+        Исключение из compute() не кэшируется и пробрасывается всем, кто ждал
+        этот же ключ.
+        """
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is not None:
+                value, expires, size = entry
+                if expires > time.monotonic():
+                    self._entries.move_to_end(key)
+                    self.hits += 1
+                    return value
+                self._remove(key)
+
+            flight = self._inflight.get(key)
+            leader = flight is None
+            if leader:
+                flight = self._inflight[key] = _Flight()
+                self.misses += 1
+            else:
+                self.shared += 1
+
+        if not leader:
+            if not flight.event.wait(wait_timeout):
+                raise TimeoutError("Shared response is not ready")
+            if flight.error is not None:
+                raise flight.error
+            return flight.value
+
+        try:
+            flight.value = compute()
+        except Exception as e:
+            flight.error = e
+            raise
+        else:
+            self._store(key, flight.value)
+            return flight.value
+        finally:
+            with self._lock:
+                self._inflight.pop(key, None)
+            flight.event.set()
+
+    def _store(self, key, value):
+        size = self._size(key, value)
+        if size > self.max_bytes:
+            return
+        with self._lock:
+            if key in self._entries:
+                self._remove(key)
+            self._entries[key] = (value, time.monotonic() + self.ttl, size)
+            self.bytes += size
+            while len(self._entries) > self.max_entries or self.bytes > self.max_bytes:
+                oldest = next(iter(self._entries))
+                self._remove(oldest)
+                self.evictions += 1
+
+    def _remove(self, key):
+        _, _, size = self._entries.pop(key)
+        self.bytes -= size
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+            self.bytes = 0
+
+    def stats(self):
+        lookups = self.hits + self.misses + self.shared
+        return {
+            "entries": len(self._entries),
+            "bytes": self.bytes,
+            "hits": self.hits,
+            "misses": self.misses,
+            "shared": self.shared,
+            "evictions": self.evictions,
+            "hit_rate": round((self.hits + self.shared) / lookups, 3) if lookups else 0.0
+        }
@@ -0,0 +1,155 @@
+"""Табличный диспетчер callback-кнопок.
+
+Обработчики регистрируются по точному значению callback_data или по
+префиксу. Точные ключи ищутся в словаре, префиксы - в словаре по каждой
+из встречающихся длин префикса (их единицы), поэтому стоимость маршрутизации
+не растет с числом кнопок в меню.
+
+Общие шаги (ответ на callback_query, смена режима, сохранение урока,
+отрисовка экрана) выполняются middleware до и после обработчика. Для
+каждого маршрута считаются вызовы, ошибки и время обработки.
+
+Обработчик получает CallbackContext и возвращает словарь-результат или None.
+Его можно вызвать и измерить отдельно от вебхука:
+    router.dispatch({"id": "1", "data": "menu_main",
+                     "message": {"chat": {"id": 1}, "message_id": 1}})
+"""
+import logging
+import threading
+import time
+
+log = logging.getLogger(__name__)
+
+
+class CallbackContext:
+    __slots__ = ("query", "chat_id", "message_id", "data", "route")
+
+    def __init__(self, query):
+        self.query = query
+        message = query.get("message", {})
+        self.chat_id = message.get("chat", {}).get("id")
+        self.message_id = message.get("message_id")
+        self.data = query.get("data", "")
+        self.route = None
+
+
+class Route:
+    __slots__ = ("key", "handler", "options", "calls", "errors", "total_time", "max_time")
+
+    def __init__(self, key, handler, options):
+        self.key = key
+        self.handler = handler
+        self.options = options
+        self.calls = 0
+        self.errors = 0
+        self.total_time = 0.0
+        self.max_time = 0.0
+
+    def stats(self):
+        return {
+            "calls": self.calls,
+            "errors": self.errors,
+            "avg_ms": round(self.total_time / self.calls * 1000, 2) if self.calls else 0,
+            "max_ms": round(self.max_time * 1000, 2)
+        }
+
+
+class CallbackRouter:
+    def __init__(self, observer=None):
+        # observer(маршрут, секунды, была ли ошибка) - для метрик
+        self.observer = observer
+        self._exact = {}
+        self._prefixes = {}
+        self._prefix_lengths = []
+        self._before = []
+        self._after = []
+        self._stats_lock = threading.Lock()
+        self.unmatched = 0
+
+    # ---- регистрация ----
+
+    def exact(self, key, **options):
+        """Декоратор: обработчик для callback_data == key"""
+        def register(handler):
+            self._exact[key] = Route(key, handler, options)
+            return handler
+        return register
+
+    def prefix(self, prefix, **options):
+        """Декоратор: обработчик для callback_data, начинающихся с prefix"""
+        def register(handler):
+            self._prefixes[prefix] = Route(prefix + "*", handler, options)
+            # Сначала проверяются самые длинные префиксы
+            self._prefix_lengths = sorted({len(p) for p in self._prefixes}, reverse=True)
+            return handler
+        return register
+
+    def before(self, hook):
+        """hook(ctx) вызывается перед обработчиком"""
+        self._before.append(hook)
+        return hook
+
+    def after(self, hook):
+        """hook(ctx, result) после обработчика; может вернуть новый результат"""
+        self._after.append(hook)
+        return hook
+
+    # ---- маршрутизация ----
+
+    def resolve(self, data):
+        route = self._exact.get(data)
+        if route is not None:
+            return route
+        for length in self._prefix_lengths:
+            route = self._prefixes.get(data[:length])
+            if route is not None:
+                return route
+        return None
+
+    def dispatch(self, query):
+        ctx = CallbackContext(query)
+        ctx.route = self.resolve(ctx.data)
+        if ctx.route is None:
+            with self._stats_lock:
+                self.unmatched += 1
+
+        started = time.perf_counter()
+        failed = False
+        try:
+            for hook in self._before:
+                hook(ctx)
+            if ctx.route is None:
+                return {"status": "ignored"}
+            result = ctx.route.handler(ctx)
+            for hook in self._after:
+                replaced = hook(ctx, result)
+                if replaced is not None:
+                    result = replaced
+            return result or {"status": "ok"}
+        except Exception as e:
+            failed = True
+            log.error("Callback %r error: %s", ctx.data, e)
+            return {"status": "error", "message": str(e)}
+        finally:
+            if ctx.route is not None:
+                self._record(ctx.route, time.perf_counter() - started, failed)
+
+    def _record(self, route, elapsed, failed):
+        with self._stats_lock:
+            route.calls += 1
+            route.total_time += elapsed
+            if elapsed > route.max_time:
+                route.max_time = elapsed
+            if failed:
+                route.errors += 1
+        if self.observer is not None:
+            self.observer(route.key, elapsed, failed)
+
+    def routes(self):
+        return list(self._exact.values()) + list(self._prefixes.values())
+
+    def stats(self):
+        with self._stats_lock:
+            stats = {route.key: route.stats() for route in self.routes() if route.calls}
+        stats["unmatched"] = self.unmatched
+        return stats
@@ -0,0 +1,85 @@
+"""Экраны меню, собранные заранее.
+
+Screen хранит текст и клавиатуру уже сериализованными в JSON: тело запроса
+editMessageText/sendMessage получается склейкой готовых байтов с chat_id и
+message_id, без обхода вложенных словарей и json.dumps на каждое нажатие.
+Отпечаток содержимого для кэша отрисовки тоже считается один раз.
+
+Статические экраны (главное меню, NeuroPartner, список курсов) собираются
+при старте. Экраны, зависящие от пользователя (курс, профиль), хранит
+ScreenMemo: по чату и имени экрана лежит пара (ключ состояния, экран).
+Ключ - маленький кортеж, от которого зависит экран (битовая маска
+пройденных уроков, уровень, баллы); если он изменился, экран собирается
+заново. При изменении прогресса память чата сбрасывается явно (forget).
+"""
+import hashlib
+import json
+import threading
+from collections import OrderedDict
+
+from telegram_client import RawJSON
+
+
+class Screen:
+    __slots__ = ("text", "keyboard", "parse_mode", "digest", "_body")
+
+    def __init__(self, text, keyboard, parse_mode="Markdown"):
+        self.text = text
+        self.keyboard = keyboard
+        self.parse_mode = parse_mode
+        body = json.dumps(
+            {"text": text, "reply_markup": keyboard, "parse_mode": parse_mode},
+            ensure_ascii=False, separators=(",", ":")
+        ).encode('utf-8')
+        self.digest = hashlib.blake2b(body, digest_size=16).digest()
+        # Без закрывающей скобки: дальше дописываются chat_id и message_id
+        self._body = body[:-1]
+
+    def send_payload(self, chat_id):
+        return RawJSON(self._body + b',"chat_id":%d}' % chat_id, chat_id=chat_id)
+
+    def edit_payload(self, chat_id, message_id):
+        return RawJSON(
+            self._body + b',"chat_id":%d,"message_id":%d}' % (chat_id, message_id),
+            chat_id=chat_id, message_id=message_id
+        )
+
+
+class ScreenMemo:
+    """Экраны пользователя по чату; старые чаты вытесняются по LRU"""
+
+    def __init__(self, max_chats=10000):
+        self.max_chats = max_chats
+        self._chats = OrderedDict()
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, chat_id, name, state_key, build):
+        """Экран name для состояния state_key; build() собирает его при промахе"""
+        with self._lock:
+            screens = self._chats.get(chat_id)
+            entry = screens.get(name) if screens is not None else None
+            if entry is not None and entry[0] == state_key:
+                self._chats.move_to_end(chat_id)
+                self.hits += 1
+                return entry[1]
+            self.misses += 1
+
+        screen = build()
+        with self._lock:
+            screens = self._chats.get(chat_id)
+            if screens is None:
+                screens = self._chats[chat_id] = {}
+            screens[name] = (state_key, screen)
+            self._chats.move_to_end(chat_id)
+            while len(self._chats) > self.max_chats:
+                self._chats.popitem(last=False)
+        return screen
+
+    def forget(self, chat_id):
+        with self._lock:
+            self._chats.pop(chat_id, None)
+
+    def stats(self):
+        return {"chats": len(self._chats), "hits": self.hits, "misses": self.misses}
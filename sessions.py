@@ -0,0 +1,291 @@
+"""Сессии чатов для запуска в нескольких процессах и на нескольких машинах.
+
+Обработка update идет внутри сессии чата:
+
+    with sessions.session(chat_id):
+        process(update)
+
+Бэкенды:
+- local - один процесс: сессия только не дает двум потокам одновременно
+  обрабатывать один чат;
+- sqlite - общая база состояния (STATE_DB_PATH) для нескольких воркеров.
+  Дополнительно берется аренда (lease) чата в таблице leases: чат
+  обрабатывает только один процесс. Если до этого чат обрабатывал другой
+  процесс, кэш состояния чата сбрасывается и читается из базы, а при
+  выходе из сессии изменения чата записываются сразу, не дожидаясь
+  фоновой записи. Пока чат остается в одном процессе, кэш не сбрасывается.
+  Пока сессия открыта, фоновый поток продлевает аренду каждые ttl/3, так
+  что долгий ответ модели не отдает чат другому воркеру, а фоновая запись
+  состояния этот чат не трогает. Если аренду все же перехватили, изменения
+  чата при выходе не записываются, а отбрасываются - в базе останется
+  версия нового владельца.
+
+HashRing - согласованное хэширование чатов по экземплярам приложения:
+update "чужого" чата пересылается владельцу, и его кэши остаются горячими.
+"""
+import bisect
+import hashlib
+import logging
+import os
+import socket
+import sqlite3
+import threading
+import time
+from contextlib import contextmanager
+
+log = logging.getLogger(__name__)
+
+
+class SessionBusy(Exception):
+    """Чат слишком долго занят другим воркером"""
+
+
+class LocalSessions:
+    """Сессии внутри одного процесса"""
+
+    def __init__(self, wait=30.0):
+        self.wait = wait
+        self._active = set()
+        self._released = threading.Condition()
+        self.acquired = 0
+        self.waited = 0
+        self.timeouts = 0
+
+    def _acquire_local(self, chat_id, deadline):
+        with self._released:
+            if chat_id in self._active:
+                self.waited += 1
+            while chat_id in self._active:
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    self.timeouts += 1
+                    raise SessionBusy(f"chat {chat_id} is busy")
+                self._released.wait(remaining)
+            self._active.add(chat_id)
+            self.acquired += 1
+
+    def _release_local(self, chat_id):
+        with self._released:
+            self._active.discard(chat_id)
+            self._released.notify_all()
+
+    @contextmanager
+    def session(self, chat_id, wait=None):
+        """Сессия чата; wait - сколько ждать занятый чат (None - self.wait, 0 - не ждать)"""
+        if chat_id is None:
+            yield
+            return
+        self._acquire_local(chat_id, time.monotonic() + (self.wait if wait is None else wait))
+        try:
+            yield
+        finally:
+            self._release_local(chat_id)
+
+    def refresh(self, chat_id):
+        """Перед чтением состояния чата вне сессии: в одном процессе кэш всегда актуален"""
+
+    def stats(self):
+        return {
+            "backend": "local",
+            "active": len(self._active),
+            "acquired": self.acquired,
+            "waited": self.waited,
+            "timeouts": self.timeouts
+        }
+
+    def close(self):
+        pass
+
+
+class SQLiteSessions(LocalSessions):
+    """Сессии с арендой чатов в общей базе SQLite"""
+
+    def __init__(self, path, state_store, wait=30.0, ttl=60.0, poll=0.05, on_migrate=None):
+        super().__init__(wait)
+        if not path:
+            raise ValueError("SQLite sessions need STATE_DB_PATH")
+        self.state_store = state_store
+        self.ttl = ttl
+        self.poll = poll
+        # Колбэки сброса кэшей чата, когда он пришел из другого процесса
+        self.on_migrate = list(on_migrate or [])
+        self.owner = f"{socket.gethostname()}:{os.getpid()}"
+        self.migrated = 0
+        self.renewals = 0
+        self.lost = 0
+        self.flush_errors = 0
+        self._held = set()
+        self._db_lock = threading.Lock()
+        self._conn = sqlite3.connect(path, timeout=30, check_same_thread=False, isolation_level=None)
+        self._conn.execute("PRAGMA journal_mode=WAL")
+        self._conn.execute(
+            "CREATE TABLE IF NOT EXISTS leases ("
+            "chat TEXT PRIMARY KEY, owner TEXT NOT NULL, expires REAL NOT NULL) WITHOUT ROWID"
+        )
+        self._stop = threading.Event()
+        self._heartbeat = threading.Thread(target=self._renew_loop, name="lease-heartbeat", daemon=True)
+        self._heartbeat.start()
+
+    def _try_lease(self, chat_id):
+        """(взята ли аренда, был ли прошлым владельцем другой процесс)"""
+        key = str(chat_id)
+        now = time.time()
+        with self._db_lock:
+            self._conn.execute("BEGIN IMMEDIATE")
+            try:
+                row = self._conn.execute("SELECT owner, expires FROM leases WHERE chat = ?", (key,)).fetchone()
+                if row and row[0] != self.owner and row[1] > now:
+                    self._conn.execute("COMMIT")
+                    return False, False
+                self._conn.execute(
+                    "INSERT INTO leases (chat, owner, expires) VALUES (?, ?, ?) "
+                    "ON CONFLICT (chat) DO UPDATE SET owner = excluded.owner, expires = excluded.expires",
+                    (key, self.owner, now + self.ttl)
+                )
+                self._conn.execute("COMMIT")
+            except Exception:
+                self._conn.execute("ROLLBACK")
+                raise
+        return True, bool(row) and row[0] != self.owner
+
+    def _release_lease(self, chat_id):
+        # Владельца оставляем: по нему следующий процесс поймет, что кэш устарел
+        with self._db_lock:
+            self._held.discard(chat_id)
+            self._conn.execute(
+                "UPDATE leases SET expires = 0 WHERE chat = ? AND owner = ?",
+                (str(chat_id), self.owner)
+            )
+
+    def _renew_loop(self):
+        while not self._stop.wait(self.ttl / 3):
+            try:
+                self.renew()
+            except Exception as e:
+                log.error("Lease renewal error: %s", e)
+
+    def renew(self):
+        """Продлевает аренду всех открытых сессий процесса"""
+        with self._db_lock:
+            if not self._held or self._stop.is_set():
+                return 0
+            expires = time.time() + self.ttl
+            renewed = self._conn.executemany(
+                "UPDATE leases SET expires = ? WHERE chat = ? AND owner = ?",
+                [(expires, str(chat_id), self.owner) for chat_id in self._held]
+            ).rowcount
+        self.renewals += renewed
+        return renewed
+
+    def _owns(self, chat_id):
+        with self._db_lock:
+            row = self._conn.execute("SELECT owner FROM leases WHERE chat = ?", (str(chat_id),)).fetchone()
+        return bool(row) and row[0] == self.owner
+
+    def refresh(self, chat_id):
+        """Сбрасывает кэш чата, если его последним вел другой процесс.
+
+        Для чтения состояния до входа в сессию (например, классификации сообщения
+        при допуске): сессия сама сбросит кэш, но уже после этого чтения.
+        """
+        if chat_id is None:
+            return
+        with self._db_lock:
+            row = self._conn.execute("SELECT owner FROM leases WHERE chat = ?", (str(chat_id),)).fetchone()
+        if row and row[0] != self.owner:
+            self.state_store.invalidate(chat_id)
+
+    @contextmanager
+    def session(self, chat_id, wait=None):
+        if chat_id is None:
+            yield
+            return
+        deadline = time.monotonic() + (self.wait if wait is None else wait)
+        self._acquire_local(chat_id, deadline)
+        try:
+            while True:
+                leased, migrated = self._try_lease(chat_id)
+                if leased:
+                    with self._db_lock:
+                        self._held.add(chat_id)
+                    self.state_store.hold(chat_id)
+                    break
+                if time.monotonic() >= deadline:
+                    self.timeouts += 1
+                    raise SessionBusy(f"chat {chat_id} is leased by another worker")
+                self.waited += 1
+                time.sleep(self.poll)
+            if migrated:
+                self.migrated += 1
+                self.state_store.invalidate(chat_id)
+                for callback in self.on_migrate:
+                    callback(chat_id)
+            try:
+                yield
+            finally:
+                try:
+                    if self._owns(chat_id):
+                        try:
+                            # Следующий воркер должен увидеть изменения сразу
+                            self.state_store.flush(chat_id)
+                        except Exception as e:
+                            # Изменения остались в очереди записи. Аренду все равно отпускаем:
+                            # иначе heartbeat продлевал бы ее до конца жизни процесса
+                            self.flush_errors += 1
+                            log.error("Flush of chat %s failed, releasing its lease: %s", chat_id, e)
+                        self._release_lease(chat_id)
+                    else:
+                        # Аренду перехватили - наша версия чата старше той, что пишет новый владелец
+                        self.lost += 1
+                        log.error("Lease of chat %s lost during the session, changes discarded", chat_id)
+                        self.state_store.discard(chat_id)
+                finally:
+                    with self._db_lock:
+                        self._held.discard(chat_id)
+                    self.state_store.release(chat_id)
+        finally:
+            self._release_local(chat_id)
+
+    def stats(self):
+        stats = super().stats()
+        stats.update({"backend": "sqlite", "owner": self.owner, "migrated": self.migrated,
+                      "renewals": self.renewals, "lost": self.lost,
+                      "flush_errors": self.flush_errors})
+        return stats
+
+    def close(self):
+        self._stop.set()
+        self._heartbeat.join(5)
+        with self._db_lock:
+            self._conn.close()
+
+
+def create_sessions(backend, state_store, path=None, wait=30.0, ttl=60.0, on_migrate=None):
+    if backend == "sqlite":
+        return SQLiteSessions(path, state_store, wait=wait, ttl=ttl, on_migrate=on_migrate)
+    if backend == "local":
+        return LocalSessions(wait=wait)
+    raise ValueError(f"Unknown session backend: {backend}")
+
+
+class HashRing:
+    """Согласованное хэширование: чат -> экземпляр приложения"""
+
+    def __init__(self, nodes, replicas=100):
+        self.nodes = list(nodes)
+        self._ring = []
+        for node in self.nodes:
+            for replica in range(replicas):
+                self._ring.append((self._hash(f"{node}#{replica}"), node))
+        self._ring.sort()
+        self._hashes = [point for point, _ in self._ring]
+
+    @staticmethod
+    def _hash(value):
+        return int.from_bytes(hashlib.blake2b(str(value).encode('utf-8'), digest_size=8).digest(), "big")
+
+    def node_for(self, key):
+        if not self._ring:
+            return None
+        index = bisect.bisect(self._hashes, self._hash(key)) % len(self._ring)
+        return self._ring[index][1]
@@ -0,0 +1,264 @@
+"""Долговременное хранилище состояния пользователей (SQLite в режиме WAL).
+
+USER_PROGRESS, USER_LESSON_STATE и остальные словари работают поверх
+PersistentMap: чтение идет из горячего кэша в памяти, а запись в SQLite
+откладывается и выполняется пакетами в фоновом потоке, так что обработка
+вебхука никогда не ждет fsync. Данные чата подгружаются лениво при первом
+обращении, поэтому время старта не зависит от числа пользователей.
+
+Без пути к базе (STATE_DB_PATH не задан) карты ведут себя как обычные
+словари и ничего не сохраняют.
+"""
+import json
+import logging
+import sqlite3
+import threading
+from collections.abc import MutableMapping
+
+log = logging.getLogger(__name__)
+
+_MISSING = object()
+
+
+class PersistentMap(MutableMapping):
+    def __init__(self, store, namespace, encode=None, decode=None, lock=None):
+        self._store = store
+        self.namespace = namespace
+        self.encode = encode
+        self.decode = decode
+        # lock(key) -> блокировка, под которой значение меняют обработчики
+        self.lock = lock
+        self._cache = {}
+        self._loaded = set()
+
+    def _ensure(self, key):
+        if key in self._loaded:
+            return
+        value = self._store.load(self.namespace, key)
+        if value is not _MISSING and key not in self._cache:
+            self._cache[key] = self.decode(value) if self.decode else value
+        # Отмечаем после заполнения кэша: параллельное чтение не увидит пустоту
+        self._loaded.add(key)
+
+    def __getitem__(self, key):
+        self._ensure(key)
+        return self._cache[key]
+
+    def __contains__(self, key):
+        self._ensure(key)
+        return key in self._cache
+
+    def __setitem__(self, key, value):
+        self._loaded.add(key)
+        self._cache[key] = value
+        self._store.mark_dirty(self, key)
+
+    def __delitem__(self, key):
+        self._ensure(key)
+        del self._cache[key]
+        self._store.mark_dirty(self, key)
+
+    def invalidate(self, key):
+        """Забывает закэшированное значение: следующее чтение пойдет в базу"""
+        self._loaded.discard(key)
+        self._cache.pop(key, None)
+
+    def touch(self, key):
+        """Помечает значение измененным (после правки вложенных полей)"""
+        if key in self._cache:
+            self._store.mark_dirty(self, key)
+
+    def __iter__(self):
+        # Только то, что уже в памяти: полный обход базы здесь не нужен
+        return iter(list(self._cache))
+
+    def __len__(self):
+        return len(self._cache)
+
+    def _encoded(self, key):
+        if self.lock is None:
+            return self._encode_value(key)
+        # Сериализуем под той же блокировкой, чтобы не записать полуизмененное значение
+        with self.lock(key):
+            return self._encode_value(key)
+
+    def _encode_value(self, key):
+        value = self._cache.get(key, _MISSING)
+        if value is _MISSING:
+            return _MISSING
+        return json.dumps(self.encode(value) if self.encode else value, ensure_ascii=False)
+
+
+class StateStore:
+    def __init__(self, path=None, flush_interval=0.5):
+        self.path = path
+        self.flush_interval = flush_interval
+        self._dirty = {}
+        # Ключи открытых сессий: их пишет только сама сессия при выходе (flush(key))
+        self._held = set()
+        self._dirty_lock = threading.Lock()
+        self._db_lock = threading.Lock()
+        self._wakeup = threading.Event()
+        self._closed = False
+        self._conn = None
+        self._maps = []
+        self.flushes = 0
+        self.flush_errors = 0
+        self.rows_written = 0
+        if path:
+            # Базу могут делить несколько процессов: ждем чужую запись, а не падаем
+            self._conn = sqlite3.connect(path, timeout=30, check_same_thread=False)
+            self._conn.execute("PRAGMA journal_mode=WAL")
+            self._conn.execute("PRAGMA synchronous=NORMAL")
+            self._conn.execute(
+                "CREATE TABLE IF NOT EXISTS state ("
+                "ns TEXT NOT NULL, key TEXT NOT NULL, value TEXT NOT NULL, "
+                "PRIMARY KEY (ns, key)) WITHOUT ROWID"
+            )
+            self._conn.commit()
+            self._thread = threading.Thread(target=self._run, name="state-flusher", daemon=True)
+            self._thread.start()
+
+    @property
+    def durable(self):
+        return self._conn is not None
+
+    def map(self, namespace, encode=None, decode=None, lock=None):
+        pmap = PersistentMap(self, namespace, encode, decode, lock)
+        self._maps.append(pmap)
+        return pmap
+
+    def invalidate(self, key):
+        """Сбрасывает кэш ключа во всех картах (его мог изменить другой процесс).
+
+        Неповторно записанные изменения не трогаем - они новее базы.
+        """
+        if self._conn is None:
+            return
+        with self._dirty_lock:
+            dirty = {ns for (ns, dirty_key) in self._dirty if dirty_key == key}
+        for pmap in self._maps:
+            if pmap.namespace not in dirty:
+                pmap.invalidate(key)
+
+    def hold(self, key):
+        """Фоновая запись не трогает ключ, пока его не запишет или отбросит владелец"""
+        with self._dirty_lock:
+            self._held.add(key)
+
+    def release(self, key):
+        with self._dirty_lock:
+            self._held.discard(key)
+
+    def discard(self, key):
+        """Отбрасывает незаписанные изменения ключа и его кэш (ключ теперь ведет другой процесс)"""
+        if self._conn is None:
+            return
+        with self._dirty_lock:
+            for item in [item for item in self._dirty if item[1] == key]:
+                del self._dirty[item]
+        for pmap in self._maps:
+            pmap.invalidate(key)
+
+    # ---- чтение ----
+
+    def load(self, namespace, key):
+        if self._conn is None:
+            return _MISSING
+        with self._db_lock:
+            row = self._conn.execute(
+                "SELECT value FROM state WHERE ns = ? AND key = ?",
+                (namespace, json.dumps(key))
+            ).fetchone()
+        return json.loads(row[0]) if row else _MISSING
+
+    # ---- отложенная запись ----
+
+    def mark_dirty(self, pmap, key):
+        if self._conn is None:
+            return
+        with self._dirty_lock:
+            self._dirty[(pmap.namespace, key)] = pmap
+
+    def pending(self):
+        return len(self._dirty)
+
+    def _run(self):
+        while not self._closed:
+            self._wakeup.wait(self.flush_interval)
+            self._wakeup.clear()
+            try:
+                self.flush()
+            except Exception as e:
+                log.error("State flush error: %s", e)
+
+    def flush(self, only_key=_MISSING):
+        """Записывает накопленные изменения (все или только ключа only_key) одной транзакцией"""
+        if self._conn is None:
+            return 0
+        with self._dirty_lock:
+            if only_key is _MISSING:
+                dirty = {item: pmap for item, pmap in self._dirty.items() if item[1] not in self._held}
+                for item in dirty:
+                    del self._dirty[item]
+            else:
+                dirty = {item: pmap for item, pmap in self._dirty.items() if item[1] == only_key}
+                for item in dirty:
+                    del self._dirty[item]
+        if not dirty:
+            return 0
+
+        upserts = []
+        deletes = []
+        for (namespace, key), pmap in dirty.items():
+            try:
+                value = pmap._encoded(key)
+            except RuntimeError:
+                # Значение меняется прямо сейчас - запишем в следующий раз
+                self.mark_dirty(pmap, key)
+                continue
+            if value is _MISSING:
+                deletes.append((namespace, json.dumps(key)))
+            else:
+                upserts.append((namespace, json.dumps(key), value))
+
+        try:
+            with self._db_lock:
+                with self._conn:
+                    self._conn.executemany(
+                        "INSERT INTO state (ns, key, value) VALUES (?, ?, ?) "
+                        "ON CONFLICT (ns, key) DO UPDATE SET value = excluded.value",
+                        upserts
+                    )
+                    self._conn.executemany("DELETE FROM state WHERE ns = ? AND key = ?", deletes)
+        except Exception:
+            # Транзакция откатилась - возвращаем изменения в очередь (значение все равно
+            # берется из кэша при записи, так что более свежая отметка ничего не теряет)
+            with self._dirty_lock:
+                for item, pmap in dirty.items():
+                    self._dirty.setdefault(item, pmap)
+            self.flush_errors += 1
+            raise
+        self.flushes += 1
+        self.rows_written += len(upserts) + len(deletes)
+        return len(upserts) + len(deletes)
+
+    def stats(self):
+        return {
+            "durable": self.durable,
+            "pending": self.pending(),
+            "flushes": self.flushes,
+            "flush_errors": self.flush_errors,
+            "rows_written": self.rows_written
+        }
+
+    def close(self):
+        if self._conn is None:
+            return
+        self._closed = True
+        self._wakeup.set()
+        self._thread.join(5)
+        self.flush()
+        with self._db_lock:
+            self._conn.close()
+        self._conn = None
@@ -0,0 +1,70 @@
+"""Постепенный показ ответа модели правками главного сообщения.
+
+Пока Gemini генерирует ответ, накопленный текст периодически отправляется
+в главное сообщение через editMessageText. Частота правок ограничена, чтобы
+не упираться в лимит Telegram на чат, а незакрытая Markdown-разметка
+обрезается, чтобы частичный текст всегда был валидным.
+"""
+import time
+
+CURSOR = " ▌"
+
+
+def close_markdown(text):
+    """Обрезает текст перед незакрытой сущностью Markdown (*, _, `, ```, [..](..))"""
+    i = 0
+    n = len(text)
+    while i < n:
+        if text.startswith('```', i):
+            marker = '```'
+        elif text[i] in '*_`':
+            marker = text[i]
+        elif text[i] == '[':
+            close = text.find('](', i)
+            end = text.find(')', close + 2) if close != -1 else -1
+            if end == -1:
+                return text[:i]
+            i = end + 1
+            continue
+        else:
+            i += 1
+            continue
+        # Внутри сущности разметка не вкладывается - ищем только закрывающий маркер
+        end = text.find(marker, i + len(marker))
+        if end == -1:
+            return text[:i]
+        i = end + len(marker)
+    return text
+
+
+class ProgressiveEditor:
+    """Колбэк on_partial: показывает частичный ответ в сообщении message_id"""
+
+    def __init__(self, outbound, chat_id, message_id, header, interval=1.5, min_delta=20):
+        self.outbound = outbound
+        self.chat_id = chat_id
+        self.message_id = message_id
+        self.header = header
+        self.interval = interval
+        self.min_delta = min_delta
+        self._last_sent = 0.0
+        self._last_len = 0
+        self.edits = 0
+
+    def __call__(self, partial_text):
+        now = time.monotonic()
+        if now - self._last_sent < self.interval:
+            return
+        safe_text = close_markdown(partial_text).rstrip()
+        if len(safe_text) - self._last_len < self.min_delta:
+            return
+        self._last_sent = now
+        self._last_len = len(safe_text)
+        self.edits += 1
+        # Без reply_markup: клавиатуру принесет финальная правка
+        self.outbound.submit("editMessageText", {
+            "chat_id": self.chat_id,
+            "message_id": self.message_id,
+            "text": self.header + safe_text + CURSOR,
+            "parse_mode": "Markdown"
+        }, chat_id=self.chat_id, coalesce=True)
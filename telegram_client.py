@@ -0,0 +1,128 @@
+"""Клиент Telegram Bot API на общем пуле соединений.
+
+Все вызовы идут через один httpx.Client с keep-alive, поэтому TLS-рукопожатие
+с api.telegram.org делается один раз, а не на каждое сообщение. Базовый URL
+можно подменить (TELEGRAM_API_URL), чтобы подключить локальный фейковый
+сервер для тестов и бенчмарков.
+
+Тело запроса можно передать уже сериализованным (RawJSON или bytes) -
+тогда json.dumps на каждый вызов не выполняется.
+"""
+import logging
+import time
+import httpx
+
+log = logging.getLogger(__name__)
+
+DEFAULT_BASE_URL = "https://api.telegram.org"
+
+# Таймауты по методам (секунды): служебные вызовы не должны висеть долго
+METHOD_TIMEOUTS = {
+    "answerCallbackQuery": 5.0,
+    "deleteMessage": 5.0,
+    "getChat": 5.0,
+    "getMe": 5.0,
+    "editMessageText": 10.0,
+    "sendMessage": 10.0
+}
+DEFAULT_TIMEOUT = 10.0
+JSON_HEADERS = {"Content-Type": "application/json"}
+
+
+class RawJSON:
+    """Готовое JSON-тело запроса.
+
+    fields - поля, которые нужны по пути к Telegram (например, message_id
+    для склейки правок в планировщике); читаются через get(), как у dict.
+    """
+    __slots__ = ("body", "fields")
+
+    def __init__(self, body, **fields):
+        self.body = body
+        self.fields = fields
+
+    def get(self, key, default=None):
+        return self.fields.get(key, default)
+
+
+class TelegramClient:
+    def __init__(self, token, base_url=None, max_connections=100, max_keepalive=20, observer=None):
+        self.base_url = (base_url or DEFAULT_BASE_URL).rstrip('/')
+        # observer(метод, HTTP-статус или "error", секунды) - для метрик
+        self.observer = observer
+        self._prefix = f"{self.base_url}/bot{token}/"
+        self._http = httpx.Client(
+            limits=httpx.Limits(
+                max_connections=max_connections,
+                max_keepalive_connections=max_keepalive
+            ),
+            timeout=DEFAULT_TIMEOUT
+        )
+
+    def call(self, method, payload=None):
+        """Вызывает метод Bot API и возвращает разобранный JSON-ответ.
+
+        При сетевой ошибке возвращает {"ok": False, ...}, как это делает сам
+        Telegram для неуспешных запросов.
+        """
+        started = time.perf_counter()
+        status = "error"
+        try:
+            if isinstance(payload, RawJSON):
+                payload = payload.body
+            if isinstance(payload, bytes):
+                response = self._http.post(
+                    self._prefix + method,
+                    content=payload,
+                    headers=JSON_HEADERS,
+                    timeout=METHOD_TIMEOUTS.get(method, DEFAULT_TIMEOUT)
+                )
+            else:
+                response = self._http.post(
+                    self._prefix + method,
+                    json=payload or {},
+                    timeout=METHOD_TIMEOUTS.get(method, DEFAULT_TIMEOUT)
+                )
+            status = response.status_code
+            return response.json()
+        except Exception as e:
+            log.error("Telegram %s error: %s", method, e)
+            return {"ok": False, "description": str(e)}
+        finally:
+            if self.observer is not None:
+                self.observer(method, status, time.perf_counter() - started)
+
+    def send_message(self, chat_id, text, reply_markup=None, parse_mode="Markdown"):
+        payload = {"chat_id": chat_id, "text": text, "parse_mode": parse_mode}
+        if reply_markup is not None:
+            payload["reply_markup"] = reply_markup
+        return self.call("sendMessage", payload)
+
+    def edit_message_text(self, chat_id, message_id, text, reply_markup=None, parse_mode="Markdown"):
+        payload = {
+            "chat_id": chat_id,
+            "message_id": message_id,
+            "text": text,
+            "parse_mode": parse_mode
+        }
+        if reply_markup is not None:
+            payload["reply_markup"] = reply_markup
+        return self.call("editMessageText", payload)
+
+    def delete_message(self, chat_id, message_id):
+        return self.call("deleteMessage", {"chat_id": chat_id, "message_id": message_id})
+
+    def answer_callback_query(self, callback_query_id, text=None):
+        payload = {"callback_query_id": callback_query_id}
+        if text:
+            payload["text"] = text
+        return self.call("answerCallbackQuery", payload)
+
+    def get_chat(self, chat_id):
+        return self.call("getChat", {"chat_id": chat_id})
+
+    def get_me(self):
+        return self.call("getMe")
+
+    def close(self):
+        self._http.close()
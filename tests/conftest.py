@@ -0,0 +1,42 @@
+"""Общие фикстуры: корень репозитория и заглушки из benchmarks/ в sys.path.
+
+app импортируется один раз на прогон, против локальной заглушки Bot API и
+заглушки LLM - настройки берутся из окружения при импорте.
+"""
+import os
+import sys
+
+import pytest
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+sys.path.insert(0, os.path.join(ROOT, "benchmarks"))
+
+from fake_telegram import FakeTelegram  # noqa: E402
+
+
+@pytest.fixture(scope="session")
+def fake_telegram():
+    fake = FakeTelegram().start()
+    yield fake
+    fake.stop()
+
+
+@pytest.fixture(scope="session")
+def app_module(fake_telegram, tmp_path_factory):
+    workdir = tmp_path_factory.mktemp("app")
+    os.environ.update({
+        "TELEGRAM_TOKEN": "test",
+        "TELEGRAM_API_URL": fake_telegram.url,
+        "TELEGRAM_GLOBAL_RATE": "1000",
+        "TELEGRAM_CHAT_RATE": "1000",
+        "TELEGRAM_CHAT_BURST": "1000",
+        "LLM_BACKEND": "fake",
+        "FAKE_LLM_LATENCY": "0",
+        "LLM_WARMUP": "0",
+        "LESSON_OPENERS_PATH": str(workdir / "none.json"),
+        "STATE_DB_PATH": "",
+        "LOG_LEVEL": "WARNING",
+    })
+    import app
+    return app
@@ -0,0 +1,82 @@
+import threading
+import time
+
+from admission import ADMITTED, COLLAPSED, SHED, AdmissionController
+
+
+def controller(**kwargs):
+    options = dict(limit=16, max_wait={"lesson": 0.1, "partner": 0.1})
+    options.update(kwargs)
+    return AdmissionController(("lesson", "partner"), **options)
+
+
+def admit_in_thread(admission, *args, **kwargs):
+    result = {}
+    thread = threading.Thread(target=lambda: result.setdefault("ticket", admission.admit(*args, **kwargs)))
+    thread.start()
+    return thread, result
+
+
+def test_follow_up_waits_for_own_chat_instead_of_shedding():
+    admission = controller()
+    first = admission.admit(1, "lesson", "first", ref=10)
+    assert first.status == ADMITTED
+
+    thread, result = admit_in_thread(admission, 1, "lesson", "second", ref=11)
+    time.sleep(0.05)
+    third = admission.admit(1, "lesson", "third", ref=12)
+    assert third.status == COLLAPSED
+
+    # Дольше max_wait: свой же запрос чата - не перегрузка
+    time.sleep(0.3)
+    admission.release(first)
+    thread.join(2)
+    second = result["ticket"]
+    assert second.status == ADMITTED
+    assert second.text == "second\nthird"
+    assert second.merged == [12]
+    admission.release(second)
+    assert admission.stats()["in_flight"] == {"lesson": 0, "partner": 0}
+
+
+def test_shed_only_on_global_capacity():
+    admission = controller(limit=1, min_limit=1)
+    busy = admission.admit(1, "lesson", "busy")
+    assert busy.status == ADMITTED
+    started = time.monotonic()
+    other = admission.admit(2, "lesson", "other")
+    assert other.status == SHED
+    assert time.monotonic() - started >= 0.1
+    admission.release(busy)
+
+
+def test_collapsed_refs_stay_with_shed_host():
+    admission = controller(limit=1, min_limit=1)
+    busy = admission.admit(1, "lesson", "busy")
+    thread, result = admit_in_thread(admission, 2, "lesson", "host", ref=20)
+    time.sleep(0.02)
+    collapsed = admission.admit(2, "lesson", "extra", ref=21)
+    thread.join(2)
+    assert collapsed.status == COLLAPSED
+    host = result["ticket"]
+    # Хозяина сбросили - вызывающий видит приклеенные сообщения и не удаляет их
+    assert host.status == SHED
+    assert host.merged == [21]
+    admission.release(busy)
+
+
+def test_lesson_goes_before_partner():
+    admission = controller(limit=1, min_limit=1, max_wait={"lesson": 2, "partner": 2})
+    busy = admission.admit(1, "lesson", "busy")
+    partner_thread, partner = admit_in_thread(admission, 2, "partner", "p")
+    time.sleep(0.05)
+    lesson_thread, lesson = admit_in_thread(admission, 3, "lesson", "l")
+    time.sleep(0.05)
+    admission.release(busy)
+    lesson_thread.join(2)
+    assert lesson["ticket"].status == ADMITTED
+    assert partner_thread.is_alive()
+    admission.release(lesson["ticket"])
+    partner_thread.join(2)
+    assert partner["ticket"].status == ADMITTED
+    admission.release(partner["ticket"])
@@ -0,0 +1,69 @@
+import threading
+import time
+
+import pytest
+
+
+@pytest.fixture
+def client(app_module):
+    return app_module.app.test_client()
+
+
+def message(update_id, chat_id, text, message_id):
+    return {"update_id": update_id, "message": {"chat": {"id": chat_id}, "text": text, "message_id": message_id}}
+
+
+def deleted(fake_telegram, chat_id):
+    return [payload["message_id"] for method, payload in list(fake_telegram.recent)
+            if method == "deleteMessage" and payload.get("chat_id") == chat_id]
+
+
+def test_health_stays_ready_when_llm_circuit_is_open(app_module, client, monkeypatch):
+    monkeypatch.setattr(app_module.llm_gateway.breaker, "is_open", lambda: True)
+    response = client.get("/health")
+    assert response.status_code == 200
+    assert response.json["status"] == "degraded"
+    assert response.json["llm_available"] is False
+
+
+def test_collapsed_message_is_deleted_after_host_is_answered(app_module, client, fake_telegram, monkeypatch):
+    chat_id = 515151
+    client.post("/webhook", json={"update_id": 9000, "callback_query": {
+        "id": "1", "data": "menu_neuropartner", "message": {"chat": {"id": chat_id}, "message_id": 1}}})
+    monkeypatch.setattr(app_module.llm_backend, "latency", 0.3)
+    monkeypatch.setattr(app_module.admission, "max_wait", {"lesson": 0.05, "neuropartner": 0.05})
+
+    results = {}
+
+    def send(index):
+        update = message(9001 + index, chat_id, f"text {index}", 700 + index)
+        results[index] = client.post("/webhook", json=update).json["status"]
+
+    threads = []
+    for index in range(3):
+        thread = threading.Thread(target=send, args=(index,))
+        thread.start()
+        threads.append(thread)
+        time.sleep(0.05)
+        if index == 2:
+            # Третье сообщение приклеено ко второму, которое еще ждет первое
+            thread.join(5)
+            assert results[2] == "collapsed"
+            assert 702 not in deleted(fake_telegram, chat_id)
+    for thread in threads:
+        thread.join(5)
+
+    # Ждать свой же запрос чата дольше max_wait - не перегрузка
+    assert results == {0: "ok", 1: "ok", 2: "collapsed"}
+    deadline = time.monotonic() + 2
+    while 702 not in deleted(fake_telegram, chat_id) and time.monotonic() < deadline:
+        time.sleep(0.01)
+    assert {700, 701, 702} <= set(deleted(fake_telegram, chat_id))
+
+
+def test_duplicate_delivery_is_acknowledged_without_processing(client, fake_telegram):
+    update = message(9100, 525252, "/start", 800)
+    assert client.post("/webhook", json=update).json["status"] == "ok"
+    sent = fake_telegram.calls["sendMessage"]
+    assert client.post("/webhook", json=update).json["status"] == "duplicate"
+    assert fake_telegram.calls["sendMessage"] == sent
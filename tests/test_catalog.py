@@ -0,0 +1,72 @@
+import os
+
+import pytest
+
+from catalog import (
+    Catalog, LESSONS_PER_PAGE, catalog_callback, course_callback, lesson_callback,
+    page_slice, parse_ids, popcount
+)
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+
+def test_shipped_courses_fit_on_one_page():
+    catalog = Catalog.load(os.path.join(ROOT, "courses.json"))
+    for course in catalog.courses:
+        assert len(course.lessons) <= LESSONS_PER_PAGE
+        assert course.pages() == 1
+
+
+def make_catalog(*lesson_counts):
+    return Catalog([
+        {"id": course_id, "name": f"Курс {course_id}",
+         "lessons": [{"id": course_id * 100 + index, "title": f"Урок {course_id}.{index}"}
+                     for index in range(count)]}
+        for course_id, count in enumerate(lesson_counts, start=1)
+    ])
+
+
+def test_callbacks_round_trip_through_parse_ids():
+    assert parse_ids(course_callback(3)) == [3]
+    assert parse_ids(course_callback(3, 2)) == [3, 2]
+    assert parse_ids(lesson_callback(107)) == [107]
+    assert parse_ids(catalog_callback(1)) == [1]
+    # Старые и испорченные кнопки не роняют обработчик
+    assert parse_ids("c:python") is None
+    assert parse_ids("k:") is None
+    assert parse_ids("menu_main") == []
+
+
+def test_callbacks_fit_telegram_limit():
+    assert len(course_callback(10 ** 9, 10 ** 6).encode()) <= 64
+
+
+def test_page_slice_clamps_page():
+    items = list(range(25))
+    assert page_slice(items, 0, 10) == (0, list(range(10)))
+    assert page_slice(items, 2, 10) == (2, [20, 21, 22, 23, 24])
+    assert page_slice(items, 7, 10) == (2, [20, 21, 22, 23, 24])
+    assert page_slice(items, -1, 10) == (0, list(range(10)))
+    assert page_slice([], 3, 10) == (0, [])
+
+
+def test_pages_round_up():
+    catalog = make_catalog(LESSONS_PER_PAGE, LESSONS_PER_PAGE + 1, 0)
+    assert [course.pages() for course in catalog.courses] == [1, 2, 1]
+
+
+def test_duplicate_ids_are_rejected():
+    with pytest.raises(ValueError):
+        Catalog([{"id": 1, "name": "a"}, {"id": 1, "name": "b"}])
+    with pytest.raises(ValueError):
+        Catalog([{"id": 1, "name": "a", "lessons": [{"id": 5, "title": "x"}]},
+                 {"id": 2, "name": "b", "lessons": [{"id": 5, "title": "y"}]}])
+
+
+def test_progress_migrates_titles_to_course_bits():
+    catalog = make_catalog(3, 2)
+    bits = catalog.progress_bits(["Урок 1.0", "Урок 1.2", "Урок 2.1", "Урок 1.2", "Удаленный урок"])
+    assert bits == {"1": 0b101, "2": 0b10}
+    assert sum(popcount(mask) for mask in bits.values()) == 3
+    lesson = catalog.lesson(102)
+    assert bits[str(lesson.course.id)] & lesson.bit
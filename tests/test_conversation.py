@@ -0,0 +1,70 @@
+from conversation import (
+    MAX_TURN_CHARS, ROLE_STUDENT, ROLE_TEACHER, Conversation,
+    decode_lesson_state, encode_lesson_state, snapshot_lesson_state
+)
+
+
+def contents(conversation):
+    return [turn.content for turn in conversation]
+
+
+def test_ring_keeps_the_newest_turns_in_order():
+    conversation = Conversation(capacity=3)
+    for index in range(5):
+        conversation.append(ROLE_STUDENT if index % 2 else ROLE_TEACHER, str(index))
+    assert contents(conversation) == ["2", "3", "4"]
+    assert len(conversation) == 3
+    assert conversation.total == 5
+    assert [turn.content for turn in conversation.recent(2)] == ["3", "4"]
+    assert conversation.recent(0) == []
+    assert conversation.last(ROLE_STUDENT).content == "3"
+
+
+def test_turn_is_truncated_and_role_interned():
+    conversation = Conversation(capacity=2)
+    conversation.append("".join(["stu", "dent"]), "x" * (MAX_TURN_CHARS + 10))
+    turn = conversation.last(ROLE_STUDENT)
+    assert len(turn.content) == MAX_TURN_CHARS
+    assert turn.role is ROLE_STUDENT
+
+
+def test_snapshot_shares_buffer_until_next_write():
+    conversation = Conversation(capacity=3)
+    conversation.append(ROLE_TEACHER, "a")
+    conversation.append(ROLE_STUDENT, "b")
+    saved = conversation.snapshot()
+    assert saved._items is conversation._items
+
+    conversation.append(ROLE_TEACHER, "c")
+    conversation.append(ROLE_STUDENT, "d")
+    assert contents(saved) == ["a", "b"]
+    assert saved.total == 2
+    assert contents(conversation) == ["b", "c", "d"]
+
+    # Запись в снимок тоже не трогает оригинал
+    saved.append(ROLE_STUDENT, "e")
+    assert contents(saved) == ["a", "b", "e"]
+    assert contents(conversation) == ["b", "c", "d"]
+
+
+def test_lesson_state_snapshot_and_round_trip():
+    conversation = Conversation(capacity=2)
+    for text in ("a", "b", "c"):
+        conversation.append(ROLE_STUDENT, text)
+    state = {"current_lesson": "Урок", "step": 3, "conversation": conversation}
+
+    snapshot = snapshot_lesson_state(state)
+    state["step"] = 4
+    conversation.append(ROLE_TEACHER, "d")
+    assert snapshot["step"] == 3
+    assert contents(snapshot["conversation"]) == ["b", "c"]
+
+    restored = decode_lesson_state(encode_lesson_state(snapshot))
+    assert contents(restored["conversation"]) == ["b", "c"]
+    assert restored["conversation"].total == 3
+    assert "conversation_total" not in restored
+
+
+def test_from_list_reads_the_old_dict_format():
+    conversation = Conversation.from_list([{"role": "teacher", "content": "привет"}, ["student", "ответ"]])
+    assert [(turn.role, turn.content) for turn in conversation] == [(ROLE_TEACHER, "привет"), (ROLE_STUDENT, "ответ")]
@@ -0,0 +1,55 @@
+import threading
+
+from idempotency import UpdateDeduplicator
+
+
+def test_retry_on_another_worker_is_a_duplicate(tmp_path):
+    path = str(tmp_path / "state.db")
+    first, second = UpdateDeduplicator(path=path), UpdateDeduplicator(path=path)
+    assert not first.is_duplicate(1)
+    assert second.is_duplicate(1)
+    assert second.stats()["shared_duplicates"] == 1
+    # После рестарта окно в памяти пустое, но база помнит
+    assert UpdateDeduplicator(path=path).is_duplicate(1)
+
+
+def test_forget_releases_update_for_every_worker(tmp_path):
+    path = str(tmp_path / "state.db")
+    first, second = UpdateDeduplicator(path=path), UpdateDeduplicator(path=path)
+    assert not first.is_duplicate(2)
+    first.forget(2)
+    assert not second.is_duplicate(2)
+
+
+def test_exactly_one_claim_under_concurrency(tmp_path):
+    path = str(tmp_path / "state.db")
+    workers = [UpdateDeduplicator(path=path) for _ in range(4)]
+    claims = []
+
+    def run(dedup):
+        for update_id in range(200):
+            if not dedup.is_duplicate(update_id):
+                claims.append(update_id)
+
+    threads = [threading.Thread(target=run, args=(dedup,)) for dedup in workers for _ in range(2)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    assert sorted(claims) == list(range(200))
+
+
+def test_old_rows_are_cleaned_up(tmp_path):
+    path = str(tmp_path / "state.db")
+    dedup = UpdateDeduplicator(window=0.01, path=path)
+    assert not dedup.is_duplicate(3)
+    dedup._cleanup(dedup._order[-1][1] + 1)
+    dedup.forget(3)
+    assert not UpdateDeduplicator(window=0.01, path=path).is_duplicate(3)
+
+
+def test_in_memory_without_database():
+    dedup = UpdateDeduplicator()
+    assert not dedup.is_duplicate(5)
+    assert dedup.is_duplicate(5)
+    assert not dedup.stats()["durable"]
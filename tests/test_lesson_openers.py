@@ -0,0 +1,48 @@
+import threading
+
+from lesson_openers import LessonOpeners
+
+
+def test_concurrent_opener_saves_never_tear_the_artifact(tmp_path):
+    path = str(tmp_path / "openers.json")
+    workers = [LessonOpeners(path) for _ in range(8)]
+    for index, openers in enumerate(workers):
+        openers._entries = {f"lesson-{index}": {"variants": ["шаг " * 20000]}}
+    threads = [threading.Thread(target=openers.save) for openers in workers]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+
+    assert len(LessonOpeners(path)) == 1
+    assert [p.name for p in tmp_path.iterdir()] == ["openers.json"]
+
+
+def build(openers, calls):
+    def generate(prompt):
+        calls.append(prompt)
+        return "вариант " + prompt
+
+    return openers.build(["Урок 1", "Урок 2"], lambda topic, level: f"{topic}/{level}", generate, levels=[1, 2])
+
+
+def test_only_one_worker_builds_and_others_reload_the_artifact(tmp_path):
+    path = str(tmp_path / "openers.json")
+    builder = LessonOpeners(path, variants=2)
+    sibling = LessonOpeners(path, variants=2, reload_interval=0)
+    calls = []
+
+    with builder._build_lock() as owner:
+        assert owner
+        # Пока блокировку держит другой процесс, сборка не запускается
+        assert build(sibling, calls) == 0
+        assert calls == []
+
+    assert build(builder, calls) == 8
+    assert sibling.pick("Урок 2", 1).startswith("вариант Урок 2/1")
+
+    # Воркер, стартовавший позже, находит готовый файл и ничего не генерирует
+    late = LessonOpeners(str(tmp_path / "openers.json"), variants=2)
+    late._entries = {}
+    assert build(late, calls) == 0
+    assert len(calls) == 8
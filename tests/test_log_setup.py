@@ -0,0 +1,41 @@
+import io
+import logging
+import time
+
+import pytest
+
+from log_setup import setup_logging
+
+
+class SlowStream(io.StringIO):
+    """Поток вывода медленнее записи логов - очередь успевает заполниться"""
+
+    def write(self, text):
+        time.sleep(0.001)
+        return super().write(text)
+
+
+@pytest.fixture
+def root_handlers():
+    root = logging.getLogger()
+    saved, level = list(root.handlers), root.level
+    yield
+    for handler in list(root.handlers):
+        root.removeHandler(handler)
+    for handler in saved:
+        root.addHandler(handler)
+    root.setLevel(level)
+
+
+def test_stop_drains_a_full_queue(root_handlers):
+    stream = SlowStream()
+    pipeline = setup_logging("INFO", queue_size=10, rate=0, stream=stream)
+    log = logging.getLogger("test.flood")
+    for index in range(200):
+        log.info("record %d", index)
+    assert pipeline.stats()["dropped"] > 0
+
+    pipeline.stop()
+    written = stream.getvalue().count("\n")
+    assert written == 200 - pipeline.stats()["dropped"]
+    assert pipeline.stats()["queued"] == 0
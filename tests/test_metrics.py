@@ -0,0 +1,57 @@
+import gc
+import threading
+
+from metrics import MetricsRegistry
+
+
+def run_threads(count, target):
+    threads = [threading.Thread(target=target) for _ in range(count)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    del threads
+    gc.collect()
+
+
+def test_finished_threads_do_not_keep_cells():
+    registry = MetricsRegistry()
+    counter = registry.counter("requests_total", "", ("route",))
+    histogram = registry.histogram("request_seconds", "", ("route",))
+
+    def request():
+        counter.inc("menu")
+        histogram.observe(0.02, "menu")
+
+    for _ in range(3):
+        run_threads(100, request)
+
+    assert counter._cells.live() == 0
+    assert histogram._cells.live() == 0
+    # Значения потоков не теряются - они в базовой ячейке
+    assert counter.collect() == {("menu",): 300}
+    cell = histogram.collect()[("menu",)]
+    assert sum(cell[:-1]) == 300
+    assert round(cell[-1], 6) == 6.0
+
+
+def test_live_thread_values_are_visible_before_it_exits():
+    registry = MetricsRegistry()
+    counter = registry.counter("events_total", "")
+    written, release = threading.Event(), threading.Event()
+
+    def worker():
+        counter.inc()
+        written.set()
+        release.wait(5)
+
+    thread = threading.Thread(target=worker)
+    thread.start()
+    written.wait(5)
+    assert counter.collect() == {(): 1}
+    assert counter._cells.live() == 1
+    release.set()
+    thread.join()
+    gc.collect()
+    assert counter.collect() == {(): 1}
+    assert "events_total 1" in registry.render()
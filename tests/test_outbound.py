@@ -0,0 +1,75 @@
+import threading
+import time
+
+from outbound import OutboundScheduler, is_superseded
+
+
+class GatedClient:
+    """Клиент Bot API, который держит вызовы, пока не открыт gate"""
+
+    def __init__(self):
+        self.gate = threading.Event()
+        self.sent = []
+
+    def call(self, method, payload):
+        self.gate.wait(5)
+        self.sent.append(payload["text"])
+        return {"ok": True, "result": True}
+
+
+def wait_until(predicate, timeout=5):
+    """Ждет условия с ограничением по времени, чтобы регрессия не вешала прогон"""
+    deadline = time.monotonic() + timeout
+    while not predicate():
+        assert time.monotonic() < deadline, "condition not reached in time"
+        time.sleep(0.001)
+
+
+def edit(scheduler, text):
+    return scheduler.submit("editMessageText", {"message_id": 1, "text": text}, chat_id=1, coalesce=True)
+
+
+def test_coalesced_callers_learn_their_payload_was_replaced():
+    client = GatedClient()
+    scheduler = OutboundScheduler(client, chat_rate=1000, chat_burst=1000)
+    try:
+        in_flight = edit(scheduler, "0")
+        # Пока первая правка в работе, следующие склеиваются в одну
+        wait_until(lambda: scheduler.stats()["in_flight"])
+        replaced = edit(scheduler, "a")
+        latest = edit(scheduler, "b")
+        client.gate.set()
+        assert not is_superseded(in_flight.result(5))
+        assert is_superseded(replaced.result(5))
+        assert not is_superseded(latest.result(5))
+        assert client.sent == ["0", "b"]
+    finally:
+        client.gate.set()
+        scheduler.close()
+
+
+def test_show_screen_remembers_only_what_is_on_screen(app_module, fake_telegram, monkeypatch):
+    app = app_module
+    chat_id, message_id = 424242, 77
+    screens = [app.compile_screen({"text": f"screen {i}", "keyboard": {"inline_keyboard": []}}) for i in range(3)]
+    remembered = []
+    remember = app.render_cache.remember
+    monkeypatch.setattr(app.render_cache, "remember",
+                        lambda *args: (remembered.append(args[2]), remember(*args)))
+    fake_telegram.latency = 0.3
+    try:
+        threads = []
+        for screen in screens:
+            thread = threading.Thread(target=app.show_screen, args=(chat_id, screen, message_id))
+            thread.start()
+            threads.append(thread)
+            # Первая правка уходит, вторая и третья склеиваются в очереди
+            wait_until(lambda: app.outbound.stats()["in_flight"])
+        for thread in threads:
+            thread.join(5)
+    finally:
+        fake_telegram.latency = 0.0
+    # Текст второго экрана так и не ушел в Telegram - его digest не запоминается никогда
+    assert screens[1].digest not in remembered
+    assert app.render_cache.is_current(chat_id, message_id, screens[2].digest)
+    assert not app.render_cache.is_current(chat_id, message_id, screens[1].digest)
@@ -0,0 +1,123 @@
+import pytest
+
+from payments import (
+    NANO, PaymentLedger, ReconciliationPoller, parse_comment, parse_transaction, payment_comment
+)
+
+PRICE = 10 * NANO
+PERIOD = 30 * 86400
+
+
+def transaction(lt, chat_id=None, amount=PRICE, source="EQsender", aborted=False):
+    comment = payment_comment(chat_id) if chat_id is not None else None
+    content = {"decoded": {"type": "text_comment", "comment": comment}} if comment else None
+    return {"hash": f"h{lt}", "lt": str(lt), "now": 1_700_000_000 + lt,
+            "description": {"aborted": aborted},
+            "in_msg": {"source": source, "value": str(amount), "message_content": content}}
+
+
+class PagedIndexer:
+    """Индексатор в памяти с тем же контрактом страниц, что и TonIndexerClient"""
+
+    def __init__(self, transactions, page_size=3):
+        self.transactions = transactions
+        self.page_size = page_size
+        self.requests = []
+
+    def page(self, after_lt):
+        self.requests.append(after_lt)
+        page = [tx for tx in self.transactions if int(tx["lt"]) > after_lt][:self.page_size]
+        last_lt = max((int(tx["lt"]) for tx in page), default=after_lt)
+        transfers = [transfer for transfer in map(parse_transaction, page) if transfer]
+        return transfers, last_lt, len(page) >= self.page_size
+
+
+def transfers(*transactions):
+    return [parse_transaction(tx) for tx in transactions]
+
+
+def test_comment_and_transaction_parsing():
+    assert parse_comment(" premium_42 ") == 42
+    assert parse_comment("PREMIUM_-100") == -100
+    assert parse_comment("premium_x") is None
+    assert parse_comment(None) is None
+    assert parse_transaction(transaction(1, 5))["comment"] == "premium_5"
+    assert parse_transaction(transaction(2, 5, aborted=True)) is None
+    assert parse_transaction(transaction(3, 5, source=None)) is None
+
+
+def test_repeated_page_is_counted_once():
+    ledger = PaymentLedger(price=PRICE, period=PERIOD)
+    page = transfers(transaction(1, 7), transaction(2, 8, amount=PRICE // 2), transaction(3))
+    recorded = ledger.record(page, cursor=3)
+    assert len(recorded) == 3
+    until = recorded[0]["premium_until"]
+
+    # Тот же ответ индексатора еще раз (повтор опроса или второй процесс)
+    assert ledger.record(page, cursor=3) == []
+    assert ledger.totals() == {"total_income": PRICE * 2 + PRICE // 2,
+                               "development_fund": PRICE + PRICE // 4, "payments": 3}
+    # Срок не продлен второй раз, недоплата премиум не дает
+    assert ledger.is_premium(7, now=until - 1) and not ledger.is_premium(7, now=until)
+    assert not ledger.is_premium(8, now=1_700_000_000)
+
+
+def test_overpayment_and_renewal_extend_premium():
+    ledger = PaymentLedger(price=PRICE, period=PERIOD)
+    first = ledger.record(transfers(transaction(1, 9, amount=PRICE * 2 + PRICE // 3)))[0]
+    assert first["premium_until"] == 1_700_000_001 + 2 * PERIOD
+    second = ledger.record(transfers(transaction(2, 9)))[0]
+    assert second["premium_until"] == first["premium_until"] + PERIOD
+    assert [payment["granted"] for payment in ledger.payments(9)] == [True, True]
+
+
+def test_cursor_never_moves_back():
+    ledger = PaymentLedger()
+    ledger.record([], cursor=50)
+    ledger.record([], cursor=20)
+    assert ledger.cursor == 50
+
+
+def test_failure_mid_page_rolls_back_the_whole_page(tmp_path):
+    path = str(tmp_path / "payments.db")
+    ledger = PaymentLedger(path, price=PRICE, period=PERIOD)
+    broken = transfers(transaction(1, 1), transaction(2, 2))
+    del broken[1]["amount"]
+    with pytest.raises(KeyError):
+        ledger.record(broken, cursor=2)
+    assert ledger.totals()["payments"] == 0
+    assert ledger.cursor == 0
+    assert not ledger.is_premium(1, now=1_700_000_002)
+
+    ledger.record(transfers(transaction(1, 1), transaction(2, 2)), cursor=2)
+    assert ledger.totals()["payments"] == 2
+    ledger.close()
+
+
+def test_restart_mid_poll_resumes_from_the_cursor(tmp_path):
+    path = str(tmp_path / "payments.db")
+    indexer = PagedIndexer([transaction(lt, chat_id=lt) for lt in range(1, 9)], page_size=3)
+
+    ledger = PaymentLedger(path, price=PRICE, period=PERIOD)
+    poller = ReconciliationPoller(ledger, indexer, max_pages=1)
+    # Процесс успел записать одну страницу и умер
+    assert poller.poll_once() == 3
+    ledger.close()
+
+    restarted = PaymentLedger(path, price=PRICE, period=PERIOD)
+    assert restarted.cursor == 3
+    seen = []
+    poller = ReconciliationPoller(restarted, indexer, on_payment=lambda payment: seen.append(payment["chat_id"]))
+    assert poller.poll_once() == 5
+    assert seen == [4, 5, 6, 7, 8]
+    assert indexer.requests == [0, 3, 6]
+    assert restarted.totals()["payments"] == 8
+    assert all(restarted.is_premium(chat_id, now=1_700_000_000) for chat_id in range(1, 9))
+
+    # Второй процесс с устаревшим курсором перечитывает уже учтенное - без повторов
+    stale = PaymentLedger(path, price=PRICE, period=PERIOD)
+    stale._meta["cursor_lt"] = 0
+    indexer.page_size = 100
+    assert stale.record(indexer.page(0)[0], cursor=8) == []
+    stale.refresh()
+    assert stale.totals()["payments"] == 8
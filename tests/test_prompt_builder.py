@@ -0,0 +1,78 @@
+import pytest
+
+from conversation import ROLE_STUDENT, ROLE_TEACHER, Conversation
+from prompt_builder import LessonContextBuilder, estimate_tokens
+
+
+def run_lesson(builder, capacity, steps):
+    """Проигрывает урок как app: реплика ученика, обновление содержания, промпт, ответ учителя.
+
+    Возвращает для каждого шага реплики, которых нет ни в содержании, ни в промпте дословно.
+    """
+    state = {"step": 0, "conversation": Conversation(capacity)}
+    missing = []
+    for step in range(1, steps + 1):
+        state["conversation"].append(ROLE_STUDENT, f"вопрос {step}.")
+        state["step"] = step
+        builder.refresh_summary(state)
+        prompt, _ = builder.build("Тема", 1, state["conversation"], state.get("summary"),
+                                  state.get("summary_upto", 0))
+        said = [f"вопрос {n}." for n in range(1, step + 1)] + [f"ответ {n}." for n in range(1, step)]
+        missing.append([text for text in said if text not in prompt])
+        state["conversation"].append(ROLE_TEACHER, f"ответ {step}.")
+    return state, missing
+
+
+def test_summary_folds_turns_before_the_ring_evicts_them():
+    builder = LessonContextBuilder(token_budget=5000, summary_budget=5000, recent_turns=4,
+                                   summary_every=2, capacity=8)
+    state, missing = run_lesson(builder, capacity=8, steps=20)
+    assert missing == [[]] * 20
+    assert state["conversation"].total == 40
+    assert len(state["conversation"]) == 8
+    assert state["summary_upto"] == 35
+    assert state["summary"][0] == "- Ученик: вопрос 1."
+
+
+def test_capacity_too_small_for_summary_cadence_is_rejected():
+    with pytest.raises(ValueError):
+        LessonContextBuilder(recent_turns=4, summary_every=3, capacity=8)
+    with pytest.raises(ValueError):
+        LessonContextBuilder(recent_turns=6, summary_every=2, capacity=8)
+    LessonContextBuilder(recent_turns=4, summary_every=2, capacity=8)
+
+
+def test_summary_refreshes_only_every_n_steps():
+    builder = LessonContextBuilder(recent_turns=2, summary_every=3, capacity=8)
+    conversation = Conversation(8)
+    for text in ("a.", "b.", "c.", "d."):
+        conversation.append(ROLE_STUDENT, text)
+    state = {"step": 2, "conversation": conversation}
+    assert builder.refresh_summary(state) is False
+    state["step"] = 3
+    assert builder.refresh_summary(state) is True
+    assert state["summary"] == ["- Ученик: a.", "- Ученик: b."]
+    assert state["summary_upto"] == 2
+
+
+def test_summary_drops_oldest_lines_over_budget():
+    builder = LessonContextBuilder(summary_budget=20, recent_turns=1, summary_every=1, capacity=8)
+    conversation = Conversation(8)
+    for index in range(6):
+        conversation.append(ROLE_TEACHER, f"объяснение номер {index}. Подробности")
+    state = {"step": 1, "conversation": conversation}
+    builder.refresh_summary(state)
+    assert estimate_tokens("\n".join(state["summary"])) <= 20
+    assert state["summary"][-1] == "- Учитель: объяснение номер 4."
+    assert "номер 0" not in "".join(state["summary"])
+
+
+def test_prompt_stays_within_budget_and_keeps_the_last_turn():
+    builder = LessonContextBuilder(token_budget=300, recent_turns=4, capacity=8)
+    conversation = Conversation(8)
+    for index in range(4):
+        conversation.append(ROLE_STUDENT, "слово " * 200 + str(index))
+    prompt, tokens = builder.build("Тема", 1, conversation)
+    # Оценка частей округляется вверх - несколько токенов сверх бюджета допустимы
+    assert tokens <= 310
+    assert "Ученик: слово" in prompt
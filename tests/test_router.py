@@ -0,0 +1,89 @@
+import time
+
+from router import CallbackRouter
+
+
+def query(data, chat_id=1):
+    return {"id": "q1", "data": data, "message": {"chat": {"id": chat_id}, "message_id": 10}}
+
+
+def answered(fake_telegram, query_id):
+    return any(method == "answerCallbackQuery" and payload.get("callback_query_id") == query_id
+               for method, payload in list(fake_telegram.recent))
+
+
+def test_exact_route_wins_over_longest_prefix():
+    router = CallbackRouter()
+    router.exact("menu_course_back")(lambda ctx: {"status": "back"})
+    router.prefix("menu_")(lambda ctx: {"status": "menu"})
+    router.prefix("menu_course_")(lambda ctx: {"status": "course"})
+
+    assert router.dispatch(query("menu_course_back"))["status"] == "back"
+    assert router.dispatch(query("menu_course_Python"))["status"] == "course"
+    assert router.dispatch(query("menu_profile"))["status"] == "menu"
+    assert router.dispatch(query("unknown"))["status"] == "ignored"
+    assert router.stats()["unmatched"] == 1
+
+
+def test_middleware_runs_around_handler_in_registration_order():
+    router = CallbackRouter()
+    calls = []
+    router.before(lambda ctx: calls.append(("answer", ctx.data)))
+    router.before(lambda ctx: calls.append(("state", ctx.route.options.get("event") if ctx.route else None)))
+
+    @router.after
+    def render(ctx, result):
+        calls.append(("render", result))
+        return {"status": "rendered"}
+
+    @router.exact("menu_main", event="open_main_menu")
+    def on_main(ctx):
+        calls.append(("handler", ctx.chat_id))
+        return "screen"
+
+    assert router.dispatch(query("menu_main", chat_id=7)) == {"status": "rendered"}
+    assert calls == [("answer", "menu_main"), ("state", "open_main_menu"),
+                     ("handler", 7), ("render", "screen")]
+
+    # Неизвестная кнопка тоже получает ответ на callback, но не обработчик и не отрисовку
+    calls.clear()
+    router.dispatch(query("stale_button"))
+    assert calls == [("answer", "stale_button"), ("state", None)]
+
+
+def test_route_timing_and_errors_are_counted():
+    observed = []
+    router = CallbackRouter(observer=lambda key, elapsed, failed: observed.append((key, failed)))
+
+    @router.prefix("l:")
+    def on_lesson(ctx):
+        if ctx.data == "l:bad":
+            raise ValueError("no such lesson")
+        time.sleep(0.01)
+
+    assert router.dispatch(query("l:1")) == {"status": "ok"}
+    result = router.dispatch(query("l:bad"))
+    assert result["status"] == "error"
+
+    stats = router.stats()["l:*"]
+    assert stats["calls"] == 2
+    assert stats["errors"] == 1
+    assert stats["max_ms"] >= 10
+    assert observed == [("l:*", False), ("l:*", True)]
+
+
+def test_app_routes_answer_switch_mode_and_render(app_module, fake_telegram):
+    app = app_module
+    chat_id = 616161
+    app.USER_CHAT_MODES.handle(chat_id, "start")
+
+    result = app.callback_router.dispatch(query("menu_neuropartner", chat_id))
+    assert result == {"status": "ok"}
+    assert app.USER_CHAT_MODES.get(chat_id) == app.chat_modes.NEUROPARTNER
+    assert app.render_cache.is_current(chat_id, app.USER_MESSAGE_IDS.get(chat_id),
+                                       app.NEUROPARTNER_SCREEN.digest)
+    # Ответ на callback идет параллельно с отрисовкой
+    deadline = time.monotonic() + 5
+    while not answered(fake_telegram, "q1") and time.monotonic() < deadline:
+        time.sleep(0.01)
+    assert answered(fake_telegram, "q1")
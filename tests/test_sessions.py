@@ -0,0 +1,104 @@
+import threading
+import time
+
+import pytest
+
+from sessions import SessionBusy, SQLiteSessions
+from state_store import StateStore
+
+
+@pytest.fixture
+def workers(tmp_path):
+    path = str(tmp_path / "state.db")
+    created = []
+
+    def make(owner, **kwargs):
+        store = StateStore(path)
+        sessions = SQLiteSessions(path, store, **kwargs)
+        sessions.owner = owner
+        created.append((sessions, store))
+        return sessions, store
+
+    yield make
+    for sessions, store in created:
+        sessions.close()
+        store.close()
+
+
+def hold(sessions, chat_id, seconds, before=None):
+    def run():
+        with sessions.session(chat_id):
+            if before is not None:
+                before()
+            time.sleep(seconds)
+
+    thread = threading.Thread(target=run)
+    thread.start()
+    return thread
+
+
+def test_lease_is_renewed_during_long_handler(workers):
+    first, _ = workers("a", ttl=0.3)
+    second, _ = workers("b", ttl=0.3, wait=0.6)
+    thread = hold(first, 1, 1.0)
+    time.sleep(0.1)
+    # Обработчик идет втрое дольше ttl, но аренду не отбирают
+    with pytest.raises(SessionBusy):
+        with second.session(1):
+            pass
+    thread.join()
+    assert first.stats()["renewals"] > 0
+
+
+def test_lost_lease_discards_changes(workers):
+    first, first_store = workers("a", ttl=0.2)
+    second, second_store = workers("b", ttl=0.2, wait=1.0)
+    first._stop.set()  # продление не работает - аренда истечет
+    first_map, second_map = first_store.map("mode"), second_store.map("mode")
+    thread = hold(first, 2, 0.6, before=lambda: first_map.__setitem__(2, "stale"))
+    time.sleep(0.35)
+    with second.session(2):
+        second_map[2] = "fresh"
+    thread.join()
+    first_store.flush()
+    assert first.stats()["lost"] == 1
+    assert first_store.pending() == 0
+    second_store.invalidate(2)
+    assert second_map[2] == "fresh"
+
+
+def test_failed_flush_still_releases_the_lease(workers, monkeypatch):
+    first, first_store = workers("a", ttl=0.3)
+    second, _ = workers("b", ttl=0.3, wait=0.2)
+
+    def locked(key=None):
+        raise RuntimeError("database is locked")
+
+    monkeypatch.setattr(first_store, "flush", locked)
+    with first.session(3):
+        first_store.map("mode")[3] = "lesson"
+    assert first.stats()["flush_errors"] == 1
+    assert first.renew() == 0
+    # Чат сразу доступен другому воркеру, а не после смерти процесса
+    with second.session(3):
+        pass
+
+
+def test_refresh_drops_cache_of_a_chat_served_elsewhere(workers):
+    first, first_store = workers("a")
+    second, second_store = workers("b")
+    first_modes, second_modes = first_store.map("mode"), second_store.map("mode")
+    with second.session(4):
+        second_modes[4] = "neuropartner"
+    with first.session(4):
+        first_modes[4] = "lesson"
+
+    # Второй воркер еще помнит режим до перехода чата
+    assert second_modes[4] == "neuropartner"
+    second.refresh(4)
+    assert second_modes[4] == "lesson"
+
+    # Свой чат не перечитывается
+    first_modes[4] = "unsaved"
+    first.refresh(4)
+    assert first_modes[4] == "unsaved"
@@ -0,0 +1,75 @@
+import sqlite3
+
+import pytest
+
+from state_store import StateStore
+
+
+class LockedConnection:
+    """Соединение, на котором запись падает, как при занятой другим процессом базе"""
+
+    def __init__(self, conn):
+        self.conn = conn
+
+    def __enter__(self):
+        return self.conn.__enter__()
+
+    def __exit__(self, *exc):
+        return self.conn.__exit__(*exc)
+
+    def executemany(self, *args):
+        raise sqlite3.OperationalError("database is locked")
+
+
+def test_write_behind_survives_restart(tmp_path):
+    path = str(tmp_path / "state.db")
+    store = StateStore(path, flush_interval=60)
+    progress = store.map("progress")
+    progress[1] = {"points": 10}
+    assert store.pending() == 1
+    store.close()
+
+    restored = StateStore(path).map("progress")
+    assert restored[1] == {"points": 10}
+
+
+def test_failed_flush_keeps_changes_for_the_next_one(tmp_path):
+    path = str(tmp_path / "state.db")
+    store = StateStore(path, flush_interval=60)
+    progress = store.map("progress")
+    progress[1] = {"points": 10}
+    conn, store._conn = store._conn, LockedConnection(store._conn)
+    with pytest.raises(sqlite3.OperationalError):
+        store.flush()
+    store._conn = conn
+    assert store.pending() == 1
+    assert store.stats()["flush_errors"] == 1
+
+    progress[1] = {"points": 20}
+    assert store.flush() == 1
+    store.close()
+    assert StateStore(path).map("progress")[1] == {"points": 20}
+
+
+def test_held_key_is_written_only_by_its_owner(tmp_path):
+    store = StateStore(str(tmp_path / "state.db"), flush_interval=60)
+    modes = store.map("mode")
+    store.hold(1)
+    modes[1] = "lesson"
+    modes[2] = "menu"
+    assert store.flush() == 1
+    assert store.pending() == 1
+    assert store.flush(1) == 1
+    store.release(1)
+    store.close()
+
+
+def test_discard_drops_pending_changes_and_cache(tmp_path):
+    path = str(tmp_path / "state.db")
+    store = StateStore(path, flush_interval=60)
+    modes = store.map("mode")
+    modes[1] = "stale"
+    store.discard(1)
+    assert store.pending() == 0
+    assert 1 not in modes
+    store.close()
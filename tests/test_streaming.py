@@ -0,0 +1,40 @@
+import pytest
+
+from streaming import CURSOR, ProgressiveEditor, close_markdown
+
+
+@pytest.mark.parametrize("text, safe", [
+    ("простой текст", "простой текст"),
+    ("*жирный* и _курсив_", "*жирный* и _курсив_"),
+    ("готово. *незакры", "готово. "),
+    ("код `print(", "код "),
+    ("```\nблок * с _маркерами` внутри\n```", "```\nблок * с _маркерами` внутри\n```"),
+    ("до ```\nнезакрытый *блок", "до "),
+    ("`x_y` и *z*", "`x_y` и *z*"),
+    ("[ссылка](https://example.com) дальше", "[ссылка](https://example.com) дальше"),
+    ("см. [ссылка](https://exa", "см. "),
+    ("см. [ссылк", "см. "),
+    ("*a* _b", "*a* "),
+])
+def test_close_markdown_cuts_before_unclosed_entity(text, safe):
+    assert close_markdown(text) == safe
+
+
+class RecordingOutbound:
+    def __init__(self):
+        self.texts = []
+
+    def submit(self, method, payload, chat_id=None, coalesce=False):
+        assert coalesce
+        self.texts.append(payload["text"])
+
+
+def test_editor_sends_only_safe_growing_prefixes():
+    outbound = RecordingOutbound()
+    editor = ProgressiveEditor(outbound, 1, 10, "H: ", interval=0, min_delta=5)
+    editor("Начало ответа *выдел")
+    editor("Начало ответа *выделено")
+    editor("Начало ответа *выделено* и еще немного текста")
+    assert outbound.texts == ["H: Начало ответа" + CURSOR,
+                              "H: Начало ответа *выделено* и еще немного текста" + CURSOR]
+    assert editor.edits == 2
@@ -0,0 +1,66 @@
+import time
+
+from update_queue import UpdateQueue
+
+
+def update(update_id, chat_id):
+    return {"update_id": update_id, "message": {"chat": {"id": chat_id}, "text": str(update_id)}}
+
+
+class BusyChats:
+    """Обработчик, у которого часть чатов занята другим воркером"""
+
+    def __init__(self, busy=()):
+        self.busy = set(busy)
+        self.handled = []
+
+    def __call__(self, data):
+        chat_id = data["message"]["chat"]["id"]
+        if chat_id in self.busy:
+            return {"status": "busy"}
+        self.handled.append(data["update_id"])
+        return {"status": "ok"}
+
+
+def test_busy_chat_is_retried_in_order_without_blocking_its_shard():
+    handler = BusyChats(busy={1})
+    updates = UpdateQueue(handler, workers=1, retry_delay=0.01, retry_max_delay=0.05)
+    updates.start()
+    try:
+        updates.submit(update(1, 1))
+        updates.submit(update(2, 2))
+        updates.submit(update(3, 1))
+        deadline = time.monotonic() + 5
+        while 2 not in handler.handled and time.monotonic() < deadline:
+            time.sleep(0.01)
+        # Другой чат того же шарда не ждет занятый
+        assert handler.handled == [2]
+        assert updates.stats()["parked"] == 2
+
+        handler.busy.clear()
+        while len(handler.handled) < 3 and time.monotonic() < deadline:
+            time.sleep(0.01)
+        assert handler.handled == [2, 1, 3]
+        assert updates.stats()["retried"] >= 1
+    finally:
+        updates.shutdown(1)
+
+
+def test_busy_chat_is_dropped_after_retry_budget():
+    handler = BusyChats(busy={1})
+    dropped = []
+    updates = UpdateQueue(handler, workers=1, retry_delay=0.01, retry_max_delay=0.02,
+                          retry_budget=0.1, on_drop=lambda data: dropped.append(data["update_id"]))
+    updates.start()
+    try:
+        updates.submit(update(1, 1))
+        updates.submit(update(2, 1))
+        deadline = time.monotonic() + 5
+        while len(dropped) < 2 and time.monotonic() < deadline:
+            time.sleep(0.01)
+        assert dropped == [1, 2]
+        assert updates.stats()["dropped"] == 2
+        assert updates.stats()["parked"] == 0
+        assert handler.handled == []
+    finally:
+        updates.shutdown(1)
@@ -0,0 +1,238 @@
+"""Очередь входящих обновлений Telegram.
+
+Вебхук только проверяет update, кладет его в очередь и сразу отвечает 200,
+а обработка идет в ограниченном пуле воркеров. Все обновления одного
+chat_id попадают в один и тот же воркер, поэтому внутри чата порядок
+сохраняется, а разные чаты обрабатываются параллельно.
+
+Если чат занят другим воркером (обработчик вернул {"status": "busy"}), воркер
+шарда его не ждет: update откладывается и повторяется с растущей паузой, а
+следующие update того же чата встают за ним. Когда пауза исчерпана, update
+отбрасываются и передаются в on_drop.
+"""
+import heapq
+import itertools
+import logging
+import queue
+import threading
+import time
+from collections import deque
+
+log = logging.getLogger(__name__)
+
+_STOP = object()
+
+
+class _Retry:
+    """Метка в очереди шарда: пора повторить отложенные update чата"""
+    __slots__ = ("chat_id",)
+
+    def __init__(self, chat_id):
+        self.chat_id = chat_id
+
+
+class _Parked:
+    """Отложенные update занятого чата в порядке поступления"""
+    __slots__ = ("updates", "attempts", "waited")
+
+    def __init__(self):
+        self.updates = deque()
+        self.attempts = 0
+        self.waited = 0.0
+
+
+def extract_chat_id(update):
+    """Достает chat_id из сообщения или callback_query"""
+    if 'callback_query' in update:
+        return update['callback_query'].get('message', {}).get('chat', {}).get('id')
+    for key in ('message', 'edited_message'):
+        if key in update:
+            return update[key].get('chat', {}).get('id')
+    return None
+
+
+class UpdateQueue:
+    def __init__(self, handler, workers=8, max_depth=1000, retry_delay=0.05,
+                 retry_max_delay=2.0, retry_budget=30.0, on_drop=None):
+        self.handler = handler
+        self.workers = max(1, workers)
+        self.retry_delay = retry_delay
+        self.retry_max_delay = retry_max_delay
+        self.retry_budget = retry_budget
+        self.on_drop = on_drop
+        shard_size = max(1, max_depth // self.workers)
+        self._queues = [queue.Queue(maxsize=shard_size) for _ in range(self.workers)]
+        self._threads = []
+        self._accepting = False
+        # Занятые чаты: chat_id -> _Parked. Чат всегда в одном шарде, поэтому
+        # запись меняет только воркер этого шарда
+        self._parked = {}
+        self._timers = []
+        self._timer_cond = threading.Condition()
+        self._timer_seq = itertools.count()
+        self._timer_thread = None
+        self._stopping = False
+        self.processed = 0
+        self.rejected = 0
+        self.failed = 0
+        self.retried = 0
+        self.dropped = 0
+
+    def start(self):
+        if self._threads:
+            return
+        self._accepting = True
+        for i, shard in enumerate(self._queues):
+            thread = threading.Thread(
+                target=self._worker, args=(shard,), name=f"update-worker-{i}", daemon=True
+            )
+            thread.start()
+            self._threads.append(thread)
+        self._timer_thread = threading.Thread(target=self._timer_loop, name="update-retry", daemon=True)
+        self._timer_thread.start()
+
+    def _shard_for(self, chat_id):
+        if chat_id is None:
+            return self._queues[0]
+        return self._queues[hash(chat_id) % self.workers]
+
+    def submit(self, update):
+        """Ставит update в очередь. False - очередь переполнена или закрыта"""
+        if not self._accepting:
+            self.rejected += 1
+            return False
+        try:
+            self._shard_for(extract_chat_id(update)).put_nowait(update)
+            return True
+        except queue.Full:
+            self.rejected += 1
+            return False
+
+    def depth(self):
+        return sum(shard.qsize() for shard in self._queues)
+
+    def parked(self):
+        return sum(len(parked.updates) for parked in list(self._parked.values()))
+
+    def stats(self):
+        return {
+            "workers": self.workers,
+            "depth": self.depth(),
+            "parked": self.parked(),
+            "processed": self.processed,
+            "rejected": self.rejected,
+            "failed": self.failed,
+            "retried": self.retried,
+            "dropped": self.dropped
+        }
+
+    def _worker(self, shard):
+        while True:
+            item = shard.get()
+            try:
+                if item is _STOP:
+                    return
+                if isinstance(item, _Retry):
+                    self._retry(item.chat_id)
+                    continue
+                chat_id = extract_chat_id(item)
+                parked = self._parked.get(chat_id)
+                if parked is not None:
+                    # Чат ждет повтора - новый update встает за отложенными
+                    parked.updates.append(item)
+                elif not self._process(item):
+                    parked = self._parked[chat_id] = _Parked()
+                    parked.updates.append(item)
+                    self._schedule(chat_id, parked)
+            finally:
+                shard.task_done()
+
+    def _process(self, update):
+        """False - чат занят другим воркером, update нужно повторить"""
+        try:
+            result = self.handler(update)
+        except Exception as e:
+            self.failed += 1
+            log.error("Update worker error: %s", e)
+            return True
+        if isinstance(result, dict) and result.get("status") == "busy":
+            return False
+        self.processed += 1
+        return True
+
+    def _retry(self, chat_id):
+        parked = self._parked.get(chat_id)
+        if parked is None:
+            return
+        while parked.updates:
+            if not self._process(parked.updates[0]):
+                self._schedule(chat_id, parked)
+                return
+            parked.updates.popleft()
+        del self._parked[chat_id]
+
+    def _schedule(self, chat_id, parked):
+        """Назначает повтор с растущей паузой или отбрасывает update, если ждать больше нельзя"""
+        delay = min(self.retry_max_delay, self.retry_delay * 2 ** parked.attempts)
+        if parked.waited + delay > self.retry_budget:
+            del self._parked[chat_id]
+            log.error("Chat %s busy for %.1fs, %d updates dropped", chat_id, parked.waited, len(parked.updates))
+            self._drop(parked.updates)
+            return
+        parked.attempts += 1
+        parked.waited += delay
+        self.retried += 1
+        with self._timer_cond:
+            heapq.heappush(self._timers, (time.monotonic() + delay, next(self._timer_seq), chat_id))
+            self._timer_cond.notify()
+
+    def _drop(self, updates):
+        for update in updates:
+            self.dropped += 1
+            if self.on_drop is not None:
+                try:
+                    self.on_drop(update)
+                except Exception as e:
+                    log.error("Update drop callback error: %s", e)
+
+    def _timer_loop(self):
+        while True:
+            with self._timer_cond:
+                while not self._stopping:
+                    wait = self._timers[0][0] - time.monotonic() if self._timers else None
+                    if wait is not None and wait <= 0:
+                        break
+                    self._timer_cond.wait(wait)
+                if self._stopping:
+                    return
+                _, _, chat_id = heapq.heappop(self._timers)
+            # Повтор идет в шард чата - за update, которые уже стоят в очереди
+            self._shard_for(chat_id).put(_Retry(chat_id))
+
+    def shutdown(self, timeout=10.0):
+        """Перестает принимать обновления и дорабатывает уже принятые.
+
+        Возвращает количество обновлений, которые не успели обработать.
+        """
+        if not self._accepting:
+            return self.depth()
+        self._accepting = False
+        with self._timer_cond:
+            self._stopping = True
+            self._timer_cond.notify()
+        deadline = time.monotonic() + timeout
+        for shard in self._queues:
+            try:
+                shard.put(_STOP, timeout=max(0.0, deadline - time.monotonic()))
+            except queue.Full:
+                pass
+        for thread in self._threads:
+            thread.join(max(0.0, deadline - time.monotonic()))
+        # Отложенные update занятых чатов больше не повторить
+        parked = [update for chat in list(self._parked.values()) for update in chat.updates]
+        self._parked.clear()
+        self._drop(parked)
+        left = self.depth() + len(parked)
+        if left:
+            log.error("Update queue shutdown: %d updates not processed", left)
+        return left